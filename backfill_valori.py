@@ -0,0 +1,107 @@
+# backfill_valori.py – calcola e salva i valori di stima sulle righe storiche
+#
+# Uso:
+#   python backfill_valori.py            # solo righe senza valori
+#   python backfill_valori.py --tutte    # ricalcola anche quelle già valutate
+#   python backfill_valori.py --batch 200
+#
+# Ogni blocco è una transazione a sé (paginazione per id): si può
+# interrompere e rilanciare senza rifare il lavoro già fatto.
+
+import argparse
+
+from psycopg2.extras import execute_values
+
+import regole
+from database import get_connection
+from valuation import (
+    compute_from_payload,
+    payload_from_row,
+    versione_motore,
+    CATALOG_VERSION,
+)
+
+
+def backfill_valori(batch: int = 500, tutte: bool = False) -> int:
+    filtro = "" if tutte else "AND price_exact IS NULL"
+    ultimo_id = 0
+    totale = 0
+    saltate = []
+
+    conn = get_connection()
+    try:
+        while True:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT * FROM stime
+                WHERE id > %s AND deleted_at IS NULL {filtro}
+                ORDER BY id
+                LIMIT %s
+            """, (ultimo_id, batch))
+            rows = cur.fetchall()
+            cols = [d[0] for d in cur.description]
+
+            if not rows:
+                cur.close()
+                break
+
+            valori = []
+            r_blocco = regole.attuali()
+            versione = versione_motore(r_blocco)
+            for r in rows:
+                row = dict(zip(cols, r))
+                try:
+                    calc = compute_from_payload(payload_from_row(row), r_blocco)
+                except Exception as e:
+                    # una riga storica malformata non deve fermare il backfill
+                    print(f"⚠️  Stima {row['id']} saltata: {e!r}")
+                    saltate.append(row["id"])
+                    continue
+                valori.append((
+                    row["id"],
+                    calc["price_exact"], calc["eur_mq_finale"],
+                    calc["valore_pertinenze"], calc["base_mq"],
+                    versione, CATALOG_VERSION,
+                ))
+
+            if valori:
+                execute_values(cur, """
+                    UPDATE stime AS s SET
+                      price_exact = v.price_exact,
+                      eur_mq_finale = v.eur_mq_finale,
+                      valore_pertinenze = v.valore_pertinenze,
+                      base_mq = v.base_mq,
+                      engine_version = v.engine_version,
+                      catalog_version = v.catalog_version,
+                      valutata_at = NOW()
+                    FROM (VALUES %s) AS v(id, price_exact, eur_mq_finale,
+                                          valore_pertinenze, base_mq,
+                                          engine_version, catalog_version)
+                    WHERE s.id = v.id
+                """, valori,
+                    template="(%s::int, %s::numeric, %s::numeric, %s::numeric, %s::numeric, %s, %s)",
+                    page_size=batch)
+            conn.commit()
+            cur.close()
+
+            ultimo_id = rows[-1][cols.index("id")]
+            totale += len(valori)
+            print(f"🔧 Valutate {totale} righe (ultimo id {ultimo_id})")
+    finally:
+        conn.close()
+
+    if saltate:
+        print(f"⚠️  {len(saltate)} stime saltate per errore del motore: {saltate}")
+    return totale
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Backfill valori calcolati su stime")
+    ap.add_argument("--batch", type=int, default=500)
+    ap.add_argument("--tutte", action="store_true",
+                    help="ricalcola anche le righe già valutate")
+    args = ap.parse_args()
+
+    regole.carica()   # le stesse regole del server (REGOLE_SORGENTE)
+    n = backfill_valori(batch=args.batch, tutte=args.tutte)
+    print(f"✅ Backfill completato: {n} righe ({versione_motore()} / {CATALOG_VERSION}).")
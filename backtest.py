@@ -0,0 +1,267 @@
+# backtest.py – rigioca le stime storiche su una o più versioni del motore
+#
+# Uso:
+#   python backtest.py                                        # motore attuale
+#   python backtest.py --regole nuove.yaml                    # coefficienti nuovi
+#   python backtest.py --motori valuation,valuation_candidata # codice nuovo
+#   python backtest.py --processi 8 --dal 2024-01-01 --json backtest.json
+#   python backtest.py --solo-vendute                         # solo righe con esito
+#
+# Ogni riga di `stime` non eliminata (con i campi di stime_dettagliate
+# sovrapposti, se il lead l'ha compilata: sono quelli più affidabili)
+# passa da ogni motore. I motori sono moduli con ENGINE_VERSION e
+# compute_from_payload (come in shadow.py), più un motore live per ogni file
+# di --regole (regole.py: è così che si prova un ritocco dei coefficienti,
+# una copia di valuation.py userebbe le regole attuali). Il primo è il
+# riferimento.
+#
+# Confronti, per motore e per comune/microzona:
+#   - errore % rispetto al prezzo di vendita reale (stime.prezzo_vendita,
+#     inserito dall'agente con POST /api/admin/stime/{stima_id}/update),
+#     dove c'è
+#   - scostamento % dal price_exact registrato al momento della stima
+#   - scostamento % dal primo motore della lista
+#
+# Parallelo: --processi shard per `id % N`, ognuno con la sua connessione e
+# un cursore lato server (named cursor): le righe arrivano a blocchi di
+# ITERSIZE, la memoria resta piatta anche su anni di lead.
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import multiprocessing
+from array import array
+from datetime import date
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+ITERSIZE = 5000
+
+# campi di stime_dettagliate che, se valorizzati, sostituiscono quelli di stime
+CAMPI_DETTAGLIO = (
+    "tipologia", "mq", "piano", "locali", "bagni", "ascensore", "stato", "anno",
+    "microzona", "posizionemare", "distanzamare", "barrieramare", "vistamare",
+    "mqgiardino", "mqgarage", "mqcantina", "mqpostoauto", "mqtaverna",
+    "mqsoffitta", "mqterrazzo", "numbalconi", "altrodescrizione", "pertinenze",
+)
+
+SQL_RIGHE = """
+    SELECT s.*, {dettaglio}
+    FROM stime s
+    LEFT JOIN LATERAL (
+        SELECT * FROM stime_dettagliate d
+        WHERE d.stima_id = s.id AND d.deleted_at IS NULL
+        ORDER BY d.id DESC
+        LIMIT 1
+    ) d ON TRUE
+    WHERE s.deleted_at IS NULL
+      AND s.id %% %(shard_n)s = %(shard_k)s
+      AND s.data >= %(dal)s AND s.data < %(al)s
+      {filtro}
+""".format(
+    dettaglio=", ".join(f"d.{c} AS d_{c}" for c in CAMPI_DETTAGLIO),
+    filtro="{filtro}",
+)
+
+
+def _motori(nomi: list[str], file_regole: list[str] = ()) -> list[tuple[str, object]]:
+    """[(versione, compute_from_payload)]: i moduli nell'ordine dato, poi i file di regole."""
+    import regole
+    from valuation import compute_from_payload, versione_motore
+
+    regole.carica()   # le stesse regole del server (REGOLE_SORGENTE)
+    motori = []
+    for nome in nomi:
+        modulo = importlib.import_module(nome)
+        versione = getattr(modulo, "versione_motore", lambda: modulo.ENGINE_VERSION)()
+        motori.append((f"{versione} ({nome})", modulo.compute_from_payload))
+    for percorso in file_regole:
+        r = regole.compila(regole.leggi_file(percorso), percorso)
+        motori.append((f"{versione_motore(r)} ({os.path.basename(percorso)})",
+                       lambda payload, r=r: compute_from_payload(payload, r)))
+    return motori
+
+
+def _riga_payload(riga: dict) -> dict:
+    from valuation import payload_from_row
+
+    for c in CAMPI_DETTAGLIO:
+        v = riga.pop(f"d_{c}", None)
+        if v not in (None, ""):
+            riga[c] = v
+    return payload_from_row(riga)
+
+
+# ---------------------------------------------------------
+# SHARD (processo figlio)
+# ---------------------------------------------------------
+def _shard(args: dict) -> dict:
+    """Rigioca le righe con id % shard_n == shard_k; serie per (motore, comune, microzona)."""
+    from database import get_connection
+
+    t0 = time.perf_counter()
+    motori = _motori(args["motori"], args["regole"])
+    serie = {}          # (motore, comune, microzona) → {misura: array('d')}
+    esito = {"righe": 0, "errori": 0}
+
+    def aggiungi(chiave, misura, valore):
+        serie.setdefault(chiave, {}).setdefault(misura, array("d")).append(valore)
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor(name=f"backtest_{args['shard_k']}")
+        cur.itersize = ITERSIZE
+        filtro = "AND s.prezzo_vendita IS NOT NULL" if args["solo_vendute"] else ""
+        cur.execute(SQL_RIGHE.format(filtro=filtro), args)
+        colonne = None
+        for r in cur:
+            if colonne is None:
+                colonne = [d[0] for d in cur.description]
+            riga = dict(zip(colonne, r))
+            esito["righe"] += 1
+            payload = _riga_payload(riga)
+            vendita = float(riga["prezzo_vendita"]) if riga.get("prezzo_vendita") else None
+            live = float(riga["price_exact"]) if riga.get("price_exact") else None
+            riferimento = None
+            for i, (versione, calcola) in enumerate(motori):
+                try:
+                    prezzo = calcola(payload)["price_exact"]
+                except Exception:
+                    esito["errori"] += 1
+                    continue
+                chiave = (versione, payload.get("comune") or "", payload.get("microzona") or "")
+                aggiungi(chiave, "prezzo", prezzo)
+                if vendita:
+                    aggiungi(chiave, "errore_pct", (prezzo - vendita) / vendita * 100)
+                if live:
+                    aggiungi(chiave, "delta_live_pct", (prezzo - live) / live * 100)
+                if i == 0:
+                    riferimento = prezzo
+                elif riferimento:
+                    aggiungi(chiave, "delta_rif_pct", (prezzo - riferimento) / riferimento * 100)
+        cur.close()
+        conn.rollback()
+    finally:
+        conn.close()
+
+    esito["serie"] = {k: {m: v.tobytes() for m, v in misure.items()} for k, misure in serie.items()}
+    esito["secondi"] = time.perf_counter() - t0
+    return esito
+
+
+# ---------------------------------------------------------
+# AGGREGAZIONE
+# ---------------------------------------------------------
+def _statistiche(valori) -> dict:
+    import numpy as np
+
+    if not len(valori):
+        return {}
+    v = np.asarray(valori)
+    p10, p50, p90 = np.percentile(v, [10, 50, 90])
+    return {
+        "n": int(v.size),
+        "media": round(float(v.mean()), 2),
+        "mediana": round(float(p50), 2),
+        "p10": round(float(p10), 2),
+        "p90": round(float(p90), 2),
+        "abs_media": round(float(np.abs(v).mean()), 2),       # MAPE per errore_pct
+        "abs_p90": round(float(np.percentile(np.abs(v), 90)), 2),
+        "entro_10pct": round(float((np.abs(v) <= 10).mean()), 4),
+    }
+
+
+def backtest(motori: list[str], processi: int, dal: date, al: date,
+             solo_vendute: bool = False, file_regole: list[str] = ()) -> dict:
+    import numpy as np
+
+    _motori(motori, file_regole)   # errore subito se un modulo o un file non va
+    t0 = time.perf_counter()
+    lavori = [{"motori": motori, "regole": list(file_regole), "shard_n": processi, "shard_k": k, "dal": dal, "al": al,
+               "solo_vendute": solo_vendute} for k in range(processi)]
+    if processi == 1:
+        parziali = [_shard(lavori[0])]
+    else:
+        # spawn: nessuna connessione DB ereditata dal padre
+        with multiprocessing.get_context("spawn").Pool(processi) as pool:
+            parziali = pool.map(_shard, lavori)
+
+    unite = {}
+    for p in parziali:
+        for chiave, misure in p["serie"].items():
+            for misura, grezzo in misure.items():
+                unite.setdefault(chiave, {}).setdefault(misura, []).append(np.frombuffer(grezzo))
+
+    risultato = {"motori": {}, "righe": sum(p["righe"] for p in parziali),
+                 "errori": sum(p["errori"] for p in parziali), "processi": processi,
+                 "dal": dal.isoformat(), "al": al.isoformat()}
+    per_motore = {}
+    for (versione, comune, microzona), misure in unite.items():
+        misure = {m: np.concatenate(v) for m, v in misure.items()}
+        per_motore.setdefault(versione, {})[(comune, microzona)] = misure
+
+    for versione, zone in per_motore.items():
+        totale = {m: np.concatenate([z[m] for z in zone.values() if m in z])
+                  for m in ("errore_pct", "delta_live_pct", "delta_rif_pct")
+                  if any(m in z for z in zone.values())}
+        risultato["motori"][versione] = {
+            "totale": {"stime": int(sum(len(z["prezzo"]) for z in zone.values())),
+                       **{m: _statistiche(v) for m, v in totale.items()}},
+            "microzone": sorted((
+                {"comune": c, "microzona": mz, "stime": int(len(m["prezzo"])),
+                 **{k: _statistiche(v) for k, v in m.items() if k != "prezzo"}}
+                for (c, mz), m in zone.items()
+            ), key=lambda r: -r["stime"]),
+        }
+    risultato["secondi"] = round(time.perf_counter() - t0, 2)
+    return risultato
+
+
+def stampa(r: dict, righe_max: int = 25):
+    print(f"\n{r['righe']} stime rigiocate in {r['secondi']} s con {r['processi']} processi "
+          f"({r['dal']} → {r['al']}, errori motore: {r['errori']})")
+    for versione, m in r["motori"].items():
+        t = m["totale"]
+        print(f"\n=== {versione}: {t['stime']} stime")
+        for misura, nome in (("errore_pct", "errore vs vendita"), ("delta_live_pct", "vs price_exact registrato"),
+                             ("delta_rif_pct", "vs primo motore")):
+            s = t.get(misura)
+            if s:
+                print(f"  {nome:27} n={s['n']:<7} mediana {s['mediana']:+6.2f}%  "
+                      f"p10 {s['p10']:+6.2f}%  p90 {s['p90']:+6.2f}%  |medio| {s['abs_media']:5.2f}%  "
+                      f"entro ±10% {s['entro_10pct'] * 100:5.1f}%")
+        print(f"  {'comune / microzona':42} {'stime':>6} {'vendute':>7} {'MAPE':>7} {'bias':>7} {'Δ rif p50':>9}")
+        for z in m["microzone"][:righe_max]:
+            e, d = z.get("errore_pct", {}), z.get("delta_rif_pct", {})
+            print(f"  {(z['comune'] + ' / ' + z['microzona'])[:42]:42} {z['stime']:6} "
+                  f"{e.get('n', 0):7} "
+                  f"{(format(e['abs_media'], '6.2f') + '%') if e else '      -':>7} "
+                  f"{(format(e['mediana'], '+6.2f') + '%') if e else '      -':>7} "
+                  f"{(format(d['mediana'], '+8.2f') + '%') if d else '        -':>9}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Backtest del motore sulle stime storiche")
+    ap.add_argument("--motori", default="valuation",
+                    help="moduli separati da virgola; il primo è il riferimento (default valuation)")
+    ap.add_argument("--regole", default="",
+                    help="file di regole (yaml/json) separati da virgola, provati col motore live")
+    ap.add_argument("--processi", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--dal", type=date.fromisoformat, default=date(2000, 1, 1))
+    ap.add_argument("--al", type=date.fromisoformat, default=date(2100, 1, 1))
+    ap.add_argument("--solo-vendute", action="store_true", help="solo righe con prezzo_vendita")
+    ap.add_argument("--json", help="scrive il risultato completo in questo file")
+    args = ap.parse_args()
+
+    esito = backtest([m.strip() for m in args.motori.split(",") if m.strip()],
+                     max(1, args.processi), args.dal, args.al, args.solo_vendute,
+                     [p.strip() for p in args.regole.split(",") if p.strip()])
+    stampa(esito)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(esito, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 {args.json}")
+    sys.exit(0)
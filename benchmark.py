@@ -0,0 +1,376 @@
+# benchmark.py – benchmark riproducibili di motore, PDF, pipeline e query admin
+#
+# Uso:
+#   python benchmark.py                      # tutti i gruppi
+#   python benchmark.py valuation pdf        # solo alcuni gruppi
+#   python benchmark.py admin --righe 1000000
+#   python benchmark.py --confronta          # confronta con l'ultimo run di un altro commit
+#
+# Gruppi:
+#   valuation  compute_from_payload e compute_base_from_payload su un corpus
+#              generato (seed fisso, stesso corpus a ogni run)
+#   pdf        genera_pdf_stima con upload GitHub sostituito e cache disattivata
+#   pipeline   POST /api/salva_stima end-to-end su Postgres locale, con
+#              SMTP / WhatsApp / GitHub sostituiti da funzioni finte
+#   admin      query delle liste admin su N righe seminate (default 1M)
+#
+# pipeline e admin girano in uno schema temporaneo (vedi verifica_indici.py),
+# mai sulle tabelle vere. I risultati finiscono in .benchmarks/, un file JSON
+# per run con commit e macchina: --confronta segnala le regressioni oltre --soglia.
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import statistics
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RISULTATI_DIR = os.path.join(BASE_DIR, ".benchmarks")
+
+GRUPPI = ("valuation", "pdf", "pipeline", "admin")
+
+
+# ---------------------------------------------------------
+# CORPUS
+# ---------------------------------------------------------
+def corpus_payload(n: int, seed: int = 360) -> list[dict]:
+    """Payload realistici (stessi campi del form) generati con seed fisso."""
+    from valuation import BASE_MQ
+
+    rnd = random.Random(seed)
+    zone = [(c, z) for c, mz in BASE_MQ.items() for z in mz]
+    corpus = []
+    for _ in range(n):
+        comune, microzona = rnd.choice(zone)
+        tipologia = rnd.choices(["Appartamento", "Villa", "Rustico"], [8, 2, 1])[0]
+        mq = rnd.randint(35, 260)
+        pertinenze = rnd.sample(
+            ["Giardino", "Garage", "Cantina", "Posto auto", "Terrazzo", "Balconi"],
+            rnd.randint(0, 3))
+        vista = rnd.choice(["No", "Sì"])
+        corpus.append({
+            "comune": comune,
+            "microzona": microzona,
+            "tipologia": tipologia,
+            "mq": mq,
+            "piano": rnd.choice(["Terra", "1", "2", "3", "4", "Attico"]),
+            "locali": rnd.choice(["Monolocale", "Bilocale", "Trilocale", "4", "5"]),
+            "bagni": rnd.randint(1, 3),
+            "ascensore": rnd.choice(["Sì", "No"]),
+            "anno": rnd.randint(1955, 2025),
+            "stato": rnd.choice(["nuovo", "ristrutturato", "buono", "scarso", "grezzo"]),
+            "posizioneMare": rnd.choice(["frontemare", "seconda", "interna"]),
+            "distanzaMare": rnd.choice(["0-100", "100-300", "300-500", "500-1000", ">1000"]),
+            "barrieraMare": rnd.choice(["si", "no"]),
+            "vistaMareYN": vista,
+            "vistaMareDettaglio": rnd.choice(["panoramica", "parziale", "scarsa"]) if vista == "Sì" else "",
+            "vistaMare": "",
+            "pertinenze": ", ".join(pertinenze),
+            "mqGiardino": rnd.randint(20, 400) if "Giardino" in pertinenze else None,
+            "mqGarage": rnd.randint(12, 40) if "Garage" in pertinenze else None,
+            "mqCantina": rnd.randint(5, 20) if "Cantina" in pertinenze else None,
+            "mqPostoAuto": rnd.randint(10, 15) if "Posto auto" in pertinenze else None,
+            "mqTaverna": None,
+            "mqSoffitta": None,
+            "mqTerrazzo": rnd.randint(8, 60) if "Terrazzo" in pertinenze else None,
+            "numBalconi": rnd.randint(1, 3) if "Balconi" in pertinenze else None,
+            "via": rnd.choice(["Lungomare Marconi", "Via Roma", "Via Nazionale", "Via Trieste"]),
+            "civico": str(rnd.randint(1, 200)),
+            "altroDescrizione": "",
+        })
+    return corpus
+
+
+# ---------------------------------------------------------
+# MISURA
+# ---------------------------------------------------------
+def misura(nome: str, funzione, ripetizioni: int, riscaldamento: int = 1,
+           operazioni: int = 1) -> dict:
+    """
+    Esegue funzione() `ripetizioni` volte (dopo il riscaldamento) e
+    restituisce le statistiche in secondi per operazione.
+    """
+    for _ in range(riscaldamento):
+        funzione()
+    tempi = []
+    for _ in range(ripetizioni):
+        t0 = time.perf_counter()
+        funzione()
+        tempi.append((time.perf_counter() - t0) / operazioni)
+    tempi.sort()
+    esito = {
+        "nome": nome,
+        "ripetizioni": ripetizioni,
+        "operazioni": operazioni,
+        "min": tempi[0],
+        "mediana": statistics.median(tempi),
+        "media": statistics.fmean(tempi),
+        "p95": tempi[min(len(tempi) - 1, int(len(tempi) * 0.95))],
+        "max": tempi[-1],
+    }
+    print(f"  {nome:<40} mediana {esito['mediana'] * 1e3:10.3f} ms   "
+          f"p95 {esito['p95'] * 1e3:10.3f} ms   ({ripetizioni}×{operazioni})")
+    return esito
+
+
+# ---------------------------------------------------------
+# GRUPPI
+# ---------------------------------------------------------
+def bench_valuation(args) -> list[dict]:
+    from valuation import compute_from_payload
+    from valuation_base import compute_base_from_payload
+
+    corpus = corpus_payload(args.corpus)
+
+    def tutti(fn):
+        return lambda: [fn(p) for p in corpus]
+
+    return [
+        misura("compute_from_payload", tutti(compute_from_payload),
+               args.ripetizioni, operazioni=len(corpus)),
+        misura("compute_base_from_payload", tutti(compute_base_from_payload),
+               args.ripetizioni, operazioni=len(corpus)),
+    ]
+
+
+def bench_pdf(args) -> list[dict]:
+    import tempfile
+    import pdf_report
+    from valuation import compute_from_payload
+
+    pdf_report.warmup()
+    pdf_report._upload_pdf_to_github = lambda path, nome: f"https://example.invalid/{nome}"
+
+    corpus = corpus_payload(args.ripetizioni + 1, seed=36)
+    dati = []
+    for i, p in enumerate(corpus):
+        calc = compute_from_payload(p)
+        dati.append({**p, **calc, "id_stima": i, "nome": "Mario", "cognome": "Rossi",
+                     "telefono": "3331234567", "email": "mario@example.invalid",
+                     "indirizzo": f"{p['via']} {p['civico']}, {p['comune']}"})
+
+    risultati = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # cartelle temporanee: ogni render è "freddo" (niente cache per hash)
+        pdf_report.REPORTS_DIR = tmp
+        pdf_report.CACHE_DIR = os.path.join(tmp, ".cache")
+        it = iter(range(len(dati)))
+
+        def render():
+            i = next(it)
+            pdf_report.genera_pdf_stima(dati[i], nome_file=f"bench_{i}.pdf")
+
+        risultati.append(misura("genera_pdf_stima", render, args.ripetizioni))
+
+        def build():
+            pdf_report._costruisci_pdf(dict(dati[0]), os.path.join(tmp, "build.pdf"))
+
+        risultati.append(misura("_costruisci_pdf", build, args.ripetizioni))
+    return risultati
+
+
+class _RispostaFinta:
+    status_code = 200
+    text = '{"ok": true}'
+
+    def json(self):
+        return {"ok": True}
+
+
+class _SessioneFinta:
+    """Al posto di main.sessione_http(): nessuna richiesta esce dalla macchina."""
+
+    def post(self, *a, **k):
+        return _RispostaFinta()
+
+    get = post
+
+
+def bench_pipeline(args) -> list[dict]:
+    import verifica_indici
+    import pdf_report
+    import main
+    from migrations import applica_migrazioni
+    from fastapi.testclient import TestClient
+
+    # integrazioni esterne sostituite: si misura solo il nostro codice + DB
+    main.invia_mail = lambda *a, **k: True
+    sessione = _SessioneFinta()
+    main.sessione_http = lambda: sessione   # invia_whatsapp, invia_whatsapp_text
+    pdf_report._upload_pdf_to_github = lambda path, nome: f"https://example.invalid/{nome}"
+
+    corpus = corpus_payload(args.ripetizioni + 1, seed=3600)
+    verifica_indici.crea_schema()
+    try:
+        applica_migrazioni()
+        it = iter(corpus)
+        with TestClient(main.app) as client:
+            def lead():
+                p = next(it)
+                r = client.post("/api/salva_stima", json={
+                    **p, "nome": "Mario", "cognome": "Rossi",
+                    "email": "mario@example.invalid", "telefono": "3331234567",
+                })
+                if r.status_code != 200:
+                    raise RuntimeError(f"salva_stima {r.status_code}: {r.text[:200]}")
+
+            return [misura("POST /api/salva_stima", lead, args.ripetizioni)]
+    finally:
+        verifica_indici.elimina_schema()
+
+
+def bench_admin(args) -> list[dict]:
+    import verifica_indici
+    import main
+    from database import get_connection
+    from migrations import applica_migrazioni
+
+    verifica_indici.crea_schema()
+    try:
+        applica_migrazioni()
+        print(f"  semina {args.righe} righe…")
+        verifica_indici.popola(args.righe)
+
+        oggi = datetime.combine(datetime.now().date(), datetime.min.time())
+        settimana = oggi - timedelta(days=7)
+        domani = oggi + timedelta(days=1)
+        query = [
+            ("admin stime (oggi)", main.SQL_ADMIN_STIME, (oggi, domani)),
+            ("admin stime (7 giorni)", main.SQL_ADMIN_STIME, (settimana, domani)),
+            ("admin stime_pro (7 giorni)", main.SQL_ADMIN_STIME_PRO, (settimana, domani)),
+            ("whatsapp inbox (oggi)",
+             main.SQL_WHATSAPP_MESSAGES.format(where="WHERE wi.received_at >= %s"), (oggi,)),
+            ("prefill (token)", main.SQL_PREFILL, (None,)),
+        ]
+
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT token FROM stime WHERE token IS NOT NULL LIMIT 1")
+        token = cur.fetchone()[0]
+
+        risultati = []
+        for nome, sql, params in query:
+            if params == (None,):
+                params = (token,)
+
+            def esegui(sql=sql, params=params):
+                cur.execute(sql, params)
+                cur.fetchall()
+
+            risultati.append(misura(nome, esegui, args.ripetizioni))
+        cur.close(); conn.close()
+        return risultati
+    finally:
+        verifica_indici.elimina_schema()
+
+
+# ---------------------------------------------------------
+# RISULTATI
+# ---------------------------------------------------------
+def _git(*cmd) -> str:
+    try:
+        return subprocess.check_output(["git", *cmd], cwd=BASE_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return ""
+
+
+def salva_risultati(risultati: dict, args) -> str:
+    os.makedirs(RISULTATI_DIR, exist_ok=True)
+    commit = _git("rev-parse", "--short", "HEAD") or "sconosciuto"
+    run = {
+        "commit": commit,
+        "modifiche_locali": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "data": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "macchina": {
+            "python": platform.python_version(),
+            "sistema": platform.platform(),
+            "cpu": os.cpu_count(),
+        },
+        "parametri": {"ripetizioni": args.ripetizioni, "corpus": args.corpus,
+                      "righe": args.righe},
+        "risultati": risultati,
+    }
+    nome = f"{datetime.now():%Y%m%d-%H%M%S}_{commit}.json"
+    path = os.path.join(RISULTATI_DIR, nome)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+    return path
+
+
+def confronta(path_nuovo: str, soglia: float) -> int:
+    """Confronta con l'ultimo run di un commit diverso; ritorna le regressioni."""
+    with open(path_nuovo, encoding="utf-8") as f:
+        nuovo = json.load(f)
+    precedenti = sorted(
+        n for n in os.listdir(RISULTATI_DIR)
+        if n.endswith(".json") and os.path.join(RISULTATI_DIR, n) != path_nuovo
+    )
+    base = None
+    for n in reversed(precedenti):
+        with open(os.path.join(RISULTATI_DIR, n), encoding="utf-8") as f:
+            run = json.load(f)
+        if run.get("commit") != nuovo["commit"]:
+            base = run
+            break
+    if base is None:
+        print("Nessun run precedente di un altro commit da confrontare.")
+        return 0
+
+    print(f"\nConfronto con {base['commit']} ({base['data']}), soglia {soglia:.0%}:")
+    regressioni = 0
+    for gruppo, voci in nuovo["risultati"].items():
+        vecchie = {v["nome"]: v for v in base["risultati"].get(gruppo, [])}
+        for v in voci:
+            b = vecchie.get(v["nome"])
+            if not b:
+                continue
+            delta = v["mediana"] / b["mediana"] - 1
+            segno = "❌" if delta > soglia else "✅"
+            if delta > soglia:
+                regressioni += 1
+            print(f"  {segno} {gruppo}/{v['nome']:<40} {delta:+7.1%}")
+    return regressioni
+
+
+if __name__ == "__main__":
+    # Prima di importare main: render nel processo corrente (l'upload finto
+    # deve valere anche lì), niente controllo schema né purge in background.
+    # Solo da script: chi importa corpus_payload (loadtest.py) non li eredita
+    os.environ.setdefault("PDF_WORKERS", "0")
+    os.environ.setdefault("SCHEMA_CHECK", "off")
+    os.environ.setdefault("PURGE_INTERVALLO", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    ap = argparse.ArgumentParser(description="Benchmark Stima360")
+    ap.add_argument("gruppi", nargs="*", metavar="gruppo",
+                    help=f"uno o più tra {', '.join(GRUPPI)} (default: tutti)")
+    ap.add_argument("--ripetizioni", type=int, default=20)
+    ap.add_argument("--corpus", type=int, default=2000,
+                    help="payload nel corpus di valuation (default 2000)")
+    ap.add_argument("--righe", type=int, default=1_000_000,
+                    help="righe seminate per le query admin (default 1M)")
+    ap.add_argument("--confronta", action="store_true",
+                    help="confronta con l'ultimo run di un altro commit")
+    ap.add_argument("--soglia", type=float, default=0.15,
+                    help="regressione tollerata sulla mediana (default 0.15)")
+    args = ap.parse_args()
+    for g in args.gruppi:
+        if g not in GRUPPI:
+            ap.error(f"gruppo sconosciuto: {g}")
+
+    risultati = {}
+    for gruppo in args.gruppi or GRUPPI:
+        print(f"[{gruppo}]")
+        risultati[gruppo] = globals()[f"bench_{gruppo}"](args)
+
+    path = salva_risultati(risultati, args)
+    print(f"\nRisultati salvati in {os.path.relpath(path, BASE_DIR)}")
+
+    if args.confronta:
+        sys.exit(1 if confronta(path, args.soglia) else 0)
@@ -0,0 +1,56 @@
+# backend/cache.py
+# Piccola cache in memoria con scadenza (TTL) e dimensione massima.
+# Thread-safe: gli endpoint sync di FastAPI girano nel threadpool.
+
+import time
+import threading
+from collections import OrderedDict
+
+# Sentinella per distinguere "non in cache" da un valore None in cache
+MANCANTE = object()
+
+
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._dati = OrderedDict()   # key -> (scadenza, valore)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MANCANTE):
+        now = time.monotonic()
+        with self._lock:
+            item = self._dati.get(key)
+            if item is None:
+                return default
+            scadenza, valore = item
+            if scadenza <= now:
+                del self._dati[key]
+                return default
+            self._dati.move_to_end(key)
+            return valore
+
+    def set(self, key, valore, ttl: float | None = None):
+        scadenza = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._dati[key] = (scadenza, valore)
+            self._dati.move_to_end(key)
+            while len(self._dati) > self.maxsize:
+                self._dati.popitem(last=False)
+
+    def invalida(self, key):
+        with self._lock:
+            self._dati.pop(key, None)
+
+    def invalida_se(self, pred):
+        """Rimuove le voci per cui pred(key, valore) è vero."""
+        with self._lock:
+            for k in [k for k, (_, v) in self._dati.items() if pred(k, v)]:
+                del self._dati[k]
+
+    def svuota(self):
+        with self._lock:
+            self._dati.clear()
+
+    def __len__(self):
+        return len(self._dati)
@@ -0,0 +1,360 @@
+# backend/comparabili.py
+# Comparabili: le stime storiche più simili a un immobile, in memoria.
+#
+# Indice per comune (i comparabili non attraversano il confine comunale):
+# per ogni comune una matrice numpy di feature già scalate, cresciuta per
+# raddoppio quando arrivano nuovi lead. La ricerca è una distanza
+# vettoriale su tutta la partizione + argpartition: con decine di migliaia
+# di righe per comune resta sotto il millisecondo, senza strutture ad albero.
+#
+# Distanza (unità = "ugualmente diverso"):
+#   - mq in scala logaritmica (±30% ≈ 1)
+#   - anno (15 anni ≈ 1)
+#   - posizione, distanza e vista mare
+#   - penalità fisse se cambia microzona o tipologia
+#
+# L'indice si carica nel warmup e si aggiorna:
+#   - subito, per i lead salvati da questo processo (aggiungi / rimuovi)
+#   - ogni COMPARABILI_REFRESH_S secondi dal DB, per quelli degli altri
+#     worker uvicorn, per le righe rivalutate (backfill_valori.py) e per le
+#     stime eliminate (thread in background). Il cursore è valutata_at, non
+#     l'id: una riga valutata dopo (backfill, salvataggio valori fallito e
+#     ripreso) entra comunque, e una rivalutata sostituisce la vecchia.
+
+import os
+import math
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+from valuation import normalize_vista_mare
+from database import get_connection
+
+logger = logging.getLogger("stima360.comparabili")
+
+COMPARABILI_K = int(os.getenv("COMPARABILI_K", "5"))
+# Secondi tra due aggiornamenti dal DB (0 = solo aggiunte locali)
+COMPARABILI_REFRESH_S = int(os.getenv("COMPARABILI_REFRESH_S", "120"))
+
+PENALITA_MICROZONA = 4.0
+PENALITA_TIPOLOGIA = 9.0
+_SCALA_MQ = math.log(1.3)
+_SCALA_ANNO = 15.0
+_SCALA_DISTANZA = math.log(3.0)
+ANNO_DEFAULT = 1985
+
+_POSIZIONE = {"frontemare": 2.0, "seconda": 1.0}
+# punto medio della fascia, in metri
+_DISTANZA = {"0-100": 50, "100-300": 200, "300-500": 400, "500-1000": 750}
+_VISTA = {"panoramica": 2.0, "parziale": 1.0, "scarsa": 0.5}
+
+
+def _np():
+    # numpy al primo uso: `import main` resta leggero (verifica_avvio.py)
+    import numpy
+    return numpy
+
+
+def _testo(v) -> str:
+    return str(v or "").strip().lower()
+
+
+def _distanza_m(dist, metri=None) -> float:
+    if metri is not None:
+        return float(metri)
+    d = _testo(dist).replace("–", "-").replace("m", "").replace(" ", "")
+    return _DISTANZA.get(d, 1500)
+
+
+def _feature(p: dict) -> list[float]:
+    """Vettore numerico (già scalato) da un payload con le chiavi del form."""
+    mq = float(p.get("mq") or 0) or 1.0
+    try:
+        anno = int(p.get("anno") or ANNO_DEFAULT)
+    except (TypeError, ValueError):
+        anno = ANNO_DEFAULT
+    vista = normalize_vista_mare(p.get("vistaMareYN"), p.get("vistaMareDettaglio"), p.get("vistaMare"))
+    return [
+        math.log(mq) / _SCALA_MQ,
+        anno / _SCALA_ANNO,
+        _POSIZIONE.get(_testo(p.get("posizioneMare")), 0.0),
+        math.log1p(_distanza_m(p.get("distanzaMare"), p.get("distanzaMareM"))) / _SCALA_DISTANZA,
+        _VISTA.get(vista, 0.0),
+    ]
+
+
+N_FEATURE = 5
+
+
+# ---------------------------------------------------------
+# PARTIZIONE (un comune)
+# ---------------------------------------------------------
+class _Partizione:
+    def __init__(self):
+        np = _np()
+        self.n = 0
+        self.X = np.empty((64, N_FEATURE), dtype=np.float32)
+        self.prezzi = np.empty(64, dtype=np.float32)
+        self.microzone = np.empty(64, dtype=np.int32)
+        self.tipologie = np.empty(64, dtype=np.int32)
+        self.attive = np.zeros(64, dtype=bool)
+        self.ids = np.empty(64, dtype=np.int64)
+        self.righe = []       # dati da restituire (niente dati personali)
+
+    def _cresci(self):
+        np = _np()
+        cap = len(self.prezzi) * 2
+        for nome in ("X", "prezzi", "microzone", "tipologie", "attive", "ids"):
+            vecchio = getattr(self, nome)
+            nuovo = np.zeros((cap,) + vecchio.shape[1:], dtype=vecchio.dtype)
+            nuovo[: self.n] = vecchio[: self.n]
+            setattr(self, nome, nuovo)
+
+    def aggiungi(self, sid, feature, prezzo, microzona, tipologia, riga) -> int:
+        if self.n == len(self.prezzi):
+            self._cresci()
+        i = self.n
+        self.X[i] = feature
+        self.prezzi[i] = prezzo
+        self.microzone[i] = microzona
+        self.tipologie[i] = tipologia
+        self.ids[i] = sid
+        self.attive[i] = True
+        self.righe.append(riga)
+        self.n += 1
+        return i
+
+    def cerca(self, q, microzona: int, tipologia: int, k: int, escludi=None):
+        np = _np()
+        n = self.n
+        if n == 0:
+            return []
+        d = ((self.X[:n] - q) ** 2).sum(axis=1)
+        d += PENALITA_MICROZONA * (self.microzone[:n] != microzona)
+        d += PENALITA_TIPOLOGIA * (self.tipologie[:n] != tipologia)
+        d[~self.attive[:n]] = np.inf
+        if escludi is not None:
+            d[self.ids[:n] == escludi] = np.inf
+        # qualche candidato in più per scartare i duplicati (stesso immobile)
+        m = min(n, k * 3)
+        idx = np.argpartition(d, m - 1)[:m] if m < n else np.arange(n)
+        idx = idx[np.argsort(d[idx], kind="stable")]
+        return [(int(i), float(d[i])) for i in idx if np.isfinite(d[i])]
+
+
+# ---------------------------------------------------------
+# INDICE
+# ---------------------------------------------------------
+class IndiceComparabili:
+    def __init__(self):
+        self._partizioni = {}      # comune normalizzato -> _Partizione
+        self._posizione = {}       # id stima -> (comune, indice riga)
+        self._codici = {}          # testo normalizzato -> int (microzone, tipologie)
+        self._lock = threading.Lock()
+        # (valutata_at, id) dell'ultima riga letta dal DB
+        self.ultima_valutazione = (datetime(1970, 1, 1, tzinfo=timezone.utc), 0)
+        self.ultimo_refresh = None  # NOW() del DB all'ultimo controllo eliminate
+        self.caricato = False
+
+    def _codice(self, testo, nuovo: bool = True) -> int:
+        # nelle ricerche un testo mai visto non entra nel dizionario (-1)
+        t = _testo(testo)
+        if t not in self._codici:
+            if not nuovo:
+                return -1
+            self._codici[t] = len(self._codici)
+        return self._codici[t]
+
+    def __len__(self):
+        return len(self._posizione)
+
+    def aggiungi(self, sid: int, payload: dict, eur_mq: float, sostituisci: bool = False) -> bool:
+        """
+        Aggiunge una stima valutata; False se già presente o senza dati utili.
+        Con `sostituisci` una stima già presente ma cambiata (rivalutata,
+        microzona corretta) prende il posto della vecchia.
+        """
+        if not eur_mq or not payload.get("mq") or not payload.get("comune"):
+            return False
+        riga = {
+            "comune": payload.get("comune"),
+            "microzona": payload.get("microzona"),
+            "tipologia": payload.get("tipologia"),
+            "mq": payload.get("mq"),
+            "anno": payload.get("anno"),
+            "posizioneMare": payload.get("posizioneMare"),
+            "eur_mq": round(float(eur_mq), 2),
+        }
+        feature = _feature(payload)
+        with self._lock:
+            vecchia = self._posizione.get(sid)
+            if vecchia is not None:
+                part = self._partizioni[vecchia[0]]
+                if not sostituisci or part.righe[vecchia[1]] == riga:
+                    return False
+                part.attive[vecchia[1]] = False
+            comune = _testo(payload["comune"])
+            part = self._partizioni.get(comune)
+            if part is None:
+                part = self._partizioni[comune] = _Partizione()
+            i = part.aggiungi(sid, feature, float(eur_mq),
+                              self._codice(payload.get("microzona")),
+                              self._codice(payload.get("tipologia")), riga)
+            self._posizione[sid] = (comune, i)
+        # ultima_valutazione la fa avanzare solo aggiorna(): i lead appena
+        # salvati qui non devono far saltare quelli degli altri worker
+        return True
+
+    def rimuovi(self, ids) -> int:
+        n = 0
+        with self._lock:
+            for sid in ids:
+                pos = self._posizione.get(sid)
+                if pos is not None:
+                    comune, i = pos
+                    part = self._partizioni[comune]
+                    if part.attive[i]:
+                        part.attive[i] = False
+                        n += 1
+        return n
+
+    def cerca(self, payload: dict, k: int = COMPARABILI_K, escludi: int | None = None) -> list[dict]:
+        """Le k stime più simili (dal più vicino), un solo risultato per immobile."""
+        np = _np()
+        part = self._partizioni.get(_testo(payload.get("comune")))
+        if part is None or not payload.get("mq"):
+            return []
+        q = np.asarray(_feature(payload), dtype=np.float32)
+        with self._lock:
+            trovati = part.cerca(q, self._codice(payload.get("microzona"), nuovo=False),
+                                 self._codice(payload.get("tipologia"), nuovo=False), k, escludi)
+            risultati, visti = [], set()
+            for i, dist in trovati:
+                riga = part.righe[i]
+                chiave = (riga["microzona"], riga["tipologia"], riga["mq"], riga["anno"], riga["eur_mq"])
+                if chiave in visti:
+                    continue
+                visti.add(chiave)
+                risultati.append({**riga, "distanza": round(dist, 3)})
+                if len(risultati) == k:
+                    break
+        return risultati
+
+
+_indice = IndiceComparabili()
+
+
+def cerca(payload: dict, k: int = COMPARABILI_K, escludi: int | None = None) -> list[dict]:
+    return _indice.cerca(payload, k, escludi)
+
+
+def aggiungi(sid: int, payload: dict, eur_mq: float) -> bool:
+    return _indice.aggiungi(sid, payload, eur_mq)
+
+
+def rimuovi(ids) -> int:
+    return _indice.rimuovi(ids)
+
+
+def indicizzate() -> int:
+    return len(_indice)
+
+
+# ---------------------------------------------------------
+# CARICAMENTO DAL DB
+# ---------------------------------------------------------
+# Righe valutate dopo il cursore (valutata_at, id). Quelle valutate da meno
+# di un minuto aspettano il giro successivo: una transazione ancora aperta
+# potrebbe committare una valutata_at già superata dal cursore.
+SQL_NUOVE = """
+    SELECT id, comune, microzona, tipologia, mq, anno,
+           posizionemare, distanzamare, distanza_mare_m,
+           vistamareyn, vistamaredettaglio, vistamare, eur_mq_finale, valutata_at
+    FROM stime
+    WHERE (valutata_at, id) > (%s, %s)
+      AND valutata_at < NOW() - INTERVAL '1 minute'
+      AND deleted_at IS NULL
+      AND eur_mq_finale IS NOT NULL
+      AND mq > 0
+    ORDER BY valutata_at, id
+    LIMIT %s
+"""
+SQL_ELIMINATE = """
+    SELECT id FROM stime
+    WHERE deleted_at IS NOT NULL AND deleted_at >= %s
+"""
+BLOCCO = 5000
+
+
+def aggiorna() -> dict:
+    """Carica le stime valutate dall'ultimo giro e toglie quelle eliminate."""
+    t0 = time.perf_counter()
+    esito = {"aggiunte": 0, "rimosse": 0}
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT NOW()")
+        adesso = cur.fetchone()[0]
+        while True:
+            cur.execute(SQL_NUOVE, (*_indice.ultima_valutazione, BLOCCO))
+            righe = cur.fetchall()
+            for (sid, comune, microzona, tipologia, mq, anno,
+                 pos, dist, metri, vista_yn, vista_det, vista, eur_mq, _valutata) in righe:
+                esito["aggiunte"] += _indice.aggiungi(sid, {
+                    "comune": comune, "microzona": microzona, "tipologia": tipologia,
+                    "mq": mq, "anno": anno, "posizioneMare": pos, "distanzaMare": dist,
+                    "distanzaMareM": metri,
+                    "vistaMareYN": vista_yn, "vistaMareDettaglio": vista_det, "vistaMare": vista,
+                }, float(eur_mq), sostituisci=True)
+            if righe:
+                # anche le righe scartate (già presenti) fanno avanzare il cursore
+                _indice.ultima_valutazione = (righe[-1][-1], righe[-1][0])
+            if len(righe) < BLOCCO:
+                break
+        if _indice.ultimo_refresh is not None:
+            cur.execute(SQL_ELIMINATE, (_indice.ultimo_refresh,))
+            esito["rimosse"] = _indice.rimuovi([r[0] for r in cur.fetchall()])
+        _indice.ultimo_refresh = adesso
+        conn.commit()
+    finally:
+        cur.close(); conn.close()
+    _indice.caricato = True
+    if esito["aggiunte"] or esito["rimosse"]:
+        logger.info("comparabili aggiornati", extra={
+            **esito, "indicizzate": len(_indice),
+            "durata_ms": round((time.perf_counter() - t0) * 1000, 1),
+        })
+    return esito
+
+
+# ---------------------------------------------------------
+# THREAD IN BACKGROUND
+# ---------------------------------------------------------
+_stop = threading.Event()
+_thread = None
+
+
+def _ciclo():
+    while not _stop.wait(COMPARABILI_REFRESH_S):
+        try:
+            aggiorna()
+        except Exception:
+            logger.exception("aggiornamento comparabili fallito")
+
+
+def avvia():
+    global _thread
+    if COMPARABILI_REFRESH_S <= 0 or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_ciclo, name="comparabili", daemon=True)
+    _thread.start()
+
+
+def chiudi():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=10)
+        _thread = None
@@ -0,0 +1,285 @@
+# backend/costa.py
+# Distanza dal mare in metri, dalla linea di costa (al posto delle fasce
+# "0-100", "100-300"… scelte a mano nel form).
+#
+# Sorgente: un GeoJSON locale (GEO_COSTA) con la linea di costa della
+# zona coperta, LineString/MultiLineString in lon/lat (es. natural=coastline
+# da un estratto OSM). Senza file la distanza è None e valgono le fasce
+# del form come prima.
+#
+# Calcolo: coordinate proiettate in metri su un piano locale
+# (equirettangolare centrato sulla costa: su poche decine di km l'errore
+# è sotto il per mille), distanza punto-segmento esatta.
+# Indice a griglia (celle da COSTA_CELLA_M): per ogni cella i soli
+# segmenti che possono essere i più vicini a un punto della cella
+# (distanza dal centro ≤ minima + semidiagonale, per la disuguaglianza
+# triangolare). Le celle entro COSTA_MARGINE_M dalla costa si preparano al
+# caricamento, le altre al primo uso. Le distanze per array di punti
+# (backfill) sono vettoriali, raggruppando i punti per cella.
+#
+# Backfill sulle stime storiche con coordinate (geocoder.py):
+#   python costa.py --backfill            # solo righe senza distanza
+#   python costa.py --backfill --tutte
+# Riempie distanza_mare_m e, dove manca, la fascia in distanzamare.
+
+import os
+import json
+import math
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger("stima360.costa")
+
+BASE_DIR = Path(__file__).resolve().parent
+GEO_COSTA = Path(os.getenv("GEO_COSTA", BASE_DIR / "dati" / "costa.geojson"))
+COSTA_CELLA_M = float(os.getenv("COSTA_CELLA_M", "250"))
+COSTA_MARGINE_M = float(os.getenv("COSTA_MARGINE_M", "3000"))
+
+_R_TERRA = 6371008.8
+
+# Fasce storiche del form (estremo superiore in metri → etichetta)
+FASCE = ((100, "0-100"), (300, "100-300"), (500, "300-500"), (1000, "500-1000"))
+
+
+def _np():
+    # numpy al primo uso: `import main` resta leggero (verifica_avvio.py)
+    import numpy
+    return numpy
+
+
+def fascia(metri: float | None) -> str | None:
+    """Etichetta della fascia del form per una distanza in metri (">1000" oltre)."""
+    if metri is None or metri != metri:
+        return None
+    for limite, etichetta in FASCE:
+        if metri <= limite:
+            return etichetta
+    return ">1000"
+
+
+# ---------------------------------------------------------
+# INDICE
+# ---------------------------------------------------------
+class Costa:
+    def __init__(self, linee: list):
+        np = _np()
+        lat0 = sum(p[1] for l in linee for p in l) / sum(len(l) for l in linee)
+        lon0 = sum(p[0] for l in linee for p in l) / sum(len(l) for l in linee)
+        self.lat0, self.lon0 = lat0, lon0
+        self.kx = math.radians(1) * _R_TERRA * math.cos(math.radians(lat0))
+        self.ky = math.radians(1) * _R_TERRA
+
+        ax, ay, bx, by = [], [], [], []
+        for linea in linee:
+            x, y = self.proietta(np.array([p[1] for p in linea]), np.array([p[0] for p in linea]))
+            ax.append(x[:-1]); ay.append(y[:-1]); bx.append(x[1:]); by.append(y[1:])
+        self.ax, self.ay = np.concatenate(ax), np.concatenate(ay)
+        self.bx, self.by = np.concatenate(bx), np.concatenate(by)
+        self.dx, self.dy = self.bx - self.ax, self.by - self.ay
+        self.l2 = np.maximum(self.dx * self.dx + self.dy * self.dy, 1e-9)
+
+        self._celle = {}
+        self._lock = threading.Lock()
+        self._prepara()
+
+    def __len__(self):
+        return len(self.ax)
+
+    def proietta(self, lat, lon):
+        return (lon - self.lon0) * self.kx, (lat - self.lat0) * self.ky
+
+    def _distanze(self, x, y, idx=None):
+        """Matrice punti × segmenti (idx = sottoinsieme di segmenti)."""
+        np = _np()
+        if idx is None:
+            idx = slice(None)
+        x = np.asarray(x, dtype=float)[:, None]
+        y = np.asarray(y, dtype=float)[:, None]
+        ax, ay, dx, dy = self.ax[idx], self.ay[idx], self.dx[idx], self.dy[idx]
+        t = np.clip(((x - ax) * dx + (y - ay) * dy) / self.l2[idx], 0.0, 1.0)
+        return np.hypot(x - (ax + t * dx), y - (ay + t * dy))
+
+    def _cella(self, cx: int, cy: int):
+        """Segmenti candidati per la cella (cx, cy)."""
+        c = self._celle.get((cx, cy))
+        if c is None:
+            c = self._candidati(self._distanze([(cx + 0.5) * COSTA_CELLA_M],
+                                               [(cy + 0.5) * COSTA_CELLA_M])[0])
+            with self._lock:
+                self._celle[(cx, cy)] = c
+        return c
+
+    @staticmethod
+    def _candidati(d):
+        # d(p) ≤ d(centro) + r per ogni punto p della cella (r = semidiagonale),
+        # e un segmento oltre min + 2r dal centro non può essere il più vicino
+        return _np().flatnonzero(d <= d.min() + COSTA_CELLA_M * math.sqrt(2))
+
+    def _prepara(self):
+        x0 = min(self.ax.min(), self.bx.min()) - COSTA_MARGINE_M
+        x1 = max(self.ax.max(), self.bx.max()) + COSTA_MARGINE_M
+        y0 = min(self.ay.min(), self.by.min()) - COSTA_MARGINE_M
+        y1 = max(self.ay.max(), self.by.max()) + COSTA_MARGINE_M
+        for cx in range(math.floor(x0 / COSTA_CELLA_M), math.floor(x1 / COSTA_CELLA_M) + 1):
+            for cy in range(math.floor(y0 / COSTA_CELLA_M), math.floor(y1 / COSTA_CELLA_M) + 1):
+                # solo le celle vicine alla costa (il bbox può essere molto più largo)
+                d = self._distanze([(cx + 0.5) * COSTA_CELLA_M], [(cy + 0.5) * COSTA_CELLA_M])[0]
+                if d.min() <= COSTA_MARGINE_M:
+                    self._celle[(cx, cy)] = self._candidati(d)
+
+    def distanza(self, lat: float, lon: float) -> float:
+        x, y = self.proietta(float(lat), float(lon))
+        idx = self._cella(math.floor(x / COSTA_CELLA_M), math.floor(y / COSTA_CELLA_M))
+        return float(self._distanze([x], [y], idx)[0].min())
+
+    def distanze(self, lat, lon):
+        np = _np()
+        x, y = self.proietta(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+        risultato = np.full(x.shape, np.nan)
+        validi = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+        if not len(validi):
+            return risultato
+        celle = np.stack([np.floor(x[validi] / COSTA_CELLA_M),
+                          np.floor(y[validi] / COSTA_CELLA_M)], axis=1).astype(np.int64)
+        uniche, gruppo = np.unique(celle, axis=0, return_inverse=True)
+        gruppo = gruppo.ravel()
+        # candidati per cella in una matrice (righe riempite ripetendo il
+        # primo segmento), poi un solo calcolo punti × candidati
+        liste = [self._cella(int(cx), int(cy)) for cx, cy in uniche]
+        m = max(len(l) for l in liste)
+        candidati = np.array([np.pad(l, (0, m - len(l)), mode="edge") for l in liste])
+        passo = max(1, 4_000_000 // m)
+        for i in range(0, len(validi), passo):
+            sel = validi[i:i + passo]
+            idx = candidati[gruppo[i:i + passo]]
+            px, py = x[sel][:, None], y[sel][:, None]
+            ax, ay, dx, dy = self.ax[idx], self.ay[idx], self.dx[idx], self.dy[idx]
+            t = np.clip(((px - ax) * dx + (py - ay) * dy) / self.l2[idx], 0.0, 1.0)
+            risultato[sel] = np.hypot(px - (ax + t * dx), py - (ay + t * dy)).min(axis=1)
+        return risultato
+
+
+_costa: Costa | None = None
+
+
+def _linee(g: dict) -> list:
+    tipo, coord = g.get("type"), g.get("coordinates") or []
+    if tipo == "LineString":
+        return [coord]
+    if tipo in ("MultiLineString", "Polygon"):
+        return list(coord)
+    if tipo == "MultiPolygon":
+        return [anello for poligono in coord for anello in poligono]
+    return []
+
+
+def carica(percorso: Path | str | None = None) -> int:
+    """Legge la linea di costa e prepara l'indice; restituisce i segmenti."""
+    global _costa
+    percorso = Path(percorso or GEO_COSTA)
+    if not percorso.exists():
+        logger.info("linea di costa assente: distanze dal form", extra={"percorso": str(percorso)})
+        return 0
+    with open(percorso, encoding="utf-8") as f:
+        dati = json.load(f)
+    geometrie = [f.get("geometry") or {} for f in dati.get("features", [])] \
+        if dati.get("type") == "FeatureCollection" else [dati.get("geometry", dati)]
+    linee = [l for g in geometrie for l in _linee(g) if len(l) >= 2]
+    if not linee:
+        logger.warning("linea di costa vuota", extra={"percorso": str(percorso)})
+        return 0
+    costa = Costa(linee)
+    _costa = costa
+    logger.info("linea di costa caricata", extra={"segmenti": len(costa), "celle": len(costa._celle)})
+    return len(costa)
+
+
+def disponibile() -> bool:
+    return _costa is not None
+
+
+def distanza_m(lat: float | None, lon: float | None) -> float | None:
+    """Metri dalla linea di costa (None senza costa o senza coordinate)."""
+    if _costa is None or lat is None or lon is None:
+        return None
+    return round(_costa.distanza(lat, lon), 1)
+
+
+def distanze_m(lat, lon):
+    """Come distanza_m su array numpy di punti; NaN dove manca il dato."""
+    np = _np()
+    if _costa is None:
+        return np.full(np.shape(lat), np.nan)
+    return np.round(_costa.distanze(lat, lon), 1)
+
+
+# ---------------------------------------------------------
+# BACKFILL SULLE STIME STORICHE
+# ---------------------------------------------------------
+def backfill(batch: int = 2000, tutte: bool = False) -> int:
+    """distanza_mare_m (e la fascia se vuota) per le stime con coordinate."""
+    np = _np()
+    from psycopg2.extras import execute_values
+    from database import get_connection
+
+    if _costa is None and not carica():
+        raise RuntimeError(f"linea di costa assente ({GEO_COSTA})")
+    filtro = "" if tutte else "AND distanza_mare_m IS NULL"
+    ultimo_id, totale = 0, 0
+
+    conn = get_connection()
+    try:
+        while True:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT id, lat, lon FROM stime
+                WHERE id > %s AND lat IS NOT NULL AND lon IS NOT NULL {filtro}
+                ORDER BY id
+                LIMIT %s
+            """, (ultimo_id, batch))
+            rows = cur.fetchall()
+            if not rows:
+                cur.close()
+                break
+
+            ids = [r[0] for r in rows]
+            metri = distanze_m(np.array([r[1] for r in rows], dtype=float),
+                               np.array([r[2] for r in rows], dtype=float))
+            valori = [(i, float(m), fascia(float(m))) for i, m in zip(ids, metri) if m == m]
+            execute_values(cur, """
+                UPDATE stime AS s SET
+                  distanza_mare_m = v.metri,
+                  distanzamare = COALESCE(NULLIF(s.distanzamare, ''), v.fascia)
+                FROM (VALUES %s) AS v(id, metri, fascia)
+                WHERE s.id = v.id
+            """, valori, template="(%s::int, %s::float8, %s)", page_size=batch)
+            conn.commit()
+            cur.close()
+
+            ultimo_id = ids[-1]
+            totale += len(valori)
+            print(f"🌊 Distanze calcolate: {totale} (ultimo id {ultimo_id})")
+    finally:
+        conn.close()
+    return totale
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Distanza dalla linea di costa")
+    ap.add_argument("--backfill", action="store_true", help="distanze per le stime storiche")
+    ap.add_argument("--tutte", action="store_true", help="ricalcola anche le righe già fatte")
+    ap.add_argument("--batch", type=int, default=2000)
+    ap.add_argument("--punto", nargs=2, type=float, metavar=("LAT", "LON"), help="prova un punto")
+    args = ap.parse_args()
+
+    print(f"segmenti: {carica()}")
+    if args.punto:
+        m = distanza_m(*args.punto)
+        print(f"{m} m ({fascia(m)})")
+    elif args.backfill:
+        print(f"righe aggiornate: {backfill(args.batch, args.tutte)}")
+    else:
+        ap.print_help()
@@ -1,4 +0,0 @@
-from database import crea_tabella_stime
-
-crea_tabella_stime()
-print("Tabella creata!")
@@ -1,4 +0,0 @@
-from database import crea_tabella_stime_dettagliate
-
-crea_tabella_stime_dettagliate()
-print("Tabella dettagliata creata!")
@@ -4,268 +4,246 @@ BASE_DIR = os.path.dirname(__file__)
 REPORTS_DIR = os.path.join(BASE_DIR, "reports")
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
-import psycopg2
+import time
+import logging
+import threading
+
 from dotenv import load_dotenv
 
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from pathlib import Path
-import smtplib
-import ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
+import tracing
+import metrics
 
 # Carica variabili ambiente
 load_dotenv()
 
+logger = logging.getLogger("stima360.db")
+
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-def get_connection():
+# ------------------- POOL CONNESSIONI -------------------
+# Le connessioni si riusano: close() le restituisce al pool (rollback se
+# c'è una transazione aperta), quindi il codice esistente non cambia.
+# Il pool non limita le connessioni contemporanee: tiene solo quelle
+# inattive, fino a DB_POOL_MAX; DB_POOL_MIN vengono aperte nel warmup.
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))     # 0 = nessun pool
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+# Connessioni inattive da più di N secondi si chiudono invece di riusarle
+DB_POOL_IDLE_S = float(os.getenv("DB_POOL_IDLE_S", "300"))
+# Oltre N secondi di inattività un SELECT 1 prima di riusarla: dopo un
+# riavvio o un failover di Postgres i socket nel pool sono morti senza
+# che conn.closed lo sappia (0 = controlla sempre)
+DB_POOL_CHECK_S = float(os.getenv("DB_POOL_CHECK_S", "5"))
+
+
+def _connetti(connection_factory=None):
+    # import al primo uso (o nel warmup di main.py): non pesa sull'avvio
+    import psycopg2
     return psycopg2.connect(
         host=DB_HOST,
         port=DB_PORT,
         dbname=DB_NAME,
         user=DB_USER,
-        password=DB_PASSWORD
+        password=DB_PASSWORD,
+        # uno span per query quando il tracing è attivo
+        cursor_factory=tracing.CursoreTracciato,
+        connection_factory=connection_factory,
     )
 
 
-# ------------------- TABELLE VALORI -------------------
-def crea_tabella_zone_valori():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS zone_valori (
-            id SERIAL PRIMARY KEY,
-            comune VARCHAR(100) NOT NULL,
-            microzona VARCHAR(100) NOT NULL,
-            prezzo_mq_base NUMERIC(10,2) NOT NULL,
-            CONSTRAINT zone_valori_unq UNIQUE (comune, microzona)
-        );
-        CREATE INDEX IF NOT EXISTS idx_zone_valori_cm ON zone_valori(comune, microzona);
-    """)
-    cur.executemany("""
-        INSERT INTO zone_valori (comune, microzona, prezzo_mq_base)
-        VALUES (%s,%s,%s)
-        ON CONFLICT (comune, microzona) DO UPDATE
-        SET prezzo_mq_base = EXCLUDED.prezzo_mq_base
-    """, [
-        ("Alba Adriatica", "Nord", 1250),
-        ("Alba Adriatica", "Villa Fiore", 1350),
-        ("Alba Adriatica", "Zona Basciani", 1200),
-
-        ("Tortoreto", "Lido Sud", 1450),
-        ("Tortoreto", "Lido Centro", 1650),
-        ("Tortoreto", "Lido Nord", 1500),
-        ("Tortoreto", "Alto", 1100),
-
-        ("Martinsicuro", "Centro", 1000),
-        ("Martinsicuro", "Villarosa", 900),
-        ("Martinsicuro", "Alta", 850),
-    ])
-    conn.commit()
-    cur.close(); conn.close()
-
-
-# ------------------- MIGRAZIONI -------------------
-def migrazione_allinea_stime():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE stime
-          ADD COLUMN IF NOT EXISTS microzona       VARCHAR(100),
-          ADD COLUMN IF NOT EXISTS fascia_mare     VARCHAR(32),
-          ADD COLUMN IF NOT EXISTS prezzo_mq_base  NUMERIC(10,2),
-          ADD COLUMN IF NOT EXISTS token           UUID,
-          ADD COLUMN IF NOT EXISTS token_expires   TIMESTAMPTZ;
-        CREATE INDEX IF NOT EXISTS idx_stime_token ON stime(token);
-    """)
-    conn.commit()
-    cur.close(); conn.close()
-
-
-def migrazione_gestionale_stime():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE stime
-          ADD COLUMN IF NOT EXISTS lead_status   VARCHAR(32) DEFAULT 'nuovo',
-          ADD COLUMN IF NOT EXISTS note_internal TEXT;
+_classe = None
 
-        CREATE INDEX IF NOT EXISTS idx_stime_data ON stime(data);
-    """)
-    conn.commit()
-    cur.close(); conn.close()
 
+def _classe_connessione():
+    global _classe
+    if _classe is None:
+        import psycopg2.extensions
 
-def migrazione_stime_completa():
-    """Aggiunge TUTTI i parametri della stima base nel DB."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE stime
-          ADD COLUMN IF NOT EXISTS microzona       VARCHAR(100),
-
-          ADD COLUMN IF NOT EXISTS posizioneMare   VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS distanzaMare    VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS barrieraMare    VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS vistaMareYN     VARCHAR(10),
-          ADD COLUMN IF NOT EXISTS vistaMare       VARCHAR(50),
-
-          ADD COLUMN IF NOT EXISTS stato           VARCHAR(40),
-          ADD COLUMN IF NOT EXISTS anno            INTEGER,
-
-          ADD COLUMN IF NOT EXISTS mqGiardino      INTEGER,
-          ADD COLUMN IF NOT EXISTS mqGarage        INTEGER,
-          ADD COLUMN IF NOT EXISTS mqCantina       INTEGER,
-          ADD COLUMN IF NOT EXISTS mqPostoAuto     INTEGER,
-          ADD COLUMN IF NOT EXISTS mqTaverna       INTEGER,
-          ADD COLUMN IF NOT EXISTS mqSoffitta      INTEGER,
-          ADD COLUMN IF NOT EXISTS mqTerrazzo      INTEGER,
-          ADD COLUMN IF NOT EXISTS numBalconi      INTEGER,
-
-          ADD COLUMN IF NOT EXISTS altroDescrizione TEXT;
-    """)
-    conn.commit()
-    cur.close(); conn.close()
-
-
-# ------------------- CREAZIONE TABELLE -------------------
-def crea_tabella_stime():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS stime (
-            id SERIAL PRIMARY KEY,
-            comune VARCHAR(100),
-            via VARCHAR(100),
-            civico VARCHAR(20),
-            tipologia VARCHAR(50),
-            mq INTEGER,
-            piano VARCHAR(30),
-            locali INTEGER,
-            bagni INTEGER,
-            pertinenze VARCHAR(200),
-            ascensore VARCHAR(10),
-            nome VARCHAR(50),
-            cognome VARCHAR(50),
-            email VARCHAR(100),
-            telefono VARCHAR(30),
-
-            -- nuovi campi aggiunti con migrazione_stime_completa
-            microzona VARCHAR(100),
-
-            posizioneMare VARCHAR(50),
-            distanzaMare VARCHAR(50),
-            barrieraMare VARCHAR(50),
-            vistaMareYN VARCHAR(10),
-            vistaMare VARCHAR(50),
-
-            stato VARCHAR(40),
-            anno INTEGER,
-
-            mqGiardino INTEGER,
-            mqGarage INTEGER,
-            mqCantina INTEGER,
-            mqPostoAuto INTEGER,
-            mqTaverna INTEGER,
-            mqSoffitta INTEGER,
-            mqTerrazzo INTEGER,
-            numBalconi INTEGER,
-
-            altroDescrizione TEXT,
-
-            data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+        class ConnessionePool(psycopg2.extensions.connection):
+            """close() restituisce la connessione al pool invece di chiuderla."""
 
+            def close(self):
+                if not _pool.restituisci(self):
+                    super().close()
+
+            def chiudi_davvero(self):
+                super().close()
+
+        _classe = ConnessionePool
+    return _classe
+
+
+class PoolConnessioni:
+    def __init__(self, massimo: int):
+        self.massimo = massimo
+        self._libere = []          # (istante di rilascio, connessione), LIFO
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _dopo_fork(self):
+        # un processo figlio non deve usare le connessioni del padre
+        if self._pid != os.getpid():
+            self._libere = []
+            self._pid = os.getpid()
+
+    def prendi(self):
+        while True:
+            with self._lock:
+                self._dopo_fork()
+                if not self._libere:
+                    break
+                rilascio, conn = self._libere.pop()
+            inattiva = time.monotonic() - rilascio
+            if not conn.closed and inattiva <= DB_POOL_IDLE_S:
+                if inattiva < DB_POOL_CHECK_S or self._viva(conn):
+                    return conn
+            conn.chiudi_davvero()
+        return _connetti(_classe_connessione())
+
+    @staticmethod
+    def _viva(conn) -> bool:
+        import psycopg2.extensions
+
+        try:
+            # cursore semplice: il controllo non è una query da tracciare
+            cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            logger.info("connessione del pool non più valida, scartata")
+            return False
+
+    def restituisci(self, conn) -> bool:
+        """False se la connessione va chiusa davvero (rotta o pool pieno)."""
+        import psycopg2.extensions
+
+        if conn.closed or self._pid != os.getpid():
+            return False
+        try:
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except Exception:
+            return False
+        with self._lock:
+            if len(self._libere) >= self.massimo:
+                return False
+            self._libere.append((time.monotonic(), conn))
+        return True
+
+    def apri(self, n: int):
+        """Apre n connessioni in anticipo (warmup)."""
+        conns = [self.prendi() for _ in range(max(0, min(n, self.massimo)))]
+        for c in conns:
+            c.close()
+
+    def chiudi(self):
+        with self._lock:
+            libere, self._libere = self._libere, []
+        for _, conn in libere:
+            try:
+                conn.chiudi_davvero()
+            except Exception:
+                pass
+
+    def libere(self) -> int:
+        return len(self._libere)
+
+
+_pool = PoolConnessioni(DB_POOL_MAX)
+
+metrics.Gauge(
+    "stima360_db_pool_idle",
+    "Connessioni DB inattive nel pool",
+    funzione=lambda: _pool.libere(),
+)
+
+
+def get_connection():
+    if DB_POOL_MAX <= 0:
+        return _connetti()
+    return _pool.prendi()
+
+
+def apri_pool(n: int = DB_POOL_MIN):
+    if DB_POOL_MAX > 0:
+        _pool.apri(n)
+
+
+def chiudi_pool():
+    _pool.chiudi()
 
-def crea_tabella_stime_dettagliate():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS stime_dettagliate (
-            id SERIAL PRIMARY KEY,
-            stima_id INTEGER REFERENCES stime(id),
-
-   
-            classe VARCHAR(8),
-            riscaldamento VARCHAR(32),
-            condizionatore VARCHAR(8),
-            spese_cond INTEGER,
-            condiz_tipo VARCHAR(50),
-            esposizione VARCHAR(16),
-            arredo VARCHAR(32),
-            note TEXT,
-            contatto VARCHAR(8),
-            sopralluogo TIMESTAMP,
-
-            data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def migrazione_stime_dettagliate_completa():
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE stime_dettagliate
-          ADD COLUMN IF NOT EXISTS nome VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS cognome VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS email VARCHAR(100),
-          ADD COLUMN IF NOT EXISTS telefono VARCHAR(30),
-
-          ADD COLUMN IF NOT EXISTS indirizzo TEXT,
-          ADD COLUMN IF NOT EXISTS tipologia VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS mq INTEGER,
-          ADD COLUMN IF NOT EXISTS piano VARCHAR(30),
-          ADD COLUMN IF NOT EXISTS locali VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS bagni INTEGER,
-          ADD COLUMN IF NOT EXISTS ascensore VARCHAR(10),
-
-          ADD COLUMN IF NOT EXISTS stato VARCHAR(40),
-          ADD COLUMN IF NOT EXISTS anno INTEGER,
-
-          ADD COLUMN IF NOT EXISTS microzona VARCHAR(100),
-          ADD COLUMN IF NOT EXISTS posizioneMare VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS distanzaMare VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS barrieraMare VARCHAR(50),
-          ADD COLUMN IF NOT EXISTS vistaMare VARCHAR(80),
-          ADD COLUMN IF NOT EXISTS mqGiardino INTEGER,
-          ADD COLUMN IF NOT EXISTS mqGarage INTEGER,
-          ADD COLUMN IF NOT EXISTS mqCantina INTEGER,
-          ADD COLUMN IF NOT EXISTS mqPostoAuto INTEGER,
-          ADD COLUMN IF NOT EXISTS mqTaverna INTEGER,
-          ADD COLUMN IF NOT EXISTS mqSoffitta INTEGER,
-          ADD COLUMN IF NOT EXISTS mqTerrazzo INTEGER,
-          ADD COLUMN IF NOT EXISTS numBalconi INTEGER,
-          ADD COLUMN IF NOT EXISTS altroDescrizione TEXT,
-          ADD COLUMN IF NOT EXISTS pertinenze VARCHAR(200);
-    """)
-    conn.commit()
-    cur.close(); conn.close()
 # ------------------- EMAIL -------------------
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "20"))
+
+
+def _config_smtp():
+    return (
+        os.getenv("SMTP_HOST", "mail.stima360.it"),
+        int(os.getenv("SMTP_PORT", "587")),
+        os.getenv("SMTP_USER"),
+        os.getenv("SMTP_PASS"),
+    )
+
+
+def _apri_smtp():
+    """Connessione SMTP autenticata (EHLO, STARTTLS, LOGIN)."""
+    import smtplib
+
+    smtp_host, smtp_port, smtp_user, smtp_pass = _config_smtp()
+    # SMTP_STARTTLS=0 solo per server locali di test (sink senza TLS)
+    smtp_starttls = os.getenv("SMTP_STARTTLS", "1").lower() not in ("0", "false", "no")
+
+    server = smtplib.SMTP(smtp_host, smtp_port, timeout=SMTP_TIMEOUT)
+    try:
+        server.ehlo()
+        if smtp_starttls:
+            server.starttls()
+        server.login(smtp_user, smtp_pass)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def verifica_smtp() -> bool:
+    """
+    Apre e chiude una sessione SMTP (warmup): DNS, TLS e credenziali
+    vengono verificati prima del primo lead, non durante.
+    """
+    smtp_host, smtp_port, smtp_user, smtp_pass = _config_smtp()
+    if not smtp_host or not smtp_user or not smtp_pass:
+        logger.warning("smtp non configurato")
+        return False
+    try:
+        _apri_smtp().quit()
+        return True
+    except Exception as e:
+        logger.warning("smtp non raggiungibile",
+                       extra={"smtp": f"{smtp_host}:{smtp_port}", "errore": str(e)})
+        return False
+
+
 def invia_mail(destinatario, oggetto, corpo_html, allegato=None):
-    smtp_host = os.getenv("SMTP_HOST", "mail.stima360.it")
-    smtp_port = int(os.getenv("SMTP_PORT", "587"))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_pass = os.getenv("SMTP_PASS")
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.application import MIMEApplication
+
+    smtp_host, smtp_port, smtp_user, smtp_pass = _config_smtp()
     email_from = smtp_user
 
     if not smtp_host or not smtp_user or not smtp_pass:
-        print("❌ SMTP non configurato!")
+        logger.error("smtp non configurato")
         return False
 
-    print(f"📧 Invio email tramite {smtp_host}:{smtp_port} a {destinatario}")
+    logger.info("email invio", extra={"smtp": f"{smtp_host}:{smtp_port}", "destinatario": destinatario})
 
     msg = MIMEMultipart()
     msg["From"] = email_from
@@ -279,23 +257,46 @@ def invia_mail(destinatario, oggetto, corpo_html, allegato=None):
                 part = MIMEApplication(f.read(), Name=os.path.basename(allegato))
                 part['Content-Disposition'] = f'attachment; filename="%s"' % os.path.basename(allegato)
                 msg.attach(part)
-        except Exception as e:
-            print("⚠️ Errore allegato:", e)
+        except Exception:
+            logger.exception("email: errore allegato", extra={"allegato": allegato})
 
     try:
-        server = smtplib.SMTP(smtp_host, smtp_port)
-        server.ehlo()
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
+        server = _apri_smtp()
         server.sendmail(email_from, destinatario, msg.as_string())
         server.quit()
-        print("✅ Email inviata correttamente!")
+        logger.info("email inviata", extra={"destinatario": destinatario})
         return True
-    except Exception as e:
-        print("❌ Errore invio email:", e)
+    except Exception:
+        logger.exception("email: errore invio", extra={"destinatario": destinatario})
         return False
 
 
+# ------------------- VALORI CALCOLATI -------------------
+def salva_valori_calcolati(stima_id, calc, engine_version, catalog_version):
+    """Scrive sulla riga di `stime` l'output di compute_from_payload."""
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE stime SET
+              price_exact=%s,
+              eur_mq_finale=%s,
+              valore_pertinenze=%s,
+              base_mq=%s,
+              engine_version=%s,
+              catalog_version=%s,
+              valutata_at=NOW()
+            WHERE id=%s
+        """, (
+            calc["price_exact"], calc["eur_mq_finale"],
+            calc["valore_pertinenze"], calc["base_mq"],
+            engine_version, catalog_version, stima_id
+        ))
+        conn.commit()
+    finally:
+        cur.close(); conn.close()
+
+
 # ------------------- JOIN COMPLETO -------------------
 def ottieni_stima_completa(stima_id):
     conn = get_connection()
@@ -303,7 +304,7 @@ def ottieni_stima_completa(stima_id):
 
     cur.execute("""
         SELECT * FROM stime
-        WHERE id = %s
+        WHERE id = %s AND deleted_at IS NULL
     """, (stima_id,))
 
     row = cur.fetchone()
@@ -319,26 +320,7 @@ def ottieni_stima_completa(stima_id):
 
 
 # ------------------- MAIN -------------------
-def migrazione_condiz_tipo():
-    """Aggiunge il campo condiz_tipo nella tabella stime_dettagliate se manca."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        ALTER TABLE stime_dettagliate
-        ADD COLUMN IF NOT EXISTS condiz_tipo VARCHAR(50);
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-# ------------------- MAIN -------------------
+# Lo schema è gestito da migrations.py (migrazioni versionate)
 if __name__ == "__main__":
-    crea_tabella_stime()
-    crea_tabella_stime_dettagliate()
-    crea_tabella_zone_valori()
-    migrazione_allinea_stime()
-    migrazione_gestionale_stime()
-    migrazione_stime_completa()
-    migrazione_condiz_tipo()   # <-- CORRETTO
-    migrazione_stime_dettagliate_completa()
+    from migrations import applica_migrazioni
+    applica_migrazioni()
@@ -0,0 +1,346 @@
+# backend/geocoder.py
+# Geocoder offline: (via, civico, comune) → coordinate, senza servizi esterni.
+#
+# Sorgente: uno stradario CSV locale (GEO_STRADARIO) con colonne
+#   comune, via, civico, lat, lon
+# una riga per numero civico; le righe con civico vuoto sono punti della
+# strada (vertici/centroidi dei tratti) e servono quando il civico manca.
+# Si genera da un estratto OSM dei comuni coperti (GeoJSON da Overpass):
+#   python geocoder.py --da-geojson estratto.geojson --comune Tortoreto >> dati/stradario.csv
+# Senza file il geocoder è spento e restituisce None: il motore continua
+# a lavorare sul testo della via come prima.
+#
+# Indice in memoria, per comune:
+#   - nome normalizzato (minuscole, senza accenti, abbreviazioni espanse:
+#     "V.le G. Marconi" → "viale g marconi") → via, lookup diretto
+#   - nome senza DUG ("g marconi") → via, per chi scrive "via" al posto di "viale"
+#   - parole del nome → vie, per i nomi abbreviati ("via marconi")
+#   - trigrammi del nome senza DUG → vie, per gli errori di battitura
+#     (similarità di Dice, soglia GEO_SOGLIA)
+# Civico: esatto se presente, altrimenti interpolato tra i civici noti
+# dello stesso lato (pari/dispari), altrimenti il centro della via.
+# Gli indirizzi già visti passano da una LRU (GEOCODER_CACHE voci).
+
+import os
+import csv
+import sys
+import json
+import bisect
+import logging
+import threading
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+
+logger = logging.getLogger("stima360.geocoder")
+
+BASE_DIR = Path(__file__).resolve().parent
+GEO_STRADARIO = Path(os.getenv("GEO_STRADARIO", BASE_DIR / "dati" / "stradario.csv"))
+GEO_SOGLIA = float(os.getenv("GEO_SOGLIA", "0.55"))
+GEOCODER_CACHE = int(os.getenv("GEOCODER_CACHE", "4096"))
+
+# Denominazioni urbanistiche generiche (DUG)
+_DUG = {
+    "via", "viale", "piazza", "piazzale", "piazzetta", "corso", "largo",
+    "vicolo", "contrada", "strada", "lungomare", "traversa", "borgo",
+    "localita", "circonvallazione", "salita", "vico", "rotonda", "galleria",
+}
+_ABBREVIAZIONI = {
+    "v": "via", "v.le": "viale", "vle": "viale", "p.zza": "piazza",
+    "p.za": "piazza", "pza": "piazza", "pzza": "piazza", "p.le": "piazzale",
+    "c.so": "corso", "cso": "corso", "l.go": "largo", "lgo": "largo",
+    "vic": "vicolo", "c.da": "contrada", "cda": "contrada", "str": "strada",
+    "loc": "localita", "lgm": "lungomare", "l.mare": "lungomare",
+    "ss": "strada statale", "s.s": "strada statale", "sp": "strada provinciale",
+    "s.p": "strada provinciale", "s": "san", "sta": "santa", "sto": "santo",
+}
+
+
+# ---------------------------------------------------------
+# NORMALIZZAZIONE
+# ---------------------------------------------------------
+def normalizza(testo) -> str:
+    """Minuscole, senza accenti né punteggiatura, abbreviazioni espanse."""
+    t = unicodedata.normalize("NFKD", str(testo or "").lower())
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    for c in "'’`\",;:/()-_":
+        t = t.replace(c, " ")
+    parole = []
+    for p in t.split():
+        p = _ABBREVIAZIONI.get(p, _ABBREVIAZIONI.get(p.rstrip("."), p))
+        parole.append(p.replace(".", " ").strip())
+    return " ".join(" ".join(parole).split())
+
+
+def _nucleo(nome: str) -> str:
+    """Nome senza la DUG iniziale ("viale g marconi" → "g marconi")."""
+    parole = nome.split()
+    if len(parole) > 1 and parole[0] in _DUG:
+        return " ".join(parole[1:])
+    return nome
+
+
+def _trigrammi(testo: str) -> set:
+    t = f"  {testo} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+
+def _civico(testo) -> tuple[int | None, str]:
+    """"12", "12/a", "12 bis", "12A" → (12, "a"); senza numero → (None, "")."""
+    t = normalizza(testo).replace(" ", "")
+    n = len(t) - len(t.lstrip("0123456789"))
+    if not n:
+        return None, ""
+    return int(t[:n]), t[n:]
+
+
+# ---------------------------------------------------------
+# INDICE
+# ---------------------------------------------------------
+class _Via:
+    __slots__ = ("nome", "civici", "lati", "centro")
+
+    def __init__(self, nome: str):
+        self.nome = nome            # come nello stradario (per il motore e i report)
+        self.civici = {}            # (numero, esponente) → (lat, lon)
+        self.lati = ([], [])        # pari, dispari: [(numero, lat, lon)] ordinati
+        self.centro = None          # (lat, lon)
+
+    def chiudi(self, punti: list):
+        for (numero, _), (lat, lon) in sorted(self.civici.items()):
+            lato = self.lati[numero % 2]
+            if not lato or lato[-1][0] != numero:
+                lato.append((numero, lat, lon))
+        if not punti:
+            punti = list(self.civici.values())
+        if punti:
+            self.centro = (sum(p[0] for p in punti) / len(punti),
+                           sum(p[1] for p in punti) / len(punti))
+
+    def posizione(self, numero: int | None, esponente: str):
+        """(lat, lon, precisione) per il civico; None se la via non ha punti."""
+        if numero is not None:
+            esatto = self.civici.get((numero, esponente)) or self.civici.get((numero, ""))
+            if esatto:
+                return esatto[0], esatto[1], "civico"
+            lato = self.lati[numero % 2]
+            if lato:
+                i = bisect.bisect_left(lato, (numero,))
+                if 0 < i < len(lato):
+                    (n0, la0, lo0), (n1, la1, lo1) = lato[i - 1], lato[i]
+                    f = (numero - n0) / (n1 - n0)
+                    return la0 + (la1 - la0) * f, lo0 + (lo1 - lo0) * f, "interpolato"
+                n, la, lo = lato[0] if i == 0 else lato[-1]
+                return la, lo, "interpolato"
+        if self.centro:
+            return self.centro[0], self.centro[1], "via"
+        return None
+
+
+class _Comune:
+    def __init__(self):
+        self.vie = {}               # nome normalizzato → _Via
+        self.nuclei = {}            # nome senza DUG → [nome normalizzato]
+        self.trigrammi = {}         # trigramma → {nome normalizzato}
+        self.n_trigrammi = {}       # nome normalizzato → trigrammi del nucleo
+        self.parole = {}            # parola del nucleo → {nome normalizzato}
+
+    def indicizza(self):
+        for chiave in self.vie:
+            nucleo = _nucleo(chiave)
+            self.nuclei.setdefault(nucleo, []).append(chiave)
+            gv = _trigrammi(nucleo)
+            self.n_trigrammi[chiave] = len(gv)
+            for g in gv:
+                self.trigrammi.setdefault(g, set()).add(chiave)
+            for p in nucleo.split():
+                self.parole.setdefault(p, set()).add(chiave)
+
+    def trova(self, via: str) -> tuple[_Via, float] | None:
+        """Via più simile e punteggio (1.0 = nome identico)."""
+        if via in self.vie:
+            return self.vie[via], 1.0
+        nucleo = _nucleo(via)
+        candidati = self.nuclei.get(nucleo)
+        if candidati:
+            # stesso nome, DUG diversa o assente: preferisce la stessa DUG
+            migliore = next((c for c in candidati if c.split()[0] == via.split()[0]), candidati[0])
+            return self.vie[migliore], 0.95
+
+        # nome abbreviato ("via marconi" per "viale guglielmo marconi"):
+        # tutte le parole presenti, vince il nome più corto
+        insiemi = [self.parole.get(p) for p in nucleo.split()]
+        if insiemi and all(insiemi):
+            contenute = set.intersection(*insiemi)
+            if contenute:
+                return self.vie[min(contenute, key=len)], 0.9
+
+        gq = _trigrammi(nucleo)
+        conteggi = {}
+        for g in gq:
+            for chiave in self.trigrammi.get(g, ()):
+                conteggi[chiave] = conteggi.get(chiave, 0) + 1
+        migliore, punteggio = None, 0.0
+        for chiave, comuni in conteggi.items():
+            dice = 2 * comuni / (len(gq) + self.n_trigrammi[chiave])
+            if dice > punteggio:
+                migliore, punteggio = chiave, dice
+        if migliore is None or punteggio < GEO_SOGLIA:
+            return None
+        return self.vie[migliore], round(punteggio, 3)
+
+
+_indice: dict[str, _Comune] = {}
+_lock = threading.Lock()
+
+
+def carica(percorso: Path | str | None = None) -> int:
+    """Legge lo stradario e sostituisce l'indice; restituisce le vie caricate."""
+    global _indice
+    percorso = Path(percorso or GEO_STRADARIO)
+    if not percorso.exists():
+        logger.info("stradario assente: geocoder spento", extra={"percorso": str(percorso)})
+        return 0
+
+    nuovo: dict[str, _Comune] = {}
+    punti: dict[int, list] = {}
+    with open(percorso, newline="", encoding="utf-8") as f:
+        for riga in csv.DictReader(f):
+            try:
+                lat, lon = float(riga["lat"]), float(riga["lon"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            chiave = normalizza(riga.get("via"))
+            if not chiave:
+                continue
+            comune = nuovo.setdefault(normalizza(riga.get("comune")), _Comune())
+            via = comune.vie.get(chiave)
+            if via is None:
+                via = comune.vie[chiave] = _Via(" ".join(str(riga["via"]).split()))
+            numero, esponente = _civico(riga.get("civico"))
+            if numero is None:
+                punti.setdefault(id(via), []).append((lat, lon))
+            else:
+                via.civici[(numero, esponente)] = (lat, lon)
+
+    totale = 0
+    for comune in nuovo.values():
+        for via in comune.vie.values():
+            via.chiudi(punti.get(id(via), []))
+        comune.indicizza()
+        totale += len(comune.vie)
+
+    with _lock:
+        _indice = nuovo
+        _cerca.cache_clear()
+    logger.info("stradario caricato", extra={"comuni": len(nuovo), "vie": totale})
+    return totale
+
+
+def disponibile() -> bool:
+    return bool(_indice)
+
+
+@lru_cache(maxsize=GEOCODER_CACHE)
+def _cerca(via: str, civico: str, comune: str):
+    c = _indice.get(comune)
+    if c is None:
+        return None
+    trovata = c.trova(via)
+    if trovata is None:
+        return None
+    v, punteggio = trovata
+    numero, esponente = _civico(civico)
+    pos = v.posizione(numero, esponente)
+    if pos is None:
+        return None
+    lat, lon, precisione = pos
+    return (round(lat, 7), round(lon, 7), v.nome, precisione, punteggio)
+
+
+def geocodifica(via, civico, comune) -> dict | None:
+    """
+    {lat, lon, via, precisione, punteggio} per l'indirizzo, oppure None
+    (geocoder spento, comune non coperto, via non riconosciuta).
+    `via` è il nome canonico dello stradario; precisione è "civico",
+    "interpolato" o "via".
+    """
+    if not _indice:
+        return None
+    chiave_via = normalizza(via)
+    if not chiave_via:
+        return None
+    r = _cerca(chiave_via, normalizza(civico), normalizza(comune))
+    if r is None:
+        return None
+    lat, lon, nome, precisione, punteggio = r
+    return {"lat": lat, "lon": lon, "via": nome,
+            "precisione": precisione, "punteggio": punteggio}
+
+
+# ---------------------------------------------------------
+# CONVERSIONE DA OSM (GeoJSON esportato da Overpass)
+# ---------------------------------------------------------
+def _punti_geometria(g: dict) -> list:
+    """Coordinate (lat, lon) di una geometria GeoJSON (solo il primo anello dei poligoni)."""
+    tipo, coord = g.get("type"), g.get("coordinates") or []
+    if tipo == "Point":
+        return [(coord[1], coord[0])]
+    if tipo == "LineString":
+        return [(c[1], c[0]) for c in coord]
+    if tipo == "MultiLineString":
+        return [(c[1], c[0]) for linea in coord for c in linea]
+    if tipo == "Polygon":
+        return [(c[1], c[0]) for c in coord[0]] if coord else []
+    if tipo == "MultiPolygon":
+        return [(c[1], c[0]) for c in coord[0][0]] if coord else []
+    return []
+
+
+def da_geojson(percorso: str, comune: str | None = None):
+    """
+    Righe dello stradario da un estratto OSM: i civici (addr:street +
+    addr:housenumber) e i vertici delle strade con nome (highway=*).
+    `comune` vale per gli oggetti senza addr:city (le strade non lo hanno).
+    """
+    with open(percorso, encoding="utf-8") as f:
+        dati = json.load(f)
+    for feat in dati.get("features", []):
+        prop = feat.get("properties") or {}
+        punti = _punti_geometria(feat.get("geometry") or {})
+        if not punti:
+            continue
+        citta = prop.get("addr:city") or comune
+        if prop.get("addr:street") and prop.get("addr:housenumber") and citta:
+            lat = sum(p[0] for p in punti) / len(punti)
+            lon = sum(p[1] for p in punti) / len(punti)
+            for numero in str(prop["addr:housenumber"]).split(";"):
+                yield citta, prop["addr:street"], numero.strip(), lat, lon
+        elif prop.get("highway") and prop.get("name") and citta:
+            for lat, lon in punti:
+                yield citta, prop["name"], "", lat, lon
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Geocoder offline (stradario locale)")
+    ap.add_argument("--da-geojson", metavar="FILE",
+                    help="converte un estratto OSM in righe CSV dello stradario (stdout)")
+    ap.add_argument("--comune", help="comune per gli oggetti OSM senza addr:city")
+    ap.add_argument("--intestazione", action="store_true",
+                    help="scrive anche la riga di intestazione del CSV")
+    ap.add_argument("indirizzo", nargs="*", help='prova: VIA CIVICO COMUNE, es. "v.le marconi" 12 Tortoreto')
+    args = ap.parse_args()
+
+    if args.da_geojson:
+        w = csv.writer(sys.stdout)
+        if args.intestazione:
+            w.writerow(["comune", "via", "civico", "lat", "lon"])
+        for riga in da_geojson(args.da_geojson, args.comune):
+            w.writerow(riga[:3] + (f"{riga[3]:.7f}", f"{riga[4]:.7f}"))
+    elif len(args.indirizzo) == 3:
+        print(f"vie caricate: {carica()}")
+        print(geocodifica(*args.indirizzo))
+    else:
+        ap.print_help()
@@ -1,19 +1,14 @@
-# init_db.py – inizializza le tabelle su Postgres
+# init_db.py – inizializza/aggiorna le tabelle su Postgres
+# (le migrazioni versionate sono in migrations.py)
 
-from database import (
-    crea_tabella_stime,
-    crea_tabella_stime_dettagliate,
-    crea_tabella_zone_valori,
-    migrazione_allinea_stime,
-)
+from migrations import applica_migrazioni, verifica_schema
 
 if __name__ == "__main__":
-    print("🔧 Creo tabella stime...")
-    crea_tabella_stime()
-    print("🔧 Creo tabella stime_dettagliate...")
-    crea_tabella_stime_dettagliate()
-    print("🔧 Creo tabella zone_valori...")
-    crea_tabella_zone_valori()
-    print("🔧 Eseguo migrazione allinea_stime...")
-    migrazione_allinea_stime()
-    print("✅ Inizializzazione DB completata.")
+    print("🔧 Applico migrazioni...")
+    fatte = applica_migrazioni()
+    print(f"🔧 Migrazioni applicate: {fatte or 'nessuna'}")
+    problemi = verifica_schema()
+    for p in problemi:
+        print("❌", p)
+    if not problemi:
+        print("✅ Inizializzazione DB completata.")
@@ -0,0 +1,505 @@
+# loadtest.py – test di carico con servizi esterni finti in locale
+#
+# Avvia:
+#   - un sink SMTP (accetta AUTH e DATA, niente TLS)
+#   - un server HTTP con il relay WhatsApp finto (WHATSAPP_SERVICE_URL),
+#     la Graph API finta (WHATSAPP_GRAPH_URL) e la GitHub contents API
+#     finta (GITHUB_API_URL)
+#   - l'app (uvicorn) in uno schema Postgres temporaneo, puntata ai finti
+# poi esegue un profilo di traffico e stampa throughput, p50/p95/p99 ed
+# errori per endpoint. Ogni servizio finto ha latenza ed errori configurabili.
+#
+# Uso:
+#   python loadtest.py                                  # profilo "misto"
+#   python loadtest.py --profilo lead --concorrenza 16 --durata 60
+#   python loadtest.py --latenza-github 0.4 --errori-github 0.05
+#   python loadtest.py --url http://localhost:8000      # app già avviata (niente uvicorn)
+#   python loadtest.py --json risultati.json
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import hashlib
+import argparse
+import threading
+import subprocess
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date
+
+import requests
+
+from benchmark import corpus_payload
+
+
+# ---------------------------------------------------------
+# SERVIZI FINTI
+# ---------------------------------------------------------
+class Comportamento:
+    """Latenza (media ± jitter, in secondi) ed errori (probabilità 0–1)."""
+
+    def __init__(self, latenza: float = 0.0, jitter: float = 0.0, errori: float = 0.0):
+        self.latenza = latenza
+        self.jitter = jitter
+        self.errori = errori
+        self.chiamate = 0
+        self.errori_iniettati = 0
+        self._lock = threading.Lock()
+
+    def applica(self) -> bool:
+        """Attende la latenza simulata; True se questa chiamata deve fallire."""
+        ritardo = max(0.0, random.gauss(self.latenza, self.jitter)) if self.jitter else self.latenza
+        if ritardo:
+            time.sleep(ritardo)
+        fallisce = random.random() < self.errori
+        with self._lock:
+            self.chiamate += 1
+            if fallisce:
+                self.errori_iniettati += 1
+        return fallisce
+
+    def stato(self) -> dict:
+        return {"chiamate": self.chiamate, "errori_iniettati": self.errori_iniettati}
+
+
+def _git_blob_sha(dati: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(dati) + dati).hexdigest()
+
+
+class ServiziHTTP:
+    """Relay WhatsApp, Graph API e GitHub contents API su un'unica porta."""
+
+    def __init__(self, whatsapp: Comportamento, graph: Comportamento, github: Comportamento):
+        self.whatsapp = whatsapp
+        self.graph = graph
+        self.github = github
+        self.file_github = {}   # path -> sha
+        self._lock = threading.Lock()
+        servizi = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _rispondi(self, status: int, corpo: dict | None = None):
+                dati = json.dumps(corpo or {}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(dati)))
+                self.end_headers()
+                self.wfile.write(dati)
+
+            def _corpo(self) -> dict:
+                n = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(n) or b"{}") if n else {}
+
+            def do_GET(self):
+                if self.path.startswith("/github/"):
+                    if servizi.github.applica():
+                        return self._rispondi(502, {"message": "errore simulato"})
+                    sha = servizi.file_github.get(self.path)
+                    if sha is None:
+                        return self._rispondi(404, {"message": "Not Found"})
+                    return self._rispondi(200, {"sha": sha})
+                self._rispondi(404)
+
+            def do_PUT(self):
+                if self.path.startswith("/github/"):
+                    import base64
+                    corpo = self._corpo()
+                    if servizi.github.applica():
+                        return self._rispondi(502, {"message": "errore simulato"})
+                    sha = _git_blob_sha(base64.b64decode(corpo.get("content", "")))
+                    with servizi._lock:
+                        servizi.file_github[self.path] = sha
+                    return self._rispondi(201, {"content": {"sha": sha}})
+                self._rispondi(404)
+
+            def do_DELETE(self):
+                if self.path.startswith("/github/"):
+                    self._corpo()
+                    if servizi.github.applica():
+                        return self._rispondi(502, {"message": "errore simulato"})
+                    with servizi._lock:
+                        trovato = servizi.file_github.pop(self.path, None)
+                    return self._rispondi(200 if trovato else 404, {})
+                self._rispondi(404)
+
+            def do_POST(self):
+                corpo = self._corpo()
+                if self.path.startswith("/whatsapp/"):
+                    if servizi.whatsapp.applica():
+                        return self._rispondi(500, {"error": "errore simulato"})
+                    return self._rispondi(200, {"ok": True, "to": corpo.get("to")})
+                if self.path.startswith("/graph/"):
+                    if servizi.graph.applica():
+                        return self._rispondi(500, {"error": {"message": "errore simulato"}})
+                    return self._rispondi(200, {"messages": [{"id": f"wamid.{uuid.uuid4().hex}"}]})
+                self._rispondi(404)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.porta = self.server.server_address[1]
+
+    def avvia(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def chiudi(self):
+        self.server.shutdown()
+
+
+class SinkSMTP:
+    """SMTP minimale: EHLO, AUTH, MAIL, RCPT, DATA; scarta i messaggi."""
+
+    def __init__(self, comportamento: Comportamento):
+        self.comportamento = comportamento
+        self.messaggi = 0
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def _scrivi(self, riga: str):
+                self.wfile.write((riga + "\r\n").encode())
+
+            def handle(self):
+                self._scrivi("220 sink.locale ESMTP")
+                while True:
+                    riga = self.rfile.readline()
+                    if not riga:
+                        return
+                    cmd = riga.decode(errors="replace").strip()
+                    verbo = cmd.split(" ", 1)[0].upper()
+                    if verbo in ("EHLO", "HELO"):
+                        self._scrivi("250-sink.locale")
+                        self._scrivi("250 AUTH PLAIN LOGIN")
+                    elif verbo == "AUTH":
+                        parti = cmd.split()
+                        if len(parti) == 2 and parti[1].upper() == "LOGIN":
+                            self._scrivi("334 VXNlcm5hbWU6")
+                            self.rfile.readline()
+                            self._scrivi("334 UGFzc3dvcmQ6")
+                            self.rfile.readline()
+                        self._scrivi("235 2.7.0 ok")
+                    elif verbo == "DATA":
+                        self._scrivi("354 fine con <CRLF>.<CRLF>")
+                        while self.rfile.readline().rstrip(b"\r\n") != b".":
+                            pass
+                        if sink.comportamento.applica():
+                            self._scrivi("451 4.3.0 errore simulato")
+                        else:
+                            with sink._lock:
+                                sink.messaggi += 1
+                            self._scrivi("250 2.0.0 accettato")
+                    elif verbo == "QUIT":
+                        self._scrivi("221 ciao")
+                        return
+                    else:
+                        self._scrivi("250 ok")
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.porta = self.server.server_address[1]
+
+    def avvia(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def chiudi(self):
+        self.server.shutdown()
+
+
+# ---------------------------------------------------------
+# APP
+# ---------------------------------------------------------
+def _porta_libera() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def avvia_app(http: ServiziHTTP, smtp: SinkSMTP, workers: int,
+              pdf_workers: int = 2) -> tuple[subprocess.Popen, str]:
+    porta = _porta_libera()
+    base = f"http://127.0.0.1:{http.porta}"
+    env = {
+        **os.environ,   # PGOPTIONS con lo schema temporaneo
+        "SCHEMA_CHECK": "warn",
+        "PURGE_INTERVALLO": "0",
+        "PDF_WORKERS": str(pdf_workers),   # pool di processi come in produzione
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp.porta),
+        "SMTP_USER": "loadtest@stima360.invalid",
+        "SMTP_PASS": "loadtest",
+        "SMTP_STARTTLS": "0",
+        "WHATSAPP_SERVICE_URL": f"{base}/whatsapp/send",
+        "WHATSAPP_GRAPH_URL": f"{base}/graph",
+        "WHATSAPP_PHONE_ID": "123456",
+        "WHATSAPP_TOKEN": "loadtest",
+        "GITHUB_API_URL": f"{base}/github",
+        "GITHUB_USER": "loadtest",
+        "GITHUB_REPO": "pdf",
+        "GITHUB_TOKEN": "loadtest",
+    }
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(porta), "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    url = f"http://127.0.0.1:{porta}"
+    scadenza = time.monotonic() + 60
+    while time.monotonic() < scadenza:
+        if proc.poll() is not None:
+            raise RuntimeError(f"uvicorn terminato (exit {proc.returncode})")
+        try:
+            if requests.get(f"{url}/readyz", timeout=2).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            time.sleep(0.3)
+    proc.terminate()
+    raise RuntimeError("app non pronta (/readyz) entro 60s")
+
+
+# ---------------------------------------------------------
+# TRAFFICO
+# ---------------------------------------------------------
+_corpus = corpus_payload(500, seed=37)
+
+
+def op_salva_stima(s: requests.Session, url: str):
+    p = random.choice(_corpus)
+    return s.post(f"{url}/api/salva_stima", json={
+        **p, "nome": "Carico", "cognome": "Test",
+        "email": "carico@stima360.invalid",
+        "telefono": f"333{random.randint(1000000, 9999999)}",
+    }, timeout=60)
+
+
+def op_stima_base(s: requests.Session, url: str):
+    p = random.choice(_corpus)
+    return s.post(f"{url}/api/stima_base", json={
+        k: p[k] for k in ("comune", "microzona", "tipologia", "mq", "anno")
+    }, timeout=30)
+
+
+def op_webhook(s: requests.Session, url: str):
+    return s.post(f"{url}/webhook/whatsapp", json={"entry": [{"changes": [{"value": {
+        "messages": [{
+            "from": f"39333{random.randint(1000000, 9999999)}",
+            "type": "text",
+            "text": {"body": "Buongiorno, vorrei informazioni"},
+        }],
+    }}]}]}, timeout=30)
+
+
+def op_admin_stime(s: requests.Session, url: str):
+    return s.get(f"{url}/api/admin/stime", params={"day": "oggi"}, timeout=30)
+
+
+def op_admin_whatsapp(s: requests.Session, url: str):
+    return s.get(f"{url}/api/admin/whatsapp/messages",
+                 params={"dal": date.today().isoformat()}, timeout=30)
+
+
+def op_admin_reply(s: requests.Session, url: str):
+    return s.post(f"{url}/api/admin/whatsapp/reply", json={
+        "to": f"333{random.randint(1000000, 9999999)}", "text": "Grazie, la ricontattiamo",
+    }, timeout=30)
+
+
+OPERAZIONI = {
+    "salva_stima": op_salva_stima,
+    "stima_base": op_stima_base,
+    "webhook": op_webhook,
+    "admin_stime": op_admin_stime,
+    "admin_whatsapp": op_admin_whatsapp,
+    "admin_reply": op_admin_reply,
+}
+
+# mix = peso di ogni operazione; fasi = [(secondi, frazione della concorrenza)]
+PROFILI = {
+    "misto": {
+        "mix": {"stima_base": 50, "salva_stima": 15, "webhook": 20,
+                "admin_stime": 8, "admin_whatsapp": 5, "admin_reply": 2},
+        "fasi": [(1.0, 1.0)],
+    },
+    "lead": {
+        "mix": {"salva_stima": 80, "stima_base": 20},
+        "fasi": [(1.0, 1.0)],
+    },
+    "admin": {
+        "mix": {"admin_stime": 50, "admin_whatsapp": 40, "admin_reply": 10},
+        "fasi": [(1.0, 1.0)],
+    },
+    # rampa: 25% → 100% → 25% della concorrenza
+    "picco": {
+        "mix": {"stima_base": 50, "salva_stima": 25, "webhook": 25},
+        "fasi": [(0.25, 0.25), (0.5, 1.0), (0.25, 0.25)],
+    },
+}
+
+
+class Esiti:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.righe = []   # (operazione, status | None, secondi)
+
+    def aggiungi(self, op, status, durata):
+        with self._lock:
+            self.righe.append((op, status, durata))
+
+
+def esegui_profilo(url: str, profilo: dict, concorrenza: int, durata: float) -> tuple[Esiti, float]:
+    esiti = Esiti()
+    ops, pesi = zip(*profilo["mix"].items())
+    attivi = [0]
+    stop = threading.Event()
+
+    def lavoratore(indice: int):
+        s = requests.Session()
+        rnd = random.Random(indice)
+        while not stop.is_set():
+            if indice >= attivi[0]:
+                time.sleep(0.05)
+                continue
+            op = rnd.choices(ops, pesi)[0]
+            t0 = time.perf_counter()
+            try:
+                r = OPERAZIONI[op](s, url)
+                esiti.aggiungi(op, r.status_code, time.perf_counter() - t0)
+            except requests.RequestException:
+                esiti.aggiungi(op, None, time.perf_counter() - t0)
+
+    thread = [threading.Thread(target=lavoratore, args=(i,), daemon=True)
+              for i in range(concorrenza)]
+    for t in thread:
+        t.start()
+
+    t_inizio = time.perf_counter()
+    for quota_tempo, quota_concorrenza in profilo["fasi"]:
+        attivi[0] = max(1, round(concorrenza * quota_concorrenza))
+        stop.wait(durata * quota_tempo)
+    stop.set()
+    for t in thread:
+        t.join(timeout=65)
+    return esiti, time.perf_counter() - t_inizio
+
+
+# ---------------------------------------------------------
+# REPORT
+# ---------------------------------------------------------
+def _percentile(valori: list[float], p: float) -> float:
+    if not valori:
+        return 0.0
+    k = (len(valori) - 1) * p
+    i = int(k)
+    j = min(i + 1, len(valori) - 1)
+    return valori[i] + (valori[j] - valori[i]) * (k - i)
+
+
+def riepilogo(esiti: Esiti, durata: float) -> dict:
+    gruppi = {}
+    for op, status, sec in esiti.righe:
+        gruppi.setdefault(op, []).append((status, sec))
+    gruppi["TOTALE"] = [(st, sec) for _op, st, sec in esiti.righe]
+
+    report = {}
+    for op, righe in gruppi.items():
+        tempi = sorted(sec for _st, sec in righe)
+        errori = sum(1 for st, _ in righe if st is None or (st >= 500 and st != 503))
+        rifiutate = sum(1 for st, _ in righe if st == 503)
+        report[op] = {
+            "richieste": len(righe),
+            "rps": len(righe) / durata if durata else 0.0,
+            "p50_ms": _percentile(tempi, 0.50) * 1000,
+            "p95_ms": _percentile(tempi, 0.95) * 1000,
+            "p99_ms": _percentile(tempi, 0.99) * 1000,
+            "errori": errori,
+            "rifiutate_503": rifiutate,
+            "tasso_errori": errori / len(righe) if righe else 0.0,
+        }
+    return report
+
+
+def stampa(report: dict, fake: dict):
+    print(f"\n{'operazione':<16}{'req':>7}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'errori':>9}{'503':>6}")
+    for op, r in sorted(report.items(), key=lambda kv: (kv[0] == "TOTALE", kv[0])):
+        print(f"{op:<16}{r['richieste']:>7}{r['rps']:>9.1f}{r['p50_ms']:>10.1f}"
+              f"{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['tasso_errori']:>8.1%}"
+              f"{r['rifiutate_503']:>6}")
+    print("\nServizi finti:", json.dumps(fake))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Test di carico Stima360 con servizi finti")
+    ap.add_argument("--profilo", choices=sorted(PROFILI), default="misto")
+    ap.add_argument("--concorrenza", type=int, default=8)
+    ap.add_argument("--durata", type=float, default=30, help="secondi")
+    ap.add_argument("--workers", type=int, default=1, help="worker uvicorn")
+    ap.add_argument("--pdf-workers", type=int, default=2,
+                    help="processi di render PDF per worker (0 = thread, default 2)")
+    ap.add_argument("--url", help="app già avviata (non avvia uvicorn né lo schema temporaneo)")
+    for nome, lat in (("smtp", 0.05), ("whatsapp", 0.08), ("graph", 0.1), ("github", 0.3)):
+        ap.add_argument(f"--latenza-{nome}", type=float, default=lat, help="secondi")
+        ap.add_argument(f"--errori-{nome}", type=float, default=0.0, help="probabilità 0–1")
+    ap.add_argument("--jitter", type=float, default=0.3,
+                    help="deviazione della latenza, in frazione della media")
+    ap.add_argument("--json", help="salva il report in questo file")
+    args = ap.parse_args()
+
+    def comportamento(nome):
+        lat = getattr(args, f"latenza_{nome}")
+        return Comportamento(lat, lat * args.jitter, getattr(args, f"errori_{nome}"))
+
+    smtp = SinkSMTP(comportamento("smtp"))
+    http = ServiziHTTP(comportamento("whatsapp"), comportamento("graph"), comportamento("github"))
+    smtp.avvia()
+    http.avvia()
+
+    proc = None
+    schema = None
+    try:
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            import verifica_indici   # imposta PGOPTIONS sullo schema temporaneo
+            from migrations import applica_migrazioni
+            schema = verifica_indici
+            schema.crea_schema()
+            applica_migrazioni()
+            proc, url = avvia_app(http, smtp, args.workers, args.pdf_workers)
+
+        print(f"Profilo {args.profilo}: {args.concorrenza} client per {args.durata:.0f}s su {url}")
+        esiti, durata = esegui_profilo(url, PROFILI[args.profilo], args.concorrenza, args.durata)
+        report = riepilogo(esiti, durata)
+        fake = {
+            "smtp": {**smtp.comportamento.stato(), "messaggi": smtp.messaggi},
+            "whatsapp": http.whatsapp.stato(),
+            "graph": http.graph.stato(),
+            "github": {**http.github.stato(), "file": len(http.file_github)},
+        }
+        stampa(report, fake)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"profilo": args.profilo, "concorrenza": args.concorrenza,
+                           "durata": durata, "report": report, "servizi_finti": fake}, f, indent=2)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if schema is not None:
+            schema.elimina_schema()
+        http.chiudi()
+        smtp.chiudi()
@@ -0,0 +1,178 @@
+# backend/log.py
+# Logging strutturato (una riga JSON per evento) con ID di correlazione.
+#
+# - request_id / lead_id (e trace_id, vedi tracing.py) vivono in contextvars: ogni riga scritta durante
+#   una richiesta li riporta, anche dai thread (asyncio.to_thread e il
+#   threadpool di FastAPI copiano il contesto) e dai worker PDF (il
+#   contesto viaggia insieme al job, vedi pdf_worker.py)
+# - le righe passano da una coda: chi logga non aspetta mai stdout,
+#   la scrittura la fa un thread dedicato (QueueListener)
+# - le righe ad alto volume si marcano con extra={"campione": True} e ne
+#   resta solo la quota LOG_SAMPLE_RATE; la scelta è per request_id, quindi
+#   una richiesta si vede per intero oppure non si vede.
+#   WARNING ed ERROR non vengono mai scartati.
+#
+# Uso:
+#   from log import get_logger
+#   logger = get_logger(__name__)
+#   logger.info("pdf generato", extra={"url": url, "durata_ms": 120})
+
+import os
+import sys
+import json
+import queue
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Quota di richieste di cui si tengono le righe marcate "campione" (0–1)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+
+request_id = contextvars.ContextVar("request_id", default=None)
+lead_id = contextvars.ContextVar("lead_id", default=None)
+job = contextvars.ContextVar("job", default=None)
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+_VARIABILI = {"request_id": request_id, "lead_id": lead_id, "job": job, "trace_id": trace_id}
+
+# Attributi standard di LogRecord: tutto il resto è un campo "extra"
+_ATTRIBUTI_RECORD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "campione"}
+
+
+# ---------------------------------------------------------
+# CONTESTO
+# ---------------------------------------------------------
+def contesto_corrente() -> dict:
+    """ID di correlazione attivi (da passare ai job in background)."""
+    return {k: v.get() for k, v in _VARIABILI.items() if v.get() is not None}
+
+
+def imposta(**valori):
+    """Imposta gli ID per il resto del contesto corrente (es. lead_id dopo l'INSERT)."""
+    for k, v in valori.items():
+        _VARIABILI[k].set(None if v is None else str(v))
+
+
+@contextmanager
+def contesto(**valori):
+    """Imposta gli ID per la durata del blocco."""
+    token = [(_VARIABILI[k], _VARIABILI[k].set(None if v is None else str(v)))
+             for k, v in valori.items()]
+    try:
+        yield
+    finally:
+        for var, t in reversed(token):
+            var.reset(t)
+
+
+# ---------------------------------------------------------
+# FORMATTER E FILTRI
+# ---------------------------------------------------------
+class FormatterJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        riga = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc)
+                          .isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for k in _VARIABILI:
+            v = getattr(record, k, None)
+            if v is not None:
+                riga[k] = v
+        for k, v in record.__dict__.items():
+            if k not in _ATTRIBUTI_RECORD and k not in _VARIABILI and k not in riga:
+                riga[k] = v
+        if record.exc_info:
+            riga["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            riga["exc"] = record.exc_text
+        return json.dumps(riga, ensure_ascii=False, default=str)
+
+
+class FiltroContesto(logging.Filter):
+    """
+    Copia gli ID di correlazione sul record nel thread che logga
+    (il QueueListener gira in un altro thread, senza il contesto).
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        for k, var in _VARIABILI.items():
+            if getattr(record, k, None) is None:
+                setattr(record, k, var.get())
+        return True
+
+
+class FiltroCampionamento(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if not getattr(record, "campione", False) or LOG_SAMPLE_RATE >= 1:
+            return True
+        if LOG_SAMPLE_RATE <= 0:
+            return False
+        # stessa decisione per tutte le righe della stessa richiesta
+        chiave = getattr(record, "request_id", None) or f"{record.created}"
+        h = int.from_bytes(hashlib.blake2b(chiave.encode(), digest_size=4).digest(), "big")
+        return h / 0xFFFFFFFF < LOG_SAMPLE_RATE
+
+
+class HandlerCoda(logging.handlers.QueueHandler):
+    """Mette in coda il record già "risolto" (messaggio e traceback come testo)."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# ---------------------------------------------------------
+# CONFIGURAZIONE
+# ---------------------------------------------------------
+_listener = None
+
+
+def configura(livello: str = LOG_LEVEL):
+    """Configura il root logger (idempotente)."""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(FormatterJSON())
+
+    coda = queue.SimpleQueue()
+    handler = HandlerCoda(coda)
+    handler.addFilter(FiltroContesto())
+    handler.addFilter(FiltroCampionamento())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(livello)
+
+    _listener = logging.handlers.QueueListener(coda, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(chiudi)
+
+
+def chiudi():
+    """Svuota la coda e ferma il thread di scrittura."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(nome: str) -> logging.Logger:
+    return logging.getLogger(nome)
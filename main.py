@@ -1,34 +1,87 @@
 # backend/main.py — versione ripulita Stima360
 
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, HTTPException, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
 
 from pathlib import Path
 from datetime import datetime, date, timedelta, timezone
-import os, uvicorn, secrets, uuid, requests
+import os, secrets, uuid, threading, signal
 from valuation_base import compute_base_from_payload 
-from database import get_connection, invia_mail
-from pdf_report import genera_pdf_stima
+import valuation_base
+from database import get_connection, invia_mail, salva_valori_calcolati
+import database
+import pdf_worker
+import purger
+import comparabili
+import geocoder
+import microzone
+import costa
+import sensibilita
+import shadow
+import regole
+import metrics
+import log
+import tracing
+import profiler
+import time
+import asyncio
 from valuation import compute_from_payload
-from valuation import BASE_MQ
+from valuation import BASE_MQ, CATALOG_VERSION, comune_canonico, versione_motore
+from cache import TTLCache, MANCANTE
+from migrations import verifica_schema
 from urllib.parse import urlencode
 # ---------------------------------------------------------
 # CONFIG
 # ---------------------------------------------------------
+log.configura()
+logger = log.get_logger("stima360")
+
 BASE_DIR = Path(__file__).parent
 REPORTS_DIR = Path("/var/tmp/reports")
 os.makedirs(REPORTS_DIR, exist_ok=True)
 
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://stima360-backend.onrender.com")
 WHATSAPP_SERVICE_URL = os.getenv("WHATSAPP_SERVICE_URL", "https://stima360-whatsapp-webhook-test.onrender.com/send")
+WHATSAPP_GRAPH_URL = os.getenv("WHATSAPP_GRAPH_URL", "https://graph.facebook.com/v18.0").rstrip("/")
+
+# ---------------------------------------------------------
+# CICLO DI VITA (lifespan)
+# ---------------------------------------------------------
+# Prima del bind: controllo schema e purger. Il resto (pool DB, catalogo
+# zone, render PDF di prova, SMTP/HTTP) lo fa warmup() in un thread, mentre
+# il server risponde già: /readyz resta 503 finché non ha finito.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    controlla_schema()
+    regole.avvia()   # coefficienti del motore prima della prima stima
+    purger.avvia()
+    comparabili.avvia()
+    shadow.avvia()
+    threading.Thread(target=warmup, name="warmup", daemon=True).start()
+    installa_sigterm()   # /readyz a 503 dal SIGTERM, non da qui
+    try:
+        yield
+    finally:
+        # qui uvicorn ha già smesso di accettare connessioni e finito le
+        # richieste in corso: serve solo a chi chiama l'app senza segnali
+        in_chiusura.set()
+        purger.chiudi()
+        comparabili.chiudi()
+        shadow.chiudi()   # scrive gli ultimi confronti prima di chiudere il pool
+        regole.chiudi()
+        pdf_worker.chiudi()
+        database.chiudi_pool()
+        tracing.chiudi()   # per ultimo: esporta anche gli span della chiusura
 
 # ---------------------------------------------------------
 # APP & CORS
 # ---------------------------------------------------------
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -46,6 +99,212 @@ app.add_middleware(
 # Static (PDF)
 app.mount("/reports", StaticFiles(directory=str(REPORTS_DIR)), name="reports")
 
+# ---------------------------------------------------------
+# METRICHE (Prometheus)
+# ---------------------------------------------------------
+# RED per ogni route: la label è il template ("/api/admin/stime/{stima_id}/update"),
+# non il path reale, così la cardinalità resta fissa
+@app.middleware("http")
+async def metriche_http(request: Request, call_next):
+    t0 = time.perf_counter()
+    metrics.HTTP_IN_CORSO.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.HTTP_IN_CORSO.dec()
+        route = request.scope.get("route")
+        path = getattr(route, "path", None) or "non_trovata"
+        metrics.HTTP_RICHIESTE.inc(method=request.method, route=path, status=status)
+        metrics.HTTP_DURATA.observe(time.perf_counter() - t0,
+                                    method=request.method, route=path)
+
+# ---------------------------------------------------------
+# TRACING (span per richiesta, DB e HTTP in uscita; vedi tracing.py)
+# ---------------------------------------------------------
+# registrato prima di contesto_richiesta, quindi gira al suo interno
+# e trova già il request_id
+app.middleware("http")(tracing.middleware)
+tracing.instrumenta_http()
+
+# ---------------------------------------------------------
+# CONTESTO RICHIESTA (request_id nei log)
+# ---------------------------------------------------------
+# X-Request-ID dal proxy se c'è, altrimenti generato; torna nella risposta
+@app.middleware("http")
+async def contesto_richiesta(request: Request, call_next):
+    rid = (request.headers.get("x-request-id") or uuid.uuid4().hex)[:64]
+    t0 = time.perf_counter()
+    with log.contesto(request_id=rid, lead_id=None):
+        try:
+            response = await call_next(request)
+        except Exception:
+            logger.exception("richiesta fallita",
+                             extra={"method": request.method, "path": request.url.path})
+            raise
+        response.headers["X-Request-ID"] = rid
+        logger.info("richiesta", extra={
+            "campione": True,
+            "method": request.method,
+            "path": request.url.path,
+            "status": response.status_code,
+            "durata_ms": round((time.perf_counter() - t0) * 1000, 1),
+        })
+        return response
+
+# Profiler on demand (vedi profiler.py): middleware ASGI puro,
+# da spento non aggiunge nulla alla richiesta
+app.add_middleware(profiler.MiddlewareASGI)
+
+@app.get("/metrics")
+def metriche():
+    return Response(metrics.esporta(), media_type=metrics.CONTENT_TYPE)
+
+# Controllo schema all'avvio: il deploy NON fa DDL (si usa migrations.py),
+# ma si rifiuta di partire se il DB non è alla versione attesa.
+#   SCHEMA_CHECK=strict (default) → errore e avvio bloccato
+#   SCHEMA_CHECK=warn             → solo log
+#   SCHEMA_CHECK=off              → nessun controllo (sviluppo senza DB)
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "strict").lower()
+
+def controlla_schema():
+    if SCHEMA_CHECK == "off":
+        return
+    problemi = verifica_schema()
+    for p in problemi:
+        logger.warning("schema non allineato", extra={"problema": p})
+    if problemi and SCHEMA_CHECK == "strict":
+        raise RuntimeError(
+            "Schema DB non allineato al codice: eseguire `python migrations.py`"
+        )
+
+# Warmup dopo il bind. Il lifespan gira PRIMA che uvicorn apra la porta:
+# lì parte solo il thread, e i moduli pesanti (requests, psycopg2,
+# smtplib/email), il pool DB, il catalogo zone e i render PDF si preparano
+# mentre il server risponde già. Chi arriva prima fa tutto al primo uso.
+# (verifica_avvio.py controlla che `import main` resti leggero)
+warmup_completato = threading.Event()
+in_chiusura = threading.Event()
+
+# Secondi tra il SIGTERM (/readyz già a 503) e l'inizio della chiusura di
+# uvicorn: per un deploy senza errori almeno un intervallo di health check
+# del bilanciatore, così smette di mandarci traffico prima che il socket chiuda
+CHIUSURA_ATTESA_S = float(os.getenv("CHIUSURA_ATTESA_S", "0"))
+
+
+def installa_sigterm():
+    """Davanti al gestore di uvicorn: al SIGTERM segna in_chiusura, poi
+    (dopo CHIUSURA_ATTESA_S) passa il segnale a uvicorn."""
+    if threading.current_thread() is not threading.main_thread():
+        return   # i segnali si gestiscono solo dal thread principale
+    precedente = signal.getsignal(signal.SIGTERM)
+
+    def inoltra(signum, frame):
+        if callable(precedente):
+            precedente(signum, frame)
+        elif precedente != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def gestore(signum, frame):
+        if in_chiusura.is_set():
+            return   # secondo SIGTERM durante l'attesa: già in corso
+        in_chiusura.set()
+        logger.info("SIGTERM: readyz a 503", extra={"attesa_s": CHIUSURA_ATTESA_S})
+        if CHIUSURA_ATTESA_S > 0:
+            t = threading.Timer(CHIUSURA_ATTESA_S, inoltra, (signum, frame))
+            t.daemon = True
+            t.start()
+        else:
+            inoltra(signum, frame)
+
+    signal.signal(signal.SIGTERM, gestore)
+
+# Esito dei passi di warmup; quelli in PRONTEZZA decidono /readyz
+stato_avvio = {"db": False, "catalogo": False, "pdf": False, "http": False,
+               "smtp": None, "comparabili": None, "geocoder": None,
+               "microzone": None, "costa": None}
+PRONTEZZA = ("db", "catalogo", "pdf", "http")
+
+def _passo(nome: str, funzione):
+    t0 = time.perf_counter()
+    try:
+        esito = funzione()
+        stato_avvio[nome] = True if esito is None else bool(esito)
+    except Exception:
+        stato_avvio[nome] = False
+        logger.exception("warmup fallito", extra={"passo": nome})
+    logger.info("warmup", extra={
+        "passo": nome, "ok": stato_avvio[nome],
+        "durata_ms": round((time.perf_counter() - t0) * 1000, 1),
+    })
+
+def _warmup_pdf():
+    # i worker fanno un render di prova nel loro initializer
+    if pdf_worker.PDF_WORKERS > 0:
+        pdf_worker.avvia()
+    else:
+        import pdf_report
+        pdf_report.warmup()
+
+def warmup():
+    t0 = time.perf_counter()
+    try:
+        _passo("db", lambda: database.apri_pool())
+        _passo("catalogo", carica_catalogo_zone)
+        # se fallisce ci riprova il thread di comparabili.py
+        _passo("comparabili", comparabili.aggiorna)
+        # False = stradario assente: si lavora sul testo della via
+        _passo("geocoder", geocoder.carica)
+        _passo("microzone", microzone.carica)
+        _passo("costa", costa.carica)
+        _passo("http", sessione_http)
+        _passo("smtp", database.verifica_smtp)
+        _passo("pdf", _warmup_pdf)
+    finally:
+        warmup_completato.set()
+        logger.info("warmup completato", extra={
+            **stato_avvio, "durata_ms": round((time.perf_counter() - t0) * 1000, 1),
+        })
+
+# Liveness: il processo risponde (nessuna dipendenza esterna)
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+# Readiness: warmup finito, DB raggiungibile, non in chiusura.
+# DB e catalogo si riprovano qui se al boot il DB non c'era.
+@app.get("/readyz")
+def readyz():
+    controlli = dict(stato_avvio)
+    try:
+        conn = get_connection(); cur = conn.cursor()
+        try:
+            cur.execute("SELECT 1")
+            cur.fetchone()
+        finally:
+            cur.close(); conn.close()
+        controlli["db"] = stato_avvio["db"] = True
+        if not stato_avvio["catalogo"]:
+            _passo("catalogo", carica_catalogo_zone)
+            controlli["catalogo"] = stato_avvio["catalogo"]
+    except Exception as e:
+        controlli["db"] = False
+        logger.warning("readyz: DB non raggiungibile", extra={"errore": str(e)})
+
+    pronto = (
+        warmup_completato.is_set()
+        and not in_chiusura.is_set()
+        and all(controlli[k] for k in PRONTEZZA)
+    )
+    return JSONResponse(
+        {"pronto": pronto, "warmup_completato": warmup_completato.is_set(),
+         "in_chiusura": in_chiusura.is_set(), "controlli": controlli},
+        status_code=200 if pronto else 503,
+    )
+
 # ---------------------------------------------------------
 # UTILS
 # ---------------------------------------------------------
@@ -59,29 +318,45 @@ def normalizza_numero_whatsapp(raw: str | None) -> str | None:
         return s
     return "39" + s.lstrip("0")
     
-def invia_whatsapp(numero: str | None, p1: str, p2: str, p3: str):
-    print("WA URL:", WHATSAPP_SERVICE_URL)
-    print("WA raw telefono:", repr(numero))
+# Sessione HTTP condivisa (keep-alive verso relay WhatsApp e Graph API),
+# creata nel warmup
+_sessione = None
+_lock_sessione = threading.Lock()
+
+def sessione_http():
+    global _sessione
+    with _lock_sessione:
+        if _sessione is None:
+            import requests
+            _sessione = requests.Session()
+        return _sessione
 
+def invia_whatsapp(numero: str | None, p1: str, p2: str, p3: str):
     dest = normalizza_numero_whatsapp(numero)
-    print("WA dest:", repr(dest))
+    logger.info("whatsapp invio", extra={
+        "campione": True, "url": WHATSAPP_SERVICE_URL,
+        "telefono_raw": numero, "dest": dest,
+    })
 
     if not dest:
-        print("WA SKIP: numero non valido")
+        logger.warning("whatsapp saltato: numero non valido", extra={"telefono_raw": numero})
         return
 
     try:
-        r = requests.post(
-            WHATSAPP_SERVICE_URL,
-            json={"to": dest, "p1": p1, "p2": p2, "p3": p3},
-            timeout=10
-        )
-        print("WA HTTP:", r.status_code, r.text[:200])
-
+        with metrics.misura("whatsapp", integrazione="whatsapp"), tracing.span("invia_whatsapp"):
+            r = sessione_http().post(
+                WHATSAPP_SERVICE_URL,
+                json={"to": dest, "p1": p1, "p2": p2, "p3": p3},
+                timeout=10
+            )
         if r.status_code >= 300:
-            print("WA ERROR:", r.status_code, r.text)
-    except Exception as e:
-        print("WA EXC:", e)
+            metrics.ERRORI.inc(integrazione="whatsapp")
+            logger.error("whatsapp errore HTTP",
+                         extra={"status": r.status_code, "body": r.text[:500]})
+        else:
+            logger.info("whatsapp inviato", extra={"status": r.status_code})
+    except Exception:
+        logger.exception("whatsapp eccezione")
 
 
 def to_int(v): 
@@ -107,10 +382,13 @@ def web_to_fs(path: str) -> str:
     return str((REPORTS_DIR / name).resolve())
 
 def normalizza_comune(v: str | None) -> str | None:
-    if not v:
-        return None
-    v = " ".join(w.capitalize() for w in v.replace("_", " ").split())
-    return v if v in {"Alba Adriatica", "Martinsicuro", "Tortoreto"} else None
+    # solo i comuni del listino (valuation.BASE_MQ), col nome canonico
+    return comune_canonico(v) if v else None
+
+def etag_corrisponde(request: Request, etag: str) -> bool:
+    """If-None-Match contiene l'ETag (anche come lista o in forma debole W/)."""
+    richiesti = request.headers.get("if-none-match") or ""
+    return any(t.strip().removeprefix("W/") in (etag, "*") for t in richiesti.split(","))
 # ---------------------------------------------------------
 # ADMIN GATE — ACCESSO RISERVATO (HTML)
 # ---------------------------------------------------------    
@@ -133,15 +411,88 @@ def admin_check(data: dict):
 
     raise HTTPException(status_code=401, detail="Unauthorized")
 
+# HTTP Basic con le stesse credenziali, per gli endpoint admin usati da script
+security = HTTPBasic()
+
+def verifica_admin(credenziali: HTTPBasicCredentials = Depends(security)):
+    admin_user = os.getenv("ADMIN_USER")
+    admin_pass = os.getenv("ADMIN_PASS")
+
+    if not admin_user or not admin_pass:
+        raise HTTPException(
+            status_code=500,
+            detail="ADMIN credentials not set on server"
+        )
+
+    utente_ok = secrets.compare_digest(credenziali.username.encode(), admin_user.encode())
+    pass_ok = secrets.compare_digest(credenziali.password.encode(), admin_pass.encode())
+    if not (utente_ok and pass_ok):
+        raise HTTPException(
+            status_code=401,
+            detail="Unauthorized",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+
 # ---------------------------------------------------------
-# ADMIN WHATSAPP — MESSAGGI (INBOX)
+# ADMIN PROFILER — PROFILO A CAMPIONAMENTO ON DEMAND
 # ---------------------------------------------------------
-@app.get("/api/admin/whatsapp/messages")
-def admin_whatsapp_messages():
-    conn = get_connection()
-    cur = conn.cursor()
+# Per N secondi (tutto il processo) oppure per le prossime N richieste
+# di una route (?route=/api/salva_stima). Risponde a profilo finito con
+# il flame graph: formato=svg, oppure folded (py-spy raw / speedscope).
+@app.post("/api/admin/profiler")
+async def admin_profiler(
+    secondi: float = 10,
+    route: str | None = None,
+    richieste: int = 20,
+    timeout: float = 120,
+    intervallo_ms: float = 5,
+    formato: str = "svg",
+    idle: bool = False,
+    _admin: None = Depends(verifica_admin),
+):
+    if formato not in ("svg", "folded"):
+        raise HTTPException(status_code=400, detail="formato: svg o folded")
+    if not 0 < secondi <= 300 or not 0 < timeout <= 600 or not 1 <= richieste <= 1000:
+        raise HTTPException(status_code=400, detail="Limiti: secondi ≤ 300, timeout ≤ 600, richieste ≤ 1000")
 
-    cur.execute("""
+    route_obj = None
+    if route:
+        route_obj = next((r for r in app.routes if getattr(r, "path", None) == route), None)
+        if route_obj is None:
+            raise HTTPException(status_code=404, detail=f"Route {route} inesistente")
+
+    try:
+        p = profiler.avvia(secondi, route_obj, richieste, intervallo_ms / 1000, idle)
+    except profiler.ProfiloInCorso:
+        raise HTTPException(status_code=409, detail="Profilo già in corso")
+
+    try:
+        await asyncio.to_thread(p.attendi, timeout)
+    finally:
+        profiler.chiudi(p)
+
+    stato = p.stato()
+    logger.info("profilo completato", extra=stato)
+    intestazioni = {
+        "X-Profilo-Campioni": str(stato["campioni"]),
+        "X-Profilo-Durata": str(stato["durata_s"]),
+    }
+    if route_obj is not None:
+        intestazioni["X-Profilo-Richieste"] = str(stato["richieste"])
+    nome = f"profilo_{datetime.now():%Y%m%d_%H%M%S}"
+    if formato == "folded":
+        intestazioni["Content-Disposition"] = f'attachment; filename="{nome}.folded"'
+        return Response(profiler.folded(p.pile), media_type="text/plain", headers=intestazioni)
+    titolo = f"stima360 {route or 'processo'} — {stato['durata_s']}s"
+    intestazioni["Content-Disposition"] = f'inline; filename="{nome}.svg"'
+    return Response(profiler.svg(p.pile, titolo), media_type="image/svg+xml", headers=intestazioni)
+
+# ---------------------------------------------------------
+# ADMIN WHATSAPP — MESSAGGI (INBOX)
+# ---------------------------------------------------------
+# Per ogni messaggio, l'ultima stima con lo stesso numero normalizzato:
+# lookup puntuale su idx_stime_telefono_norm (telefono_norm è in migrations.py)
+SQL_WHATSAPP_MESSAGES = """
     SELECT
         wi.from_number,
         wi.text,
@@ -151,37 +502,29 @@ def admin_whatsapp_messages():
         s.cognome,
         s.id AS stima_id
     FROM whatsapp_incoming wi
-    LEFT JOIN (
-        SELECT DISTINCT ON (telefono_norm)
-            telefono_norm,
-            nome,
-            cognome,
-            id
-        FROM (
-            SELECT
-                id,
-                nome,
-                cognome,
-                CASE
-                    WHEN regexp_replace(telefono, '\D', '', 'g') LIKE '39%'
-                        THEN regexp_replace(telefono, '\D', '', 'g')
-                    ELSE '39' || regexp_replace(telefono, '\D', '', 'g')
-                END AS telefono_norm
-            FROM stime
-            WHERE telefono IS NOT NULL
-        ) t
-        ORDER BY telefono_norm, id DESC
-    ) s
-    ON s.telefono_norm = (
-        CASE
-            WHEN regexp_replace(wi.from_number, '\D', '', 'g') LIKE '39%'
-                THEN regexp_replace(wi.from_number, '\D', '', 'g')
-            ELSE '39' || regexp_replace(wi.from_number, '\D', '', 'g')
-        END
-    )
-    ORDER BY wi.received_at ASC;
+    LEFT JOIN LATERAL (
+        SELECT id, nome, cognome
+        FROM stime
+        WHERE telefono IS NOT NULL
+          AND telefono_norm(telefono) = telefono_norm(wi.from_number)
+          AND deleted_at IS NULL
+        ORDER BY id DESC
+        LIMIT 1
+    ) s ON TRUE
+    {where}
+    ORDER BY wi.received_at ASC
+"""
+
+@app.get("/api/admin/whatsapp/messages")
+def admin_whatsapp_messages(dal: date | None = None):
+    conn = get_connection()
+    cur = conn.cursor()
 
-    """)
+    if dal:
+        cur.execute(SQL_WHATSAPP_MESSAGES.format(where="WHERE wi.received_at >= %s"),
+                    (datetime.combine(dal, datetime.min.time()),))
+    else:
+        cur.execute(SQL_WHATSAPP_MESSAGES.format(where=""))
     rows = cur.fetchall()
     cols = [c[0] for c in cur.description]
     cur.close(); conn.close()
@@ -203,10 +546,14 @@ def admin_whatsapp_reply(data: dict):
 
     # 1️⃣ INVIO REALE WHATSAPP
     try:
-        r = invia_whatsapp_text(dest, text)
-        print("META SEND:", r.status_code, r.text)
-    except Exception as e:
-        print("WHATSAPP SEND ERROR:", e)
+        with metrics.misura("whatsapp", integrazione="whatsapp"), tracing.span("invia_whatsapp_text"):
+            r = invia_whatsapp_text(dest, text)
+        if r.status_code >= 300:
+            metrics.ERRORI.inc(integrazione="whatsapp")
+        logger.info("whatsapp risposta admin",
+                    extra={"status": r.status_code, "body": r.text[:500]})
+    except Exception:
+        logger.exception("whatsapp risposta admin: errore invio")
 
     # 2️⃣ SALVA NEL DB (STESSA TABELLA)
     conn = get_connection()
@@ -231,6 +578,17 @@ def admin_whatsapp_reply(data: dict):
 class DeleteRequest(BaseModel):
     ids: list[int]
 
+# Soft delete: le righe spariscono subito dalle API admin/prefill,
+# la cancellazione vera (e dei PDF) la fa purger.py a blocchi piccoli
+SQL_SOFT_DELETE_STIME = """
+    UPDATE stime SET deleted_at = NOW()
+    WHERE id = ANY(%s) AND deleted_at IS NULL
+"""
+SQL_SOFT_DELETE_DETTAGLIATE_DI_STIME = """
+    UPDATE stime_dettagliate SET deleted_at = NOW()
+    WHERE stima_id = ANY(%s) AND deleted_at IS NULL
+"""
+
 @app.post("/api/admin/stime/delete")
 def admin_delete_stime(payload: DeleteRequest):
 
@@ -240,12 +598,15 @@ def admin_delete_stime(payload: DeleteRequest):
 
     conn = get_connection(); cur = conn.cursor()
 
-    cur.execute("DELETE FROM stime_dettagliate WHERE stima_id = ANY(%s)", (ids,))
-    cur.execute("DELETE FROM stime WHERE id = ANY(%s)", (ids,))
+    cur.execute(SQL_SOFT_DELETE_STIME, (ids,))
+    eliminate = cur.rowcount
+    cur.execute(SQL_SOFT_DELETE_DETTAGLIATE_DI_STIME, (ids,))
     conn.commit()
 
     cur.close(); conn.close()
-    return {"ok": True, "deleted": len(ids)}
+    invalida_prefill(ids)
+    comparabili.rimuovi(ids)
+    return {"ok": True, "deleted": eliminate}
 # ---------------------------------------------------------
 # CANCELLA STIME DETTAGLIATE 
 # ---------------------------------------------------------
@@ -258,16 +619,148 @@ def admin_delete_stime_dettagliate(payload: DeleteRequest):
 
     conn = get_connection(); cur = conn.cursor()
 
-    # Cancella ESCLUSIVAMENTE le righe della tabella stime_dettagliate
-    cur.execute("DELETE FROM stime_dettagliate WHERE id = ANY(%s)", (ids,))
+    # Marca ESCLUSIVAMENTE le righe della tabella stime_dettagliate
+    cur.execute("""
+        UPDATE stime_dettagliate SET deleted_at = NOW()
+        WHERE id = ANY(%s) AND deleted_at IS NULL
+    """, (ids,))
+    eliminate = cur.rowcount
 
     conn.commit()
     cur.close(); conn.close()
 
-    return {"ok": True, "deleted": len(ids)}
+    return {"ok": True, "deleted": eliminate}
+# ---------------------------------------------------------
+# PURGE (cancellazione definitiva delle stime eliminate)
+# ---------------------------------------------------------
+@app.post("/api/admin/stime/purge")
+def admin_purge_stime(grace_min: int | None = None, _admin: None = Depends(verifica_admin)):
+    # gira nel threadpool: i blocchi sono brevi, i PDF si rimuovono dopo il commit
+    if grace_min is None:
+        return {"ok": True, **purger.purga()}
+    return {"ok": True, **purger.purga(grace_min=max(0, grace_min))}
+# ---------------------------------------------------------
+# MOTORI CANDIDATI IN OMBRA (shadow.py)
+# ---------------------------------------------------------
+@app.get("/api/admin/shadow")
+def admin_shadow(
+    candidato: str | None = None,
+    giorni: int = 7,
+    soglia_pct: float = shadow.SHADOW_SOGLIA_PCT,
+    _admin: None = Depends(verifica_admin),
+):
+    # drift del candidato rispetto al live, totale e per comune/microzona/tipologia
+    return {**shadow.stato(),
+            "riepilogo": shadow.riepilogo(candidato, max(1, giorni), max(0.0, soglia_pct))}
+
+@app.get("/api/admin/shadow/divergenze")
+def admin_shadow_divergenze(
+    candidato: str,
+    limite: int = 50,
+    _admin: None = Depends(verifica_admin),
+):
+    return {"candidato": candidato,
+            "divergenze": shadow.divergenze(candidato, min(max(1, limite), 500))}
+
+# ---------------------------------------------------------
+# REGOLE DEI COEFFICIENTI (regole.py)
+# ---------------------------------------------------------
+@app.get("/api/admin/regole")
+def admin_regole(_admin: None = Depends(verifica_admin)):
+    r = regole.attuali()
+    risposta = {**r.descrizione(), "sorgente": regole.REGOLE_SORGENTE,
+                "engine_version": versione_motore(r), "regole": r.dati}
+    if regole.REGOLE_SORGENTE == "db":
+        risposta["storico"] = regole.storico()
+    return risposta
+
+@app.post("/api/admin/regole")
+def admin_pubblica_regole(
+    dati: dict,
+    nota: str | None = None,
+    prova: bool = False,
+    _admin: None = Depends(verifica_admin),
+):
+    # prova=true: solo validazione e versione, niente scrittura
+    try:
+        if prova:
+            r = regole.compila(dati)
+            return {"ok": True, "versione": r.versione, "engine_version": versione_motore(r)}
+        if regole.REGOLE_SORGENTE != "db":
+            raise HTTPException(status_code=409, detail=f"Regole da {regole.REGOLE_SORGENTE}: REGOLE_SORGENTE=db per pubblicarle")
+        r = regole.pubblica(dati, nota)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except regole.ConflittoRegole as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    # gli altri worker la vedono al prossimo controllo (REGOLE_CONTROLLO_S)
+    return {"ok": True, "versione": r.versione, "engine_version": versione_motore(r)}
+
 # ---------------------------------------------------------
 # STIMA BASE
 # ---------------------------------------------------------    
+# ---------------------------------------------------------
+# CATALOGO ZONE (tendine del form)
+# ---------------------------------------------------------
+# Comuni e microzone dal listino del motore (valuation.BASE_MQ): il corpo
+# si genera una volta per CATALOG_VERSION, che cambia solo coi prezzi.
+# ETag = versione, quindi il browser tiene la copia e rivalida con un 304.
+ZONE_MAX_AGE = int(os.getenv("ZONE_MAX_AGE", "86400"))
+_zone_json: dict[str, bytes] = {}
+
+def _catalogo_json() -> bytes:
+    corpo = _zone_json.get(CATALOG_VERSION)
+    if corpo is None:
+        corpo = JSONResponse({
+            "catalog_version": CATALOG_VERSION,
+            "comuni": [
+                {"comune": comune,
+                 "microzone": [{"microzona": z, "base_mq": float(v)} for z, v in zone.items()]}
+                for comune, zone in BASE_MQ.items()
+            ],
+        }).body
+        _zone_json.clear()
+        _zone_json[CATALOG_VERSION] = corpo
+    return corpo
+
+@app.get("/api/zone")
+def api_zone(request: Request):
+    etag = f'"{CATALOG_VERSION}"'
+    intestazioni = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={ZONE_MAX_AGE}, stale-while-revalidate={ZONE_MAX_AGE * 7}",
+    }
+    if etag_corrisponde(request, etag):
+        return Response(status_code=304, headers=intestazioni)
+    return Response(_catalogo_json(), media_type="application/json", headers=intestazioni)
+
+# ---------------------------------------------------------
+# COMPARABILI (immobili simili già stimati, vedi comparabili.py)
+# ---------------------------------------------------------
+@app.get("/api/comparabili")
+def api_comparabili(
+    comune: str,
+    microzona: str | None = None,
+    tipologia: str | None = None,
+    mq: float | None = None,
+    anno: int | None = None,
+    posizioneMare: str | None = None,
+    distanzaMare: str | None = None,
+    vistaMare: str | None = None,
+    k: int = comparabili.COMPARABILI_K,
+):
+    if not mq or mq <= 0:
+        raise HTTPException(status_code=400, detail="Dati mancanti")
+    if not 1 <= k <= 20:
+        raise HTTPException(status_code=400, detail="k tra 1 e 20")
+
+    risultati = comparabili.cerca({
+        "comune": normalizza_comune(comune) or comune,
+        "microzona": microzona, "tipologia": tipologia, "mq": mq, "anno": anno,
+        "posizioneMare": posizioneMare, "distanzaMare": distanzaMare, "vistaMare": vistaMare,
+    }, k=k)
+    return {"comparabili": risultati, "indicizzate": comparabili.indicizzate()}
+
 @app.post("/api/stima_base")
 async def stima_base(request: Request):
     try:
@@ -281,6 +774,13 @@ async def stima_base(request: Request):
     anno      = raw.get("anno")
     tipologia = raw.get("tipologia")   # ✅
 
+    # con via/civico la microzona può arrivare dai confini (microzone.py)
+    if raw.get("via"):
+        posizione = {"comune": comune, "microzona": microzona,
+                     "via": raw.get("via"), "civico": raw.get("civico")}
+        localizza(posizione)
+        microzona = posizione["microzona"]
+
     if not comune or not microzona or not mq or not anno:
         raise HTTPException(status_code=400, detail="Dati mancanti")
 
@@ -311,21 +811,188 @@ async def stima_base(request: Request):
         
     }
 
+# Forchetta di prezzo e input che la muovono di più (sensibilita.py):
+# stesso payload del motore, tutte le combinazioni in un passaggio numpy
+@app.post("/api/stima_range")
+async def stima_range(request: Request):
+    try:
+        raw = await request.json()
+    except:
+        raise HTTPException(status_code=400, detail="Payload non valido")
+    if not isinstance(raw, dict):
+        raise HTTPException(status_code=400, detail="Payload non valido")
+
+    payload = dict(raw)
+    geo, _ = localizza(payload)
+    if geo and geo.get("distanza_mare_m") is not None:
+        payload["distanzaMareM"] = geo["distanza_mare_m"]
+    if not payload.get("comune") or not payload.get("microzona") or not to_float(payload.get("mq")):
+        raise HTTPException(status_code=400, detail="Dati mancanti")
+
+    with metrics.misura("valuation"), tracing.span("sensibilita"):
+        risultato = sensibilita.analizza(payload)
+    return {"success": True, "microzona": payload["microzona"], **risultato}
+
+# Superficie precalcolata per gli slider mq/anno del form: una sola
+# chiamata, poi il browser interpola tra i nodi (interpolazione lineare
+# esatta lungo mq e tra i punti della curva anno, salvo i gradini dei rustici).
+# La risposta dipende solo dal listino base: cache per CATALOG_VERSION.
+SUPERFICIE_MAX_NODI = 20000
+SUPERFICIE_TIPOLOGIE = "Appartamento,Villa,Rustico"
+_superfici = TTLCache(ttl=24 * 3600, maxsize=512)
+
+@app.get("/api/stima_base/superficie")
+def stima_base_superficie(
+    request: Request,
+    comune: str,
+    microzona: str,
+    mq_min: float = 20, mq_max: float = 400, mq_passo: float = 10,
+    anno_min: int = 1950, anno_max: int = 2025, anno_passo: int = 5,
+    tipologie: str = SUPERFICIE_TIPOLOGIE,
+):
+    if valuation_base.get_base_mq(comune, microzona) <= 0:
+        raise HTTPException(status_code=404, detail="Comune/microzona non in listino")
+    if not (0 < mq_min <= mq_max and mq_passo > 0 and anno_min <= anno_max and anno_passo > 0):
+        raise HTTPException(status_code=400, detail="Griglia non valida")
+    tip = tuple(dict.fromkeys(t.strip() for t in tipologie.split(",") if t.strip()))[:10]
+    n_mq = int((mq_max - mq_min) // mq_passo) + 1
+    n_anni = (anno_max - anno_min) // anno_passo + 1
+    if n_mq * n_anni * max(1, len(tip)) > SUPERFICIE_MAX_NODI:
+        raise HTTPException(status_code=400, detail=f"Griglia troppo grande (max {SUPERFICIE_MAX_NODI} nodi)")
+
+    chiave = (valuation_base.CATALOG_VERSION, comune, microzona,
+              mq_min, mq_max, mq_passo, anno_min, anno_max, anno_passo, tip)
+    etag = f'"{valuation_base.CATALOG_VERSION}-{uuid.uuid5(uuid.NAMESPACE_URL, repr(chiave)).hex[:12]}"'
+    intestazioni = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if etag_corrisponde(request, etag):
+        return Response(status_code=304, headers=intestazioni)
+
+    corpo = _superfici.get(chiave)
+    if corpo is MANCANTE:
+        griglia_mq = [round(mq_min + i * mq_passo, 2) for i in range(n_mq)]
+        griglia_anni = [anno_min + i * anno_passo for i in range(n_anni)]
+        with metrics.misura("valuation"), tracing.span("superficie_base"):
+            valori = valuation_base.superficie_base(comune, microzona, griglia_mq, griglia_anni, tip)
+        corpo = JSONResponse({
+            "comune": comune,
+            "microzona": microzona,
+            "catalog_version": valuation_base.CATALOG_VERSION,
+            "base_mq": valuation_base.get_base_mq(comune, microzona),
+            "mq": griglia_mq,
+            "anni": griglia_anni,
+            # righe = anni, colonne = mq
+            "tipologie": {
+                t: {k: m.astype(int).tolist() for k, m in v.items()}
+                for t, v in valori.items()
+            },
+        }).body
+        _superfici.set(chiave, corpo)
+    return Response(corpo, media_type="application/json", headers=intestazioni)
+
+
+# ---------------------------------------------------------
+# POSIZIONE (geocoder.py + microzone.py + costa.py)
+# ---------------------------------------------------------
+def localizza(data: dict) -> tuple[dict | None, str | None]:
+    """
+    Geocodifica via/civico e, se il punto cade in una zona del catalogo,
+    imposta data["microzona"] dai confini (vince sul valore del form).
+    Con la linea di costa aggiunge geo["distanza_mare_m"].
+    Restituisce (geo o None, microzona arrivata dal form).
+    """
+    microzona_form = data.get("microzona")
+    try:
+        with tracing.span("geocoder"):
+            geo = geocoder.geocodifica(data.get("via"), data.get("civico"), data.get("comune"))
+            # solo zone del comune indicato: mai la microzona di un comune vicino
+            comune = normalizza_comune(data.get("comune"))
+            zona = microzone.trova(geo["lat"], geo["lon"], comune) if geo and comune else None
+            if geo:
+                geo["distanza_mare_m"] = costa.distanza_m(geo["lat"], geo["lon"])
+    except Exception:
+        logger.exception("geocoding fallito")
+        return None, microzona_form
+    if zona is not None and zona[0] == comune:
+        if microzona_form and zona[1] != microzona_form:
+            logger.info("microzona corretta dai confini", extra={
+                "comune": data.get("comune"), "form": microzona_form, "confini": zona[1],
+            })
+        data["microzona"] = zona[1]
+    return geo, microzona_form
+
 
 # ---------------------------------------------------------
 # ENDPOINT: SALVA STIMA
 # ---------------------------------------------------------
+SQL_PREZZO_ZONA = """
+    SELECT prezzo_mq_base FROM zone_valori
+    WHERE comune=%s AND microzona=%s LIMIT 1
+"""
+SQL_CATALOGO_ZONE = "SELECT comune, microzona, prezzo_mq_base FROM zone_valori"
+
+# Catalogo prezzi di zona in memoria: caricato per intero nel warmup,
+# riletto dal DB solo a scadenza o per zone non ancora viste
+ZONE_CACHE_TTL = float(os.getenv("ZONE_CACHE_TTL", "600"))
+_catalogo_zone = TTLCache(ttl=ZONE_CACHE_TTL, maxsize=4096)
+
+def carica_catalogo_zone() -> int:
+    conn = get_connection(); cur = conn.cursor()
+    try:
+        cur.execute(SQL_CATALOGO_ZONE)
+        righe = cur.fetchall()
+    finally:
+        cur.close(); conn.close()
+    for comune, microzona, prezzo in righe:
+        _catalogo_zone.set((comune, microzona), float(prezzo) if prezzo is not None else 0.0)
+    return len(righe)
+
+def prezzo_zona(comune: str, microzona: str) -> float:
+    chiave = (comune, microzona)
+    prezzo = _catalogo_zone.get(chiave)
+    if prezzo is MANCANTE:
+        with metrics.misura("db", integrazione="db"):
+            conn = get_connection(); cur = conn.cursor()
+            try:
+                cur.execute(SQL_PREZZO_ZONA, chiave)
+                row = cur.fetchone()
+            finally:
+                cur.close(); conn.close()
+        prezzo = float(row[0]) if row and row[0] is not None else 0.0
+        _catalogo_zone.set(chiave, prezzo)
+    return prezzo
+
 @app.post("/api/salva_stima")
 async def salva_stima(request: Request):
+    # Backpressure: se la coda PDF è piena rifiutiamo PRIMA di scrivere sul DB
+    try:
+        prenotazione = pdf_worker.prenota()
+    except pdf_worker.CodaPdfPiena:
+        raise HTTPException(
+            status_code=503,
+            detail="Servizio momentaneamente occupato, riprova tra poco",
+            headers={"Retry-After": str(pdf_worker.PDF_RETRY_AFTER)},
+        )
 
-    # --- 1. Leggi body ---
     try:
-        if "application/json" in (request.headers.get("content-type") or ""):
-            raw = await request.json()
-        else:
-            raw = dict(await request.form())
-    except:
-        raw = {}
+        return await _salva_stima(request, prenotazione)
+    finally:
+        # consegnata a pdf_worker.genera_pdf: la rilascia lui a render finito,
+        # anche se la richiesta è stata annullata nel frattempo
+        if not prenotazione.consegnata:
+            prenotazione.rilascia()
+
+
+async def _salva_stima(request: Request, prenotazione: pdf_worker.Prenotazione):
+
+    # --- 1. Leggi body ---
+    with tracing.span("salva_stima.parse"):
+        try:
+            if "application/json" in (request.headers.get("content-type") or ""):
+                raw = await request.json()
+            else:
+                raw = dict(await request.form())
+        except:
+            raw = {}
     # --------------------------
     # CONSENSO MARKETING (GDPR)
     # --------------------------
@@ -372,45 +1039,50 @@ async def salva_stima(request: Request):
         "altroDescrizione": raw.get("altroDescrizione"),
     }
 
-    # --- 3. Se €mq base non presente → leggi DB ---
-    if not data["prezzo_mq_base"]:
+    # --- 3. Posizione: coordinate e microzona dai confini se l'indirizzo è noto ---
+    geo, microzona_form = localizza(data)
+    data["distanzaMareM"] = geo["distanza_mare_m"] if geo else None
+    if data["distanzaMareM"] is not None and not data["distanzaMare"]:
+        data["distanzaMare"] = costa.fascia(data["distanzaMareM"])
+
+    # --- 3b. Se €mq base non presente (o microzona cambiata) → leggi DB ---
+    if not data["prezzo_mq_base"] or data["microzona"] != microzona_form:
         try:
-            conn = get_connection(); cur = conn.cursor()
-            cur.execute("""
-                SELECT prezzo_mq_base FROM zone_valori
-                WHERE comune=%s AND microzona=%s LIMIT 1
-            """, (data["comune"], data["microzona"]))
-            row = cur.fetchone()
-            data["prezzo_mq_base"] = float(row[0]) if row else 0.0
+            with tracing.span("salva_stima.zona"):
+                data["prezzo_mq_base"] = prezzo_zona(data["comune"], data["microzona"])
         except:
             data["prezzo_mq_base"] = 0.0
-        finally:
-            try: cur.close(); conn.close()
-            except: pass
 
     # --- 4. Salva stima base ---
+    t_db = time.perf_counter()
     conn = get_connection(); cur = conn.cursor()
     try:
         comune_db = normalizza_comune(data["comune"]) or data["comune"]
     
-        cur.execute("""
-             INSERT INTO stime
-             (comune, microzona, fascia_mare, via, civico, tipologia, mq, piano, locali,
-              bagni, pertinenze, ascensore, nome, cognome, email, telefono,
-              consenso_marketing, consenso_marketing_at)
-              VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-              RETURNING id
-        """, (
-            comune_db, data["microzona"], data["fascia_mare"],
-            data["via"], data["civico"], data["tipologia"],
-            data["mq"], data["piano"], data["locali"], data["bagni"],
-            data["pertinenze"], data["ascensore"],
-            data["nome"], data["cognome"], data["email"], data["telefono"],
-            consenso_marketing, consenso_marketing_at
-        ))
-        new_id = cur.fetchone()[0]
+        with tracing.span("salva_stima.insert"):
+            cur.execute("""
+                 INSERT INTO stime
+                 (comune, microzona, fascia_mare, via, civico, tipologia, mq, piano, locali,
+                  bagni, pertinenze, ascensore, nome, cognome, email, telefono,
+                  consenso_marketing, consenso_marketing_at, lat, lon, geo_precisione,
+                  distanza_mare_m)
+                  VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                  RETURNING id
+            """, (
+                comune_db, data["microzona"], data["fascia_mare"],
+                data["via"], data["civico"], data["tipologia"],
+                data["mq"], data["piano"], data["locali"], data["bagni"],
+                data["pertinenze"], data["ascensore"],
+                data["nome"], data["cognome"], data["email"], data["telefono"],
+                consenso_marketing, consenso_marketing_at,
+                geo["lat"] if geo else None, geo["lon"] if geo else None,
+                geo["precisione"] if geo else None, data["distanzaMareM"],
+            ))
+            new_id = cur.fetchone()[0]
         conn.commit()
+        log.imposta(lead_id=new_id)
     except Exception as e:
+        metrics.ERRORI.inc(integrazione="db")
         raise HTTPException(status_code=500, detail=f"Errore INSERT DB: {e}")
     finally:
         try: cur.close(); conn.close()
@@ -418,73 +1090,75 @@ async def salva_stima(request: Request):
 
 
     # --- 5. TOKEN e prezzo base ---
-    conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-    UPDATE stime SET
-      anno=%s,
-      stato=%s,
+    with tracing.span("salva_stima.update"):
+        conn = get_connection(); cur = conn.cursor()
+        cur.execute("""
+        UPDATE stime SET
+          anno=%s,
+          stato=%s,
     
-      posizionemare=%s,
-      distanzamare=%s,
-      barrieramare=%s,
+          posizionemare=%s,
+          distanzamare=%s,
+          barrieramare=%s,
     
-      vistamareyn=%s,
-      vistamaredettaglio=%s,
-      vistamare=%s,
+          vistamareyn=%s,
+          vistamaredettaglio=%s,
+          vistamare=%s,
     
-      mqgiardino=%s,
-      mqgarage=%s,
-      mqcantina=%s,
-      mqpostoauto=%s,
-      mqtaverna=%s,
-      mqsoffitta=%s,
-      mqterrazzo=%s,
-      numbalconi=%s,
+          mqgiardino=%s,
+          mqgarage=%s,
+          mqcantina=%s,
+          mqpostoauto=%s,
+          mqtaverna=%s,
+          mqsoffitta=%s,
+          mqterrazzo=%s,
+          numbalconi=%s,
     
-      altrodescrizione=%s
-    WHERE id=%s
-    """, (
-      data["anno"],
-      data["stato"],
+          altrodescrizione=%s
+        WHERE id=%s
+        """, (
+          data["anno"],
+          data["stato"],
     
-      data["posizioneMare"],
-      data["distanzaMare"],
-      data["barrieraMare"],
+          data["posizioneMare"],
+          data["distanzaMare"],
+          data["barrieraMare"],
     
-      data["vistaMareYN"],
-      data["vistaMareDettaglio"],
-      data["vistaMare"],
+          data["vistaMareYN"],
+          data["vistaMareDettaglio"],
+          data["vistaMare"],
     
-      to_int(data["mqGiardino"]),
-      to_int(data["mqGarage"]),
-      to_int(data["mqCantina"]),
-      to_int(data["mqPostoAuto"]),
-      to_int(data["mqTaverna"]),
-      to_int(data["mqSoffitta"]),
-      to_int(data["mqTerrazzo"]),
-      to_int(data["numBalconi"]),
+          to_int(data["mqGiardino"]),
+          to_int(data["mqGarage"]),
+          to_int(data["mqCantina"]),
+          to_int(data["mqPostoAuto"]),
+          to_int(data["mqTaverna"]),
+          to_int(data["mqSoffitta"]),
+          to_int(data["mqTerrazzo"]),
+          to_int(data["numBalconi"]),
     
-      data["altroDescrizione"],
-      new_id
-    ))
-    conn.commit()
-    cur.close(); conn.close()
+          data["altroDescrizione"],
+          new_id
+        ))
+        conn.commit()
+        cur.close(); conn.close()
     
-    token = str(uuid.uuid4())
-    expires = datetime.now(timezone.utc) + timedelta(days=7)
+        token = str(uuid.uuid4())
+        expires = datetime.now(timezone.utc) + timedelta(days=7)
 
-    conn = get_connection(); cur = conn.cursor()
-    try:
-        cur.execute("""
-            UPDATE stime SET token=%s, token_expires=%s, prezzo_mq_base=%s
-            WHERE id=%s
-        """, (token, expires, data["prezzo_mq_base"], new_id))
-        conn.commit()
-    except:
-        pass
-    finally:
-        try: cur.close(); conn.close()
-        except: pass
+        conn = get_connection(); cur = conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE stime SET token=%s, token_expires=%s, prezzo_mq_base=%s
+                WHERE id=%s
+            """, (token, expires, data["prezzo_mq_base"], new_id))
+            conn.commit()
+        except:
+            metrics.ERRORI.inc(integrazione="db")
+        finally:
+            try: cur.close(); conn.close()
+            except: pass
+    metrics.STAGE_DURATA.observe(time.perf_counter() - t_db, stage="db")
     link_token = f"https://www.stima360.it/stima_dettagliata.html?token={token}"
       # --- 6. Stima completa (engine ufficiale) ---
     # Usa i valori "grezzi" del form dove serve (es. locali in testo)
@@ -511,6 +1185,7 @@ async def salva_stima(request: Request):
         # Mare
         "posizioneMare": data["posizioneMare"],
         "distanzaMare":  data["distanzaMare"],
+        "distanzaMareM": data["distanzaMareM"],
         "barrieraMare":  data["barrieraMare"],
 
         # 👇 passa TUTTI i campi vista che valuation.py sa usare
@@ -530,17 +1205,40 @@ async def salva_stima(request: Request):
         "numBalconi":  data["numBalconi"],
 
         # 👇 nuovi coefficienti che abbiamo aggiunto nel motore
-        "via":              data["via"],
+        # via canonica dello stradario se riconosciuta (refusi, abbreviazioni)
+        "via":              geo["via"] if geo else data["via"],
         "altroDescrizione": data["altroDescrizione"],
     }
 
-    calc = compute_from_payload(payload_rules)
+    # regole lette una volta: prezzo ed engine_version salvato sono coerenti
+    regole_stima = regole.attuali()
+    with metrics.misura("valuation"), tracing.span("compute_from_payload"):
+        calc = compute_from_payload(payload_rules, regole_stima)
+    # motori candidati in ombra: solo un put_nowait, il calcolo è nel thread di shadow.py
+    shadow.invia(new_id, payload_rules, calc, versione_motore(regole_stima))
 
     price_exact = calc["price_exact"]
     eur_mq_finale = calc["eur_mq_finale"]
     valore_pertinenze = calc["valore_pertinenze"]
     base_mq = calc["base_mq"]
 
+    # Comparabili per il PDF (indice in memoria, comparabili.py)
+    payload_comparabili = {**payload_rules, "comune": normalizza_comune(data["comune"]) or data["comune"]}
+    try:
+        with tracing.span("comparabili"):
+            lista_comparabili = comparabili.cerca(payload_comparabili, escludi=new_id)
+    except Exception:
+        logger.exception("ricerca comparabili fallita")
+        lista_comparabili = []
+
+    # Salva i numeri calcolati sulla riga (report/analisi senza ricalcolo)
+    try:
+        with metrics.misura("db", integrazione="db"), tracing.span("salva_valori_calcolati"):
+            salva_valori_calcolati(new_id, calc, versione_motore(regole_stima), CATALOG_VERSION)
+        comparabili.aggiungi(new_id, payload_comparabili, eur_mq_finale)
+    except Exception:
+        logger.exception("salvataggio valori calcolati fallito")
+
     indirizzo = format_indirizzo(data["via"], data["civico"], data["comune"])
     
     # --- Vista mare finale per PDF ---
@@ -548,9 +1246,9 @@ async def salva_stima(request: Request):
     if data.get("vistaMareYN") and str(data["vistaMareYN"]).lower() in {"si","sì","yes","true","1"}:
         vista_mare_finale = data.get("vistaMareDettaglio") or "Sì"
 
-    # --- 7. PDF ---
+    # --- 7. PDF (render nel pool di processi) ---
     try:
-        pdf_web_path = genera_pdf_stima({
+        pdf_web_path = await pdf_worker.genera_pdf({
             "id_stima": new_id,
         
             # CLIENTE
@@ -589,8 +1287,11 @@ async def salva_stima(request: Request):
             "eur_mq_finale": eur_mq_finale,
             "valore_pertinenze": valore_pertinenze,
             "base_mq": base_mq,
+
+            # COMPARABILI (grafico €/mq)
+            "comparabili": lista_comparabili,
         
-        }, nome_file=f"stima_{new_id}.pdf")
+        }, f"stima_{new_id}.pdf", prenotazione)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore PDF: {e}")
@@ -707,10 +1408,13 @@ async def salva_stima(request: Request):
         </div>
         """
     
-        invia_mail(data["email"], f"Stima360 – {indirizzo}", corpo)
+        with metrics.misura("smtp", integrazione="smtp"), tracing.span("invia_mail"):
+            inviata = invia_mail(data["email"], f"Stima360 – {indirizzo}", corpo)
+        if not inviata:
+            metrics.ERRORI.inc(integrazione="smtp")
     
-    except Exception as e:
-        print("MAIL EXC:", e)
+    except Exception:
+        logger.exception("email stima: eccezione")
 
 
     # --- 10. WhatsApp ---
@@ -721,8 +1425,8 @@ async def salva_stima(request: Request):
             indirizzo,             # p2
             link_token,            # p3
         )
-    except Exception as e:
-        print("WA EXC:", e)
+    except Exception:
+        logger.exception("whatsapp stima: eccezione")
 
 
 
@@ -741,78 +1445,109 @@ async def salva_stima(request: Request):
 # ---------------------------------------------------------
 # PREFILL TOKEN
 # ---------------------------------------------------------
-@app.get("/api/prefill")
-async def prefill(t: str):
-    try:
-        conn = get_connection()
-        cur = conn.cursor()
+# Cache breve dei payload di prefill: la pagina stima_dettagliata.html
+# viene ricaricata spesso con lo stesso token. Contiene anche i token
+# inesistenti/scaduti (valore None), così non tornano sul DB.
+PREFILL_CACHE_TTL = float(os.getenv("PREFILL_CACHE_TTL", "60"))
+_prefill_cache = TTLCache(ttl=PREFILL_CACHE_TTL, maxsize=2048)
 
-        cur.execute("""
-            SELECT
-              s.id,
-              s.nome, s.cognome, s.email, s.telefono,
-              s.comune, s.microzona, s.via, s.civico, s.tipologia,
-              s.mq, s.piano, s.locali, s.bagni,
-              s.pertinenze, s.ascensore,
-            
-              s.anno,
-              s.stato,
-            
-              s.posizionemare,
-              s.distanzamare,
-              s.barrieramare,
-            
-              s.vistamareyn,
-              s.vistamaredettaglio,
-              s.vistamare,
-            
-              s.mqgiardino,
-              s.mqgarage,
-              s.mqcantina,
-              s.mqpostoauto,
-              s.mqtaverna,
-              s.mqsoffitta,
-              s.mqterrazzo,
-              s.numbalconi,
-            
-              s.altrodescrizione
-            FROM stime s
-            WHERE s.token = %s
-            AND (s.token_expires IS NULL OR s.token_expires > NOW())
-            LIMIT 1;
-        """, (t,))
+PREFILL_KEYS = [
+  "id","nome","cognome","email","telefono",
+  "comune","microzona","via","civico","tipologia",
+  "mq","piano","locali","bagni",
+  "pertinenze","ascensore",
 
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+  "anno","stato",
+  "posizioneMare","distanzaMare","barrieraMare",
+  "vistaMareYN","vistaMareDettaglio","vistaMare",
 
-    except Exception as e:
-        print("PREFILL ERROR:", e)
-        raise HTTPException(status_code=500, detail="Errore prefill")
+  "mqGiardino","mqGarage","mqCantina","mqPostoAuto",
+  "mqTaverna","mqSoffitta","mqTerrazzo","numBalconi",
 
-    if not row:
-        raise HTTPException(status_code=404, detail="Token non valido")
+  "altroDescrizione"
+]
 
-    keys = [
-      "id","nome","cognome","email","telefono",
-      "comune","microzona","via","civico","tipologia",
-      "mq","piano","locali","bagni",
-      "pertinenze","ascensore",
+SQL_PREFILL = """
+    SELECT
+      s.token_expires,
+      s.id,
+      s.nome, s.cognome, s.email, s.telefono,
+      s.comune, s.microzona, s.via, s.civico, s.tipologia,
+      s.mq, s.piano, s.locali, s.bagni,
+      s.pertinenze, s.ascensore,
+    
+      s.anno,
+      s.stato,
     
-      "anno","stato",
-      "posizioneMare","distanzaMare","barrieraMare",
-      "vistaMareYN","vistaMareDettaglio","vistaMare",
+      s.posizionemare,
+      s.distanzamare,
+      s.barrieramare,
     
-      "mqGiardino","mqGarage","mqCantina","mqPostoAuto",
-      "mqTaverna","mqSoffitta","mqTerrazzo","numBalconi",
+      s.vistamareyn,
+      s.vistamaredettaglio,
+      s.vistamare,
     
-      "altroDescrizione"
-    ]
+      s.mqgiardino,
+      s.mqgarage,
+      s.mqcantina,
+      s.mqpostoauto,
+      s.mqtaverna,
+      s.mqsoffitta,
+      s.mqterrazzo,
+      s.numbalconi,
+    
+      s.altrodescrizione
+    FROM stime s
+    WHERE s.token = %s::uuid
+      AND s.deleted_at IS NULL
+    LIMIT 1;
+"""
+
+def invalida_prefill(stima_ids):
+    ids = set(stima_ids)
+    _prefill_cache.invalida_se(lambda _k, v: v is not None and v[1]["id"] in ids)
+
+def _leggi_prefill(token: uuid.UUID):
+    """(token_expires, payload) oppure None se il token non esiste."""
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(SQL_PREFILL, (str(token),))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+
+    if not row:
+        return None
+    return row[0], dict(zip(PREFILL_KEYS, row[1:]))
 
+@app.get("/api/prefill")
+async def prefill(t: str):
+    # Token malformato → rifiutato senza toccare il DB
+    try:
+        token = uuid.UUID(t)
+    except (ValueError, AttributeError):
+        raise HTTPException(status_code=404, detail="Token non valido")
 
+    cached = _prefill_cache.get(token)
+    if cached is MANCANTE:
+        try:
+            cached = _leggi_prefill(token)
+        except Exception:
+            logger.exception("prefill: errore lettura")
+            raise HTTPException(status_code=500, detail="Errore prefill")
+        _prefill_cache.set(token, cached)
+
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Token non valido")
 
+    expires, payload = cached
+    log.imposta(lead_id=payload["id"])
+    if expires is not None and expires <= datetime.now(timezone.utc):
+        raise HTTPException(status_code=404, detail="Token non valido")
 
-    return dict(zip(keys, row))
+    return dict(payload)
 
 
 # ---------------------------------------------------------
@@ -837,6 +1572,7 @@ async def salva_stima_dettagliata(request: Request):
         except:
             return None
 
+    log.imposta(lead_id=to_int_safe(data.get("stima_id")))
     conn = get_connection(); cur = conn.cursor()
 
     try:
@@ -927,8 +1663,7 @@ async def salva_stima_dettagliata(request: Request):
         conn.commit()
 
     except Exception as e:
-        # QUI, SE VUOI DEBUG SERIO:
-        print("ERRORE /api/salva_stima_dettagliata:", e)
+        logger.exception("salva_stima_dettagliata: errore INSERT")
         raise HTTPException(status_code=500, detail=f"Errore INSERT: {e}")
 
     finally:
@@ -944,6 +1679,14 @@ async def salva_stima_dettagliata(request: Request):
 # ADMIN STIME PRO
 # ---------------------------------------------------------
 
+SQL_ADMIN_STIME_PRO = """
+    SELECT *
+    FROM stime_dettagliate
+    WHERE data >= %s AND data < %s
+      AND deleted_at IS NULL
+    ORDER BY data DESC
+"""
+
 @app.get("/api/admin/stime_pro")
 def admin_lista_stime_pro(
     day: str = "oggi",
@@ -960,12 +1703,7 @@ def admin_lista_stime_pro(
         end   = datetime.combine(base + timedelta(days=1), datetime.min.time())
 
     conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        SELECT *
-        FROM stime_dettagliate
-        WHERE data >= %s AND data < %s
-        ORDER BY data DESC
-    """, (start, end))
+    cur.execute(SQL_ADMIN_STIME_PRO, (start, end))
 
     rows = cur.fetchall()
     cols = [c[0] for c in cur.description]
@@ -983,6 +1721,23 @@ def admin_lista_stime_pro(
 class LeadUpdate(BaseModel):
     lead_status: str | None = None
     note_internal: str | None = None
+    # esito reale, per il backtest del motore (backtest.py)
+    prezzo_vendita: float | None = None
+    venduto_at: date | None = None
+
+SQL_ADMIN_STIME = """
+        SELECT s.id, s.data, s.comune, s.microzona, s.via, s.civico, s.tipologia,
+               s.mq, s.piano, s.locali, s.bagni, s.pertinenze, s.ascensore,
+               s.nome, s.cognome, s.email, s.telefono,s.consenso_marketing, s.lead_status, s.note_internal,
+            sd.data AS data_dettaglio
+            FROM stime s
+            LEFT JOIN stime_dettagliate sd
+                   ON sd.stima_id = s.id AND sd.deleted_at IS NULL
+
+        WHERE s.data >= %s AND s.data < %s
+          AND s.deleted_at IS NULL
+        ORDER BY s.data DESC
+"""
 
 @app.get("/api/admin/stime")
 def admin_lista_stime(
@@ -999,17 +1754,7 @@ def admin_lista_stime(
         end   = datetime.combine(base + timedelta(days=1), datetime.min.time())
 
     conn = get_connection(); cur = conn.cursor()
-    cur.execute("""
-        SELECT s.id, s.data, s.comune, s.microzona, s.via, s.civico, s.tipologia,
-               s.mq, s.piano, s.locali, s.bagni, s.pertinenze, s.ascensore,
-               s.nome, s.cognome, s.email, s.telefono,s.consenso_marketing, s.lead_status, s.note_internal,
-            sd.data AS data_dettaglio
-            FROM stime s
-            LEFT JOIN stime_dettagliate sd ON sd.stima_id = s.id
-
-        WHERE s.data >= %s AND s.data < %s
-        ORDER BY s.data DESC
-    """, (start, end))
+    cur.execute(SQL_ADMIN_STIME, (start, end))
     rows = cur.fetchall()
     cols = [c[0] for c in cur.description]
     cur.close(); conn.close()
@@ -1031,7 +1776,15 @@ def admin_update_stima(stima_id: int, payload: LeadUpdate):
     if payload.note_internal is not None:
         updates.append("note_internal=%s")
         values.append(payload.note_internal)
-
+    if payload.prezzo_vendita is not None:
+        if payload.prezzo_vendita <= 0:
+            raise HTTPException(status_code=400, detail="prezzo_vendita deve essere positivo")
+        updates.append("prezzo_vendita=%s")
+        values.append(payload.prezzo_vendita)
+        updates.append("venduto_at=%s")
+        values.append(payload.venduto_at or date.today())
+
+    log.imposta(lead_id=stima_id)
     if not updates:
         return {"ok": True}
 
@@ -1039,10 +1792,11 @@ def admin_update_stima(stima_id: int, payload: LeadUpdate):
 
     conn = get_connection(); cur = conn.cursor()
     cur.execute(f"""
-        UPDATE stime SET {",".join(updates)} WHERE id=%s
+        UPDATE stime SET {",".join(updates)} WHERE id=%s AND deleted_at IS NULL
     """, tuple(values))
     conn.commit()
     cur.close(); conn.close()
+    invalida_prefill([stima_id])
 
     return {"ok": True}
 
@@ -1100,8 +1854,8 @@ async def whatsapp_webhook(request: Request):
         cur.close()
         conn.close()
 
-    except Exception as e:
-        print("WHATSAPP WEBHOOK ERROR:", e)
+    except Exception:
+        logger.exception("whatsapp webhook: errore")
 
     return {"ok": True}
 
@@ -1116,7 +1870,7 @@ def invia_whatsapp_text(numero: str, testo: str):
     if not PHONE_NUMBER_ID or not ACCESS_TOKEN:
         raise Exception("WhatsApp Meta credentials missing")
 
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+    url = f"{WHATSAPP_GRAPH_URL}/{PHONE_NUMBER_ID}/messages"
 
     headers = {
         "Authorization": f"Bearer {ACCESS_TOKEN}",
@@ -1132,7 +1886,7 @@ def invia_whatsapp_text(numero: str, testo: str):
         }
     }
 
-    return requests.post(url, headers=headers, json=payload)
+    return sessione_http().post(url, headers=headers, json=payload, timeout=10)
 
 
 # ---------------------------------------------------------
@@ -1143,4 +1897,5 @@ def invia_whatsapp_text(numero: str, testo: str):
 
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
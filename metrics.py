@@ -0,0 +1,212 @@
+# backend/metrics.py
+# Metriche applicative in formato Prometheus (text exposition 0.0.4).
+#
+# Niente dipendenze esterne: contatori, gauge e istogrammi minimi,
+# thread-safe, esposti da /metrics in main.py. Ogni processo uvicorn ha
+# i suoi valori (Prometheus li somma per istanza).
+#
+# Uso:
+#   with misura("db"):
+#       cur.execute(...)
+#   ERRORI.inc(integrazione="smtp")
+
+import time
+import threading
+from contextlib import contextmanager
+
+# Bucket in secondi: da query veloci (5ms) a render/upload lenti (30s)
+BUCKET_LATENZA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registro = []
+_lock_registro = threading.Lock()
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _etichette(nomi, valori, extra=None) -> str:
+    coppie = list(zip(nomi, valori))
+    if extra:
+        coppie.append(extra)
+    if not coppie:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in coppie) + "}"
+
+
+def _num(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nome: str, descrizione: str, etichette=()):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self._valori = {}
+        self._lock = threading.Lock()
+        with _lock_registro:
+            _registro.append(self)
+
+    def _chiave(self, etichette: dict) -> tuple:
+        if set(etichette) != set(self.etichette):
+            raise ValueError(f"{self.nome}: etichette attese {self.etichette}")
+        return tuple(str(etichette[k]) for k in self.etichette)
+
+    def _righe(self):
+        raise NotImplementedError
+
+    def esporta(self) -> str:
+        testa = [
+            f"# HELP {self.nome} {self.descrizione}",
+            f"# TYPE {self.nome} {self.tipo}",
+        ]
+        return "\n".join(testa + list(self._righe()))
+
+
+class Counter(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valore: float = 1, **etichette):
+        k = self._chiave(etichette)
+        with self._lock:
+            self._valori[k] = self._valori.get(k, 0) + valore
+
+    def _righe(self):
+        with self._lock:
+            valori = sorted(self._valori.items())
+        for k, v in valori:
+            yield f"{self.nome}{_etichette(self.etichette, k)} {_num(v)}"
+
+
+class Gauge(_Metrica):
+    """Valore istantaneo; con `funzione` viene letto al momento dell'export."""
+    tipo = "gauge"
+
+    def __init__(self, nome, descrizione, etichette=(), funzione=None):
+        super().__init__(nome, descrizione, etichette)
+        self.funzione = funzione
+
+    def set(self, valore: float, **etichette):
+        k = self._chiave(etichette)
+        with self._lock:
+            self._valori[k] = valore
+
+    def inc(self, valore: float = 1, **etichette):
+        k = self._chiave(etichette)
+        with self._lock:
+            self._valori[k] = self._valori.get(k, 0) + valore
+
+    def dec(self, valore: float = 1, **etichette):
+        self.inc(-valore, **etichette)
+
+    def _righe(self):
+        if self.funzione is not None:
+            try:
+                yield f"{self.nome} {_num(self.funzione())}"
+            except Exception:
+                pass
+            return
+        with self._lock:
+            valori = sorted(self._valori.items())
+        for k, v in valori:
+            yield f"{self.nome}{_etichette(self.etichette, k)} {_num(v)}"
+
+
+class Histogram(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome, descrizione, etichette=(), bucket=BUCKET_LATENZA):
+        super().__init__(nome, descrizione, etichette)
+        self.bucket = tuple(sorted(bucket)) + (float("inf"),)
+
+    def observe(self, valore: float, **etichette):
+        k = self._chiave(etichette)
+        with self._lock:
+            stato = self._valori.get(k)
+            if stato is None:
+                stato = self._valori[k] = [[0] * len(self.bucket), 0.0, 0]
+            conteggi = stato[0]
+            for i, limite in enumerate(self.bucket):
+                if valore <= limite:
+                    conteggi[i] += 1
+                    break
+            stato[1] += valore
+            stato[2] += 1
+
+    def _righe(self):
+        with self._lock:
+            valori = sorted((k, (list(c), s, n)) for k, (c, s, n) in self._valori.items())
+        for k, (conteggi, somma, totale) in valori:
+            cumulato = 0
+            for limite, c in zip(self.bucket, conteggi):
+                cumulato += c
+                lab = _etichette(self.etichette, k, ("le", _num(limite)))
+                yield f"{self.nome}_bucket{lab} {cumulato}"
+            lab = _etichette(self.etichette, k)
+            yield f"{self.nome}_sum{lab} {_num(somma)}"
+            yield f"{self.nome}_count{lab} {totale}"
+
+
+def esporta() -> str:
+    with _lock_registro:
+        metriche = list(_registro)
+    return "\n".join(m.esporta() for m in metriche) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ---------------------------------------------------------
+# METRICHE DELL'APP
+# ---------------------------------------------------------
+# RED per route (route = template FastAPI, non il path reale)
+HTTP_RICHIESTE = Counter(
+    "stima360_http_requests_total",
+    "Richieste HTTP per route, metodo e status",
+    ("method", "route", "status"),
+)
+HTTP_DURATA = Histogram(
+    "stima360_http_request_duration_seconds",
+    "Durata delle richieste HTTP",
+    ("method", "route"),
+)
+HTTP_IN_CORSO = Gauge(
+    "stima360_http_requests_in_progress",
+    "Richieste HTTP in corso",
+)
+
+# Fasi di salva_stima & co.: db, valuation, pdf_build, github_put,
+# pdf (attesa + render nel pool), smtp, whatsapp
+STAGE_DURATA = Histogram(
+    "stima360_stage_duration_seconds",
+    "Durata delle singole fasi di elaborazione",
+    ("stage",),
+)
+ERRORI = Counter(
+    "stima360_integration_errors_total",
+    "Errori per integrazione esterna (db, github, pdf, smtp, whatsapp)",
+    ("integrazione",),
+)
+
+
+@contextmanager
+def misura(stage: str, integrazione: str | None = None):
+    """
+    Cronometra un blocco nell'istogramma delle fasi.
+    Se il blocco solleva un'eccezione e `integrazione` è indicata,
+    conta anche l'errore (l'eccezione viene comunque propagata).
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if integrazione:
+            ERRORI.inc(integrazione=integrazione)
+        raise
+    finally:
+        STAGE_DURATA.observe(time.perf_counter() - t0, stage=stage)
@@ -0,0 +1,299 @@
+# backend/microzone.py
+# Microzona dalle coordinate: punto-in-poligono sui confini delle zone.
+#
+# Sorgente: un GeoJSON locale (GEO_MICROZONE) con un Feature per zona,
+# Polygon o MultiPolygon in lon/lat, properties {"comune", "microzona"}.
+# Si caricano solo le zone che esistono in valuation.BASE_MQ (nomi
+# canonici del catalogo); le altre finiscono nel log e vengono ignorate.
+# Senza file la ricerca restituisce None e vale la microzona del form.
+#
+# Indice: R-tree impacchettato STR (Sort-Tile-Recursive) sui bounding box
+# delle parti dei poligoni, costruito una volta al caricamento e poi di
+# sola lettura. Una ricerca scende solo nei nodi che contengono il punto
+# e fa il test ray casting (con i buchi) sui pochi candidati rimasti.
+#
+# Batch per le stime storiche (prima geocodifica chi non ha coordinate):
+#   python microzone.py --backfill                 # solo righe senza microzona
+#   python microzone.py --backfill --tutte         # riassegna anche le altre
+#   python microzone.py --backfill --dry-run       # conta senza scrivere
+# Poi `python backfill_valori.py --tutte` ricalcola i prezzi delle righe cambiate.
+
+import os
+import json
+import math
+import logging
+import threading
+from pathlib import Path
+
+from valuation import BASE_MQ, normalize_text
+
+logger = logging.getLogger("stima360.microzone")
+
+BASE_DIR = Path(__file__).resolve().parent
+GEO_MICROZONE = Path(os.getenv("GEO_MICROZONE", BASE_DIR / "dati" / "microzone.geojson"))
+
+NODO_MAX = 8        # figli per nodo dell'R-tree
+
+
+def _chiave(testo) -> str:
+    return normalize_text(str(testo or "")).lower()
+
+
+# nome normalizzato → nome canonico del catalogo
+_COMUNI = {_chiave(c): c for c in BASE_MQ}
+_ZONE = {(_chiave(c), _chiave(z)): (c, z) for c, zone in BASE_MQ.items() for z in zone}
+
+
+# ---------------------------------------------------------
+# GEOMETRIA
+# ---------------------------------------------------------
+class _Parte:
+    """Un poligono semplice (anello esterno + buchi) di una zona."""
+    __slots__ = ("comune", "microzona", "anelli", "bbox", "area")
+
+    def __init__(self, comune: str, microzona: str, anelli: list):
+        self.comune = comune
+        self.microzona = microzona
+        # anelli come (xs, ys): lon, lat
+        self.anelli = [(tuple(p[0] for p in a), tuple(p[1] for p in a)) for a in anelli]
+        xs, ys = self.anelli[0]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.area = abs(sum(xs[i - 1] * ys[i] - xs[i] * ys[i - 1] for i in range(len(xs)))) / 2
+
+    def contiene(self, x: float, y: float) -> bool:
+        dentro = False
+        for xs, ys in self.anelli:          # i buchi invertono l'esito
+            j = len(xs) - 1
+            for i in range(len(xs)):
+                if (ys[i] > y) != (ys[j] > y) and \
+                   x < (xs[j] - xs[i]) * (y - ys[i]) / (ys[j] - ys[i]) + xs[i]:
+                    dentro = not dentro
+                j = i
+        return dentro
+
+
+def _unisci_bbox(bboxes) -> tuple:
+    bboxes = list(bboxes)
+    return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+
+def _str(voci: list) -> list:
+    """Un livello STR: voci (bbox, contenuto) → nodi (bbox, [voci])."""
+    n = len(voci)
+    fette = math.ceil(math.sqrt(math.ceil(n / NODO_MAX)))
+    per_fetta = fette * NODO_MAX
+    voci = sorted(voci, key=lambda v: v[0][0] + v[0][2])
+    nodi = []
+    for i in range(0, n, per_fetta):
+        fetta = sorted(voci[i:i + per_fetta], key=lambda v: v[0][1] + v[0][3])
+        for j in range(0, len(fetta), NODO_MAX):
+            gruppo = fetta[j:j + NODO_MAX]
+            nodi.append((_unisci_bbox(v[0] for v in gruppo), gruppo))
+    return nodi
+
+
+class RTree:
+    """R-tree statico impacchettato STR; le foglie sono _Parte."""
+
+    def __init__(self, parti: list):
+        self.n = len(parti)
+        livello = [(p.bbox, p) for p in parti]
+        while len(livello) > NODO_MAX:
+            livello = _str(livello)
+        self.radice = (_unisci_bbox(v[0] for v in livello), livello) if livello else None
+
+    def candidati(self, x: float, y: float):
+        if self.radice is None:
+            return
+        pila = [self.radice]
+        while pila:
+            bbox, figli = pila.pop()
+            if not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            for voce in figli:
+                if isinstance(voce[1], _Parte):
+                    b = voce[0]
+                    if b[0] <= x <= b[2] and b[1] <= y <= b[3]:
+                        yield voce[1]
+                else:
+                    pila.append(voce)
+
+
+# ---------------------------------------------------------
+# CARICAMENTO E RICERCA
+# ---------------------------------------------------------
+_albero = RTree([])
+_lock = threading.Lock()
+
+
+def _poligoni(g: dict) -> list:
+    if g.get("type") == "Polygon":
+        return [g.get("coordinates") or []]
+    if g.get("type") == "MultiPolygon":
+        return g.get("coordinates") or []
+    return []
+
+
+def carica(percorso: Path | str | None = None) -> int:
+    """Legge il GeoJSON e sostituisce l'indice; restituisce le zone caricate."""
+    global _albero
+    percorso = Path(percorso or GEO_MICROZONE)
+    if not percorso.exists():
+        logger.info("confini microzone assenti: assegnazione spenta", extra={"percorso": str(percorso)})
+        return 0
+
+    with open(percorso, encoding="utf-8") as f:
+        dati = json.load(f)
+    parti, zone, sconosciute = [], set(), set()
+    for feat in dati.get("features", []):
+        prop = feat.get("properties") or {}
+        zona = _ZONE.get((_chiave(prop.get("comune")), _chiave(prop.get("microzona"))))
+        if zona is None:
+            sconosciute.add(f"{prop.get('comune')}/{prop.get('microzona')}")
+            continue
+        for anelli in _poligoni(feat.get("geometry") or {}):
+            if anelli and len(anelli[0]) >= 3:
+                parti.append(_Parte(*zona, anelli))
+                zone.add(zona)
+    if sconosciute:
+        logger.warning("microzone non presenti nel catalogo", extra={"zone": sorted(sconosciute)})
+
+    albero = RTree(parti)
+    with _lock:
+        _albero = albero
+    logger.info("confini microzone caricati", extra={"zone": len(zone), "poligoni": len(parti)})
+    return len(zone)
+
+
+def disponibile() -> bool:
+    return _albero.n > 0
+
+
+def trova(lat: float, lon: float, comune: str | None = None) -> tuple[str, str] | None:
+    """
+    (comune, microzona) che contiene il punto, nomi come in BASE_MQ.
+    Con `comune` si cercano solo le sue zone: un punto che cade nel comune
+    vicino (o un comune fuori catalogo) dà None, non la zona di un altro
+    listino. Se le zone si sovrappongono vince la più piccola (la più
+    specifica).
+    """
+    if lat is None or lon is None:
+        return None
+    x, y = float(lon), float(lat)
+    c = None
+    if comune is not None:
+        c = _COMUNI.get(_chiave(comune))
+        if c is None:
+            return None
+    migliore = None
+    for parte in _albero.candidati(x, y):
+        if c is not None and parte.comune != c:
+            continue
+        if not parte.contiene(x, y):
+            continue
+        if migliore is None or parte.area < migliore.area:
+            migliore = parte
+    if migliore is None:
+        return None
+    return migliore.comune, migliore.microzona
+
+
+# ---------------------------------------------------------
+# BACKFILL SULLE STIME STORICHE
+# ---------------------------------------------------------
+def backfill(batch: int = 500, tutte: bool = False, dry_run: bool = False) -> dict:
+    """
+    Assegna la microzona alle stime con coordinate (geocodificando prima,
+    con geocoder.py, le righe che non le hanno). Paginazione per id, una
+    transazione per blocco: si può interrompere e rilanciare.
+    """
+    from psycopg2.extras import execute_values
+    from database import get_connection
+    import geocoder
+
+    geocoder.carica()
+    filtro = "" if tutte else "AND COALESCE(microzona, '') = ''"
+    conteggi = {"lette": 0, "geocodificate": 0, "assegnate": 0, "cambiate": 0, "fuori_zona": 0}
+    ultimo_id = 0
+
+    conn = get_connection()
+    try:
+        while True:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT id, comune, microzona, via, civico, lat, lon
+                FROM stime
+                WHERE id > %s AND deleted_at IS NULL {filtro}
+                ORDER BY id
+                LIMIT %s
+            """, (ultimo_id, batch))
+            rows = cur.fetchall()
+            if not rows:
+                cur.close()
+                break
+
+            valori = []
+            for id_, comune, microzona, via, civico, lat, lon in rows:
+                geo_precisione = None
+                if lat is None or lon is None:
+                    geo = geocoder.geocodifica(via, civico, comune)
+                    if geo:
+                        lat, lon, geo_precisione = geo["lat"], geo["lon"], geo["precisione"]
+                        conteggi["geocodificate"] += 1
+                # solo zone del comune della riga (trova filtra per comune)
+                zona = trova(lat, lon, comune) if comune else None
+                if zona is None:
+                    conteggi["fuori_zona"] += 1
+                    if geo_precisione is None:
+                        continue
+                    nuova = microzona
+                else:
+                    nuova = zona[1]
+                    conteggi["assegnate"] += 1
+                    if _chiave(nuova) != _chiave(microzona):
+                        conteggi["cambiate"] += 1
+                valori.append((id_, nuova, lat, lon, geo_precisione))
+
+            if valori and not dry_run:
+                execute_values(cur, """
+                    UPDATE stime AS s SET
+                      microzona = v.microzona,
+                      lat = v.lat,
+                      lon = v.lon,
+                      geo_precisione = COALESCE(v.geo_precisione, s.geo_precisione)
+                    FROM (VALUES %s) AS v(id, microzona, lat, lon, geo_precisione)
+                    WHERE s.id = v.id
+                """, valori,
+                    template="(%s::int, %s, %s::float8, %s::float8, %s)",
+                    page_size=batch)
+            conn.commit()
+            cur.close()
+
+            ultimo_id = rows[-1][0]
+            conteggi["lette"] += len(rows)
+            print(f"🗺️  Lette {conteggi['lette']} righe (ultimo id {ultimo_id}): "
+                  f"{conteggi['assegnate']} in zona, {conteggi['cambiate']} cambiate")
+    finally:
+        conn.close()
+    return conteggi
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Microzona dai confini GeoJSON")
+    ap.add_argument("--backfill", action="store_true", help="assegna la microzona alle stime storiche")
+    ap.add_argument("--tutte", action="store_true", help="riassegna anche le righe con microzona")
+    ap.add_argument("--dry-run", action="store_true", help="conta senza scrivere")
+    ap.add_argument("--batch", type=int, default=500)
+    ap.add_argument("--punto", nargs=2, type=float, metavar=("LAT", "LON"), help="prova un punto")
+    args = ap.parse_args()
+
+    print(f"zone caricate: {carica()}")
+    if args.punto:
+        print(trova(*args.punto))
+    elif args.backfill:
+        print(backfill(args.batch, args.tutte, args.dry_run))
+    else:
+        ap.print_help()
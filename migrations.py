@@ -0,0 +1,638 @@
+# backend/migrations.py
+# Migrazioni versionate dello schema Postgres.
+#
+# Ogni migrazione ha un numero di versione e viene applicata UNA volta:
+# le versioni applicate sono registrate nella tabella schema_version.
+# Regole:
+#   - non modificare mai una migrazione già rilasciata: aggiungerne una nuova
+#   - gli indici su tabelle esistenti vanno creati CONCURRENTLY, in una
+#     migrazione "fuori_transazione" (uno statement per elemento di "sql")
+#   - le migrazioni in transazione girano con lock_timeout: se la tabella è
+#     occupata falliscono subito invece di bloccare le richieste in coda
+#
+# Uso:
+#   python migrations.py           # applica le migrazioni mancanti
+#   python migrations.py --stato   # mostra versione e differenze di schema
+
+import os
+import re
+import sys
+
+from database import get_connection
+
+# Chiave dell'advisory lock: due deploy in parallelo non migrano insieme
+LOCK_ID = 360_0001
+LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+
+
+# ---------------------------------------------------------
+# MIGRAZIONI
+# ---------------------------------------------------------
+# Le versioni 1–3 riassumono le vecchie funzioni crea_tabella_* e
+# migrazione_* di database.py: sono idempotenti (IF NOT EXISTS) perché
+# il DB di produzione le ha già eseguite a mano.
+MIGRAZIONI = [
+    {
+        "versione": 1,
+        "descrizione": "tabella stime (base + gestionale + campi completi)",
+        "sql": """
+            CREATE TABLE IF NOT EXISTS stime (
+                id SERIAL PRIMARY KEY,
+                comune VARCHAR(100),
+                via VARCHAR(100),
+                civico VARCHAR(20),
+                tipologia VARCHAR(50),
+                mq INTEGER,
+                piano VARCHAR(30),
+                locali INTEGER,
+                bagni INTEGER,
+                pertinenze VARCHAR(200),
+                ascensore VARCHAR(10),
+                nome VARCHAR(50),
+                cognome VARCHAR(50),
+                email VARCHAR(100),
+                telefono VARCHAR(30),
+                data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS microzona        VARCHAR(100),
+              ADD COLUMN IF NOT EXISTS fascia_mare      VARCHAR(32),
+              ADD COLUMN IF NOT EXISTS prezzo_mq_base   NUMERIC(10,2),
+              ADD COLUMN IF NOT EXISTS token            UUID,
+              ADD COLUMN IF NOT EXISTS token_expires    TIMESTAMPTZ,
+
+              ADD COLUMN IF NOT EXISTS lead_status      VARCHAR(32) DEFAULT 'nuovo',
+              ADD COLUMN IF NOT EXISTS note_internal    TEXT,
+
+              ADD COLUMN IF NOT EXISTS posizioneMare    VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS distanzaMare     VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS barrieraMare     VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS vistaMareYN      VARCHAR(10),
+              ADD COLUMN IF NOT EXISTS vistaMare        VARCHAR(50),
+
+              ADD COLUMN IF NOT EXISTS stato            VARCHAR(40),
+              ADD COLUMN IF NOT EXISTS anno             INTEGER,
+
+              ADD COLUMN IF NOT EXISTS mqGiardino       INTEGER,
+              ADD COLUMN IF NOT EXISTS mqGarage         INTEGER,
+              ADD COLUMN IF NOT EXISTS mqCantina        INTEGER,
+              ADD COLUMN IF NOT EXISTS mqPostoAuto      INTEGER,
+              ADD COLUMN IF NOT EXISTS mqTaverna        INTEGER,
+              ADD COLUMN IF NOT EXISTS mqSoffitta       INTEGER,
+              ADD COLUMN IF NOT EXISTS mqTerrazzo       INTEGER,
+              ADD COLUMN IF NOT EXISTS numBalconi       INTEGER,
+
+              ADD COLUMN IF NOT EXISTS altroDescrizione TEXT;
+
+            CREATE INDEX IF NOT EXISTS idx_stime_data ON stime(data);
+        """,
+    },
+    {
+        "versione": 2,
+        "descrizione": "tabella stime_dettagliate (base + campi completi)",
+        "sql": """
+            CREATE TABLE IF NOT EXISTS stime_dettagliate (
+                id SERIAL PRIMARY KEY,
+                stima_id INTEGER REFERENCES stime(id),
+                classe VARCHAR(8),
+                riscaldamento VARCHAR(32),
+                condizionatore VARCHAR(8),
+                spese_cond INTEGER,
+                condiz_tipo VARCHAR(50),
+                esposizione VARCHAR(16),
+                arredo VARCHAR(32),
+                note TEXT,
+                contatto VARCHAR(8),
+                sopralluogo TIMESTAMP,
+                data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            ALTER TABLE stime_dettagliate
+              ADD COLUMN IF NOT EXISTS condiz_tipo VARCHAR(50),
+
+              ADD COLUMN IF NOT EXISTS nome VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS cognome VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS email VARCHAR(100),
+              ADD COLUMN IF NOT EXISTS telefono VARCHAR(30),
+
+              ADD COLUMN IF NOT EXISTS indirizzo TEXT,
+              ADD COLUMN IF NOT EXISTS tipologia VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS mq INTEGER,
+              ADD COLUMN IF NOT EXISTS piano VARCHAR(30),
+              ADD COLUMN IF NOT EXISTS locali VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS bagni INTEGER,
+              ADD COLUMN IF NOT EXISTS ascensore VARCHAR(10),
+
+              ADD COLUMN IF NOT EXISTS stato VARCHAR(40),
+              ADD COLUMN IF NOT EXISTS anno INTEGER,
+
+              ADD COLUMN IF NOT EXISTS microzona VARCHAR(100),
+              ADD COLUMN IF NOT EXISTS posizioneMare VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS distanzaMare VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS barrieraMare VARCHAR(50),
+              ADD COLUMN IF NOT EXISTS vistaMare VARCHAR(80),
+              ADD COLUMN IF NOT EXISTS mqGiardino INTEGER,
+              ADD COLUMN IF NOT EXISTS mqGarage INTEGER,
+              ADD COLUMN IF NOT EXISTS mqCantina INTEGER,
+              ADD COLUMN IF NOT EXISTS mqPostoAuto INTEGER,
+              ADD COLUMN IF NOT EXISTS mqTaverna INTEGER,
+              ADD COLUMN IF NOT EXISTS mqSoffitta INTEGER,
+              ADD COLUMN IF NOT EXISTS mqTerrazzo INTEGER,
+              ADD COLUMN IF NOT EXISTS numBalconi INTEGER,
+              ADD COLUMN IF NOT EXISTS altroDescrizione TEXT,
+              ADD COLUMN IF NOT EXISTS pertinenze VARCHAR(200);
+        """,
+    },
+    {
+        "versione": 3,
+        "descrizione": "tabella zone_valori + listino iniziale",
+        "sql": """
+            CREATE TABLE IF NOT EXISTS zone_valori (
+                id SERIAL PRIMARY KEY,
+                comune VARCHAR(100) NOT NULL,
+                microzona VARCHAR(100) NOT NULL,
+                prezzo_mq_base NUMERIC(10,2) NOT NULL,
+                CONSTRAINT zone_valori_unq UNIQUE (comune, microzona)
+            );
+
+            INSERT INTO zone_valori (comune, microzona, prezzo_mq_base) VALUES
+                ('Alba Adriatica', 'Nord', 1250),
+                ('Alba Adriatica', 'Villa Fiore', 1350),
+                ('Alba Adriatica', 'Zona Basciani', 1200),
+                ('Tortoreto', 'Lido Sud', 1450),
+                ('Tortoreto', 'Lido Centro', 1650),
+                ('Tortoreto', 'Lido Nord', 1500),
+                ('Tortoreto', 'Alto', 1100),
+                ('Martinsicuro', 'Centro', 1000),
+                ('Martinsicuro', 'Villarosa', 900),
+                ('Martinsicuro', 'Alta', 850)
+            ON CONFLICT (comune, microzona) DO NOTHING;
+        """,
+    },
+    {
+        "versione": 4,
+        "descrizione": "colonne usate da main.py mai create + whatsapp_incoming",
+        "sql": """
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS vistaMareDettaglio     VARCHAR(80),
+              ADD COLUMN IF NOT EXISTS consenso_marketing     BOOLEAN DEFAULT FALSE,
+              ADD COLUMN IF NOT EXISTS consenso_marketing_at  TIMESTAMPTZ;
+
+            CREATE TABLE IF NOT EXISTS whatsapp_incoming (
+                id SERIAL PRIMARY KEY,
+                from_number VARCHAR(32),
+                message_type VARCHAR(32),
+                text TEXT,
+                received_at TIMESTAMPTZ DEFAULT NOW(),
+                direction VARCHAR(8) DEFAULT 'in'
+            );
+        """,
+    },
+    {
+        "versione": 5,
+        "descrizione": "valori calcolati dal motore su stime",
+        "sql": """
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS price_exact        NUMERIC(12,2),
+              ADD COLUMN IF NOT EXISTS eur_mq_finale      NUMERIC(10,2),
+              ADD COLUMN IF NOT EXISTS valore_pertinenze  NUMERIC(12,2),
+              ADD COLUMN IF NOT EXISTS base_mq            NUMERIC(10,2),
+              ADD COLUMN IF NOT EXISTS engine_version     VARCHAR(32),
+              ADD COLUMN IF NOT EXISTS catalog_version    VARCHAR(32),
+              ADD COLUMN IF NOT EXISTS valutata_at        TIMESTAMPTZ;
+        """,
+    },
+    {
+        "versione": 6,
+        "descrizione": "indice parziale sui token di prefill",
+        "fuori_transazione": True,
+        "sql": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_token_attivi
+            ON stime (token) INCLUDE (token_expires)
+            WHERE token IS NOT NULL
+            """,
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_stime_token",
+        ],
+    },
+    {
+        "versione": 7,
+        "descrizione": "funzione telefono_norm (normalizzazione numeri +39)",
+        "sql": """
+            CREATE OR REPLACE FUNCTION telefono_norm(t TEXT) RETURNS TEXT
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+                SELECT CASE
+                    WHEN regexp_replace(t, '[^0-9]', '', 'g') LIKE '39%'
+                        THEN regexp_replace(t, '[^0-9]', '', 'g')
+                    ELSE '39' || regexp_replace(t, '[^0-9]', '', 'g')
+                END
+            $$;
+        """,
+    },
+    {
+        "versione": 8,
+        "descrizione": "indici per le query calde (admin, join, inbox WhatsApp)",
+        "fuori_transazione": True,
+        "sql": [
+            # join admin_lista_stime + delete per stima_id
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_dettagliate_stima_id
+            ON stime_dettagliate (stima_id)
+            """,
+            # admin_lista_stime_pro (range su data)
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_dettagliate_data
+            ON stime_dettagliate (data)
+            """,
+            # inbox WhatsApp (ordinamento/filtri su received_at)
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_whatsapp_incoming_received_at
+            ON whatsapp_incoming (received_at)
+            """,
+            # ultima stima per numero di telefono (LATERAL nella inbox)
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_telefono_norm
+            ON stime (telefono_norm(telefono), id DESC)
+            WHERE telefono IS NOT NULL
+            """,
+            # doppione del vincolo zone_valori_unq (stesse colonne)
+            "DROP INDEX CONCURRENTLY IF EXISTS idx_zone_valori_cm",
+        ],
+    },
+    {
+        "versione": 9,
+        "descrizione": "soft delete (deleted_at) su stime e stime_dettagliate",
+        # colonne nullable senza default: solo catalogo, nessuna riscrittura
+        "sql": """
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+
+            ALTER TABLE stime_dettagliate
+              ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+        """,
+    },
+    {
+        "versione": 10,
+        "descrizione": "indici parziali sulle righe da purgare",
+        "fuori_transazione": True,
+        "sql": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_da_purgare
+            ON stime (deleted_at) WHERE deleted_at IS NOT NULL
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_dettagliate_da_purgare
+            ON stime_dettagliate (deleted_at) WHERE deleted_at IS NOT NULL
+            """,
+        ],
+    },
+    {
+        "versione": 11,
+        "descrizione": "coordinate del geocoder offline su stime",
+        # colonne nullable senza default: solo catalogo, nessuna riscrittura
+        "sql": """
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS lat DOUBLE PRECISION,
+              ADD COLUMN IF NOT EXISTS lon DOUBLE PRECISION,
+              ADD COLUMN IF NOT EXISTS geo_precisione TEXT;
+        """,
+    },
+    {
+        "versione": 12,
+        "descrizione": "distanza dalla costa in metri su stime",
+        "sql": """
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS distanza_mare_m DOUBLE PRECISION;
+        """,
+    },
+    {
+        "versione": 13,
+        "descrizione": "confronti del motore live con le versioni candidate (shadow.py)",
+        "sql": """
+            CREATE TABLE IF NOT EXISTS valutazioni_shadow (
+                id               BIGSERIAL PRIMARY KEY,
+                creato_at        TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                stima_id         INTEGER,
+                comune           TEXT,
+                microzona        TEXT,
+                tipologia        TEXT,
+                engine_live      TEXT NOT NULL,
+                engine_candidato TEXT NOT NULL,
+                price_live       NUMERIC,
+                price_candidato  NUMERIC,
+                delta_pct        DOUBLE PRECISION,
+                payload          JSONB
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_valutazioni_shadow_candidato
+            ON valutazioni_shadow (engine_candidato, creato_at);
+        """,
+    },
+    {
+        "versione": 14,
+        "descrizione": "prezzo di vendita reale inserito dall'agente (backtest.py)",
+        # colonne nullable senza default: solo catalogo, nessuna riscrittura
+        "sql": """
+            ALTER TABLE stime
+              ADD COLUMN IF NOT EXISTS prezzo_vendita NUMERIC,
+              ADD COLUMN IF NOT EXISTS venduto_at DATE;
+        """,
+    },
+    {
+        "versione": 15,
+        "descrizione": "regole dei coefficienti del motore, versionate (regole.py)",
+        # tabella nuova: indice creato insieme, nessun CONCURRENTLY; al massimo
+        # una versione attiva
+        "sql": """
+            CREATE TABLE IF NOT EXISTS regole_motore (
+                versione   TEXT PRIMARY KEY,
+                regole     JSONB NOT NULL,
+                nota       TEXT,
+                creato_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                attiva     BOOLEAN NOT NULL DEFAULT FALSE
+            );
+
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_regole_motore_attiva
+            ON regole_motore (attiva) WHERE attiva;
+        """,
+    },
+    {
+        "versione": 16,
+        "descrizione": "indice su valutata_at (cursore di comparabili.aggiorna)",
+        "fuori_transazione": True,
+        "sql": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stime_valutata_at
+            ON stime (valutata_at, id) WHERE deleted_at IS NULL
+            """,
+        ],
+    },
+    {
+        "versione": 17,
+        "descrizione": "indice sui confronti shadow col payload (purger.py)",
+        # il purger toglie il payload ai confronti delle stime cancellate
+        "fuori_transazione": True,
+        "sql": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_valutazioni_shadow_stima_id
+            ON valutazioni_shadow (stima_id) WHERE payload IS NOT NULL
+            """,
+        ],
+    },
+    {
+        "versione": 18,
+        "descrizione": "indice su creato_at dei confronti shadow (retention del purger)",
+        # senza, ogni giro del purger scorrerebbe tutta la tabella anche
+        # quando non c'è niente da cancellare
+        "fuori_transazione": True,
+        "sql": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_valutazioni_shadow_creato_at
+            ON valutazioni_shadow (creato_at)
+            """,
+        ],
+    },
+]
+
+VERSIONE_ATTESA = max(m["versione"] for m in MIGRAZIONI)
+
+
+# ---------------------------------------------------------
+# SCHEMA ATTESO DAL CODICE
+# ---------------------------------------------------------
+# Colonne lette/scritte da main.py & co. (nomi come li restituisce Postgres)
+SCHEMA_ATTESO = {
+    "stime": {
+        "id", "data", "comune", "microzona", "fascia_mare", "via", "civico",
+        "tipologia", "mq", "piano", "locali", "bagni", "pertinenze",
+        "ascensore", "nome", "cognome", "email", "telefono",
+        "prezzo_mq_base", "token", "token_expires",
+        "lead_status", "note_internal",
+        "anno", "stato",
+        "posizionemare", "distanzamare", "barrieramare",
+        "vistamareyn", "vistamaredettaglio", "vistamare",
+        "mqgiardino", "mqgarage", "mqcantina", "mqpostoauto",
+        "mqtaverna", "mqsoffitta", "mqterrazzo", "numbalconi",
+        "altrodescrizione",
+        "consenso_marketing", "consenso_marketing_at",
+        "price_exact", "eur_mq_finale", "valore_pertinenze", "base_mq",
+        "engine_version", "catalog_version", "valutata_at",
+        "deleted_at",
+        "lat", "lon", "geo_precisione", "distanza_mare_m",
+        "prezzo_vendita", "venduto_at",
+    },
+    "stime_dettagliate": {
+        "id", "stima_id", "data",
+        "nome", "cognome", "email", "telefono",
+        "indirizzo", "stato", "anno",
+        "classe", "riscaldamento", "condizionatore", "condiz_tipo", "spese_cond",
+        "esposizione", "arredo", "note", "contatto", "sopralluogo",
+        "ascensore", "pertinenze",
+        "tipologia", "mq", "piano", "locali", "bagni",
+        "microzona", "posizionemare", "distanzamare", "barrieramare",
+        "mqgiardino", "mqgarage", "vistamare", "altrodescrizione",
+        "mqcantina", "mqpostoauto", "mqtaverna", "mqsoffitta", "mqterrazzo",
+        "numbalconi", "deleted_at",
+    },
+    "zone_valori": {"comune", "microzona", "prezzo_mq_base"},
+    "valutazioni_shadow": {
+        "id", "creato_at", "stima_id", "comune", "microzona", "tipologia",
+        "engine_live", "engine_candidato", "price_live", "price_candidato",
+        "delta_pct", "payload",
+    },
+    "regole_motore": {"versione", "regole", "nota", "creato_at", "attiva"},
+    "whatsapp_incoming": {
+        "from_number", "message_type", "text", "received_at", "direction",
+    },
+}
+
+INDICI_ATTESI = {
+    "idx_stime_data",
+    "idx_stime_token_attivi",
+    "idx_stime_telefono_norm",
+    "idx_stime_dettagliate_stima_id",
+    "idx_stime_dettagliate_data",
+    "idx_whatsapp_incoming_received_at",
+    "idx_stime_da_purgare",
+    "idx_stime_dettagliate_da_purgare",
+    "zone_valori_unq",
+    "idx_valutazioni_shadow_candidato",
+    "idx_regole_motore_attiva",
+    "idx_stime_valutata_at",
+    "idx_valutazioni_shadow_stima_id",
+    "idx_valutazioni_shadow_creato_at",
+}
+
+
+# ---------------------------------------------------------
+# RUNNER
+# ---------------------------------------------------------
+def _crea_tabella_versioni(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versione    INTEGER PRIMARY KEY,
+            descrizione TEXT NOT NULL,
+            applied_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+
+
+def _versioni_applicate(cur) -> set:
+    cur.execute("SELECT versione FROM schema_version")
+    return {r[0] for r in cur.fetchall()}
+
+
+_RE_INDICE_CONCURRENTLY = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?\"?(\w+)\"?",
+    re.IGNORECASE,
+)
+
+
+def _elimina_indici_invalidi(cur, stmt: str):
+    """Un CREATE INDEX CONCURRENTLY fallito lascia un indice INVALID:
+    IF NOT EXISTS lo salterebbe al prossimo giro, quindi va rimosso.
+    Solo gli indici creati da stmt: un INVALID qualsiasi può essere un
+    build CONCURRENTLY ancora in corso in un'altra sessione."""
+    nomi = _RE_INDICE_CONCURRENTLY.findall(stmt)
+    if not nomi:
+        return
+    cur.execute("""
+        SELECT i.relname
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_namespace n ON n.oid = i.relnamespace
+        WHERE NOT x.indisvalid AND n.nspname = current_schema()
+          AND i.relname = ANY(%s)
+    """, (nomi,))
+    for (nome,) in cur.fetchall():
+        print(f"⚠️ Rimuovo indice invalido {nome}")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{nome}"')
+
+
+def _applica(conn, cur, m):
+    if m.get("fuori_transazione"):
+        conn.autocommit = True
+        for stmt in m["sql"]:
+            try:
+                cur.execute(stmt)
+            except Exception:
+                _elimina_indici_invalidi(cur, stmt)
+                raise
+        cur.execute(
+            "INSERT INTO schema_version (versione, descrizione) VALUES (%s, %s)",
+            (m["versione"], m["descrizione"]),
+        )
+        return
+
+    conn.autocommit = False
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (LOCK_TIMEOUT,))
+        cur.execute(m["sql"])
+        cur.execute(
+            "INSERT INTO schema_version (versione, descrizione) VALUES (%s, %s)",
+            (m["versione"], m["descrizione"]),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+
+def applica_migrazioni() -> list:
+    """Applica in ordine le migrazioni mancanti. Ritorna le versioni applicate."""
+    conn = get_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    applicate_ora = []
+    try:
+        _crea_tabella_versioni(cur)
+        cur.execute("SELECT pg_advisory_lock(%s)", (LOCK_ID,))
+        try:
+            gia = _versioni_applicate(cur)
+            for m in sorted(MIGRAZIONI, key=lambda x: x["versione"]):
+                if m["versione"] in gia:
+                    continue
+                print(f"🔧 Migrazione {m['versione']}: {m['descrizione']}")
+                _applica(conn, cur, m)
+                applicate_ora.append(m["versione"])
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
+    finally:
+        cur.close(); conn.close()
+    return applicate_ora
+
+
+def verifica_schema() -> list:
+    """
+    Confronta il DB con quello che il codice si aspetta.
+    Ritorna la lista dei problemi (vuota = schema allineato). Solo letture.
+    """
+    problemi = []
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return [f"tabella schema_version assente (attesa versione {VERSIONE_ATTESA})"]
+
+        cur.execute("SELECT COALESCE(MAX(versione), 0) FROM schema_version")
+        versione = cur.fetchone()[0]
+        if versione < VERSIONE_ATTESA:
+            problemi.append(f"schema alla versione {versione}, attesa {VERSIONE_ATTESA}")
+        elif versione > VERSIONE_ATTESA:
+            problemi.append(f"schema alla versione {versione}, più nuova del codice ({VERSIONE_ATTESA})")
+
+        cur.execute("""
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = ANY(%s)
+        """, (list(SCHEMA_ATTESO),))
+        presenti = {}
+        for tabella, colonna in cur.fetchall():
+            presenti.setdefault(tabella, set()).add(colonna)
+
+        for tabella, colonne in SCHEMA_ATTESO.items():
+            if tabella not in presenti:
+                problemi.append(f"tabella {tabella} assente")
+                continue
+            mancanti = sorted(colonne - presenti[tabella])
+            if mancanti:
+                problemi.append(f"{tabella}: colonne mancanti {', '.join(mancanti)}")
+
+        cur.execute("""
+            SELECT i.relname, x.indisvalid
+            FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            JOIN pg_namespace n ON n.oid = i.relnamespace
+            WHERE n.nspname = current_schema() AND i.relname = ANY(%s)
+        """, (list(INDICI_ATTESI),))
+        indici = dict(cur.fetchall())
+        for nome in sorted(INDICI_ATTESI):
+            if nome not in indici:
+                problemi.append(f"indice {nome} assente")
+            elif not indici[nome]:
+                problemi.append(f"indice {nome} INVALID")
+    finally:
+        cur.close(); conn.close()
+
+    return problemi
+
+
+if __name__ == "__main__":
+    if "--stato" in sys.argv:
+        problemi = verifica_schema()
+        print(f"Versione attesa dal codice: {VERSIONE_ATTESA}")
+        for p in problemi:
+            print(f"❌ {p}")
+        if not problemi:
+            print("✅ Schema allineato.")
+        sys.exit(1 if problemi else 0)
+
+    fatte = applica_migrazioni()
+    if fatte:
+        print(f"✅ Migrazioni applicate: {fatte}")
+    else:
+        print("✅ Schema già aggiornato.")
@@ -3,7 +3,11 @@
 import os
 import sys
 import json
+import time
 import base64
+import hashlib
+import threading
+import logging
 import datetime
 import urllib.request
 import urllib.error
@@ -17,10 +21,9 @@ from reportlab.lib.utils import ImageReader
 from reportlab.platypus import (
     SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle, Flowable
 )
-from reportlab.graphics.shapes import Drawing
-from reportlab.graphics.charts.barcharts import VerticalBarChart
-from reportlab.graphics.barcode import qr
 from reportlab.pdfbase.pdfmetrics import stringWidth
+# reportlab.graphics (QR) si carica in _qr_block / warmup: l'import di
+# questo modulo resta leggero per chi usa solo GitHub (purger, admin)
 
 # ---------------------------------------------------------------------
 # Import valuation
@@ -29,6 +32,9 @@ from reportlab.pdfbase.pdfmetrics import stringWidth
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASE_DIR)
 from valuation import compute_from_payload  # noqa: E402
+import tracing  # noqa: E402
+
+logger = logging.getLogger("stima360.pdf")
 
 # ---------------------------------------------------------------------
 # CONFIG GITHUB
@@ -38,12 +44,91 @@ GITHUB_USER = os.getenv("GITHUB_USER")
 GITHUB_REPO = os.getenv("GITHUB_REPO")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_BRANCH = os.getenv("GITHUB_BRANCH", "main")
+# Sovrascrivibile per test di carico (API finta locale)
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
 
 GITHUB_PDF_BASE_URL = os.getenv(
     "GITHUB_PDF_BASE_URL",
     f"https://raw.githubusercontent.com/{GITHUB_USER or 'Stima360'}/{GITHUB_REPO or 'stima360-pdf'}/{GITHUB_BRANCH}"
 )
 
+# ---------------------------------------------------------------------
+# CACHE PDF (render deterministici)
+# ---------------------------------------------------------------------
+
+REPORTS_DIR = "/var/tmp/reports"
+CACHE_DIR = os.path.join(REPORTS_DIR, ".cache")
+PDF_CACHE_MAX = int(os.getenv("PDF_CACHE_MAX", "500"))
+
+# Da aggiornare quando cambia il layout: invalida tutti i PDF in cache
+PDF_TEMPLATE_VERSION = "2026.10-1"
+
+
+def _render_key(dati: dict, giorno: datetime.date | None = None) -> str:
+    """
+    Hash del dict di input normalizzato + versione template + giorno del
+    render (il footer stampa "Generato il ...": un render di ieri non vale oggi).
+    Valori vuoti (None, "", "—") sono equivalenti all'assenza della chiave,
+    come nella normalizzazione di genera_pdf_stima.
+    """
+    norm = {k: v for k, v in dati.items() if v not in (None, "", "—")}
+    giorno = giorno or datetime.date.today()
+    raw = json.dumps(
+        {"template": PDF_TEMPLATE_VERSION, "giorno": giorno.isoformat(), "dati": norm},
+        sort_keys=True, default=str, ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _git_blob_sha(content: bytes) -> str:
+    """Lo stesso sha che la contents API di GitHub restituisce per un file."""
+    h = hashlib.sha1()
+    h.update(b"blob %d\0" % len(content))
+    h.update(content)
+    return h.hexdigest()
+
+
+def _manifest_path(nome_file: str) -> str:
+    return os.path.join(CACHE_DIR, f"{nome_file}.json")
+
+
+def _leggi_manifest(nome_file: str):
+    try:
+        with open(_manifest_path(nome_file), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _scrivi_atomico(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _scrivi_manifest(nome_file: str, info: dict):
+    try:
+        _scrivi_atomico(_manifest_path(nome_file), json.dumps(info).encode("utf-8"))
+    except Exception:
+        logger.exception("errore scrittura manifest", extra={"file": nome_file})
+
+
+def _pulisci_cache():
+    """Tiene in cache al massimo PDF_CACHE_MAX render (i più recenti)."""
+    try:
+        files = [
+            os.path.join(CACHE_DIR, n) for n in os.listdir(CACHE_DIR)
+            if n.endswith(".pdf")
+        ]
+        if len(files) <= PDF_CACHE_MAX:
+            return
+        files.sort(key=os.path.getmtime)
+        for p in files[:len(files) - PDF_CACHE_MAX]:
+            os.remove(p)
+    except Exception:
+        logger.exception("errore pulizia cache")
+
 # ---------------------------------------------------------------------
 # LOGO UTILITY
 # ---------------------------------------------------------------------
@@ -162,6 +247,8 @@ def _kpi_row(d: dict):
 
 def _qr_block(url: str, title_style, size_cm: float = 2.8, title_text: str = "Parla con noi"):
     from reportlab.platypus import Spacer
+    from reportlab.graphics.shapes import Drawing
+    from reportlab.graphics.barcode import qr
 
     qrw = qr.QrCodeWidget(url or "https://stima360.it/contatti")
     b = qrw.getBounds()
@@ -192,8 +279,9 @@ def _qr_block(url: str, title_style, size_cm: float = 2.8, title_text: str = "Pa
 # ---------------------------------------------------------------------
 
 def _parse_comparabili(raw):
+    """€/mq dai comparabili (numeri, stringhe o dict); [] se non ce ne sono."""
     if raw is None:
-        return [140, 150, 160, 155, 165]
+        return []
     nums = []
     seq = raw if isinstance(raw, (list, tuple)) else [raw]
     for it in seq:
@@ -205,14 +293,77 @@ def _parse_comparabili(raw):
             except:
                 pass
         elif isinstance(it, dict):
-            for k in ("prezzo_mq", "prezzo", "valore"):
+            for k in ("eur_mq", "prezzo_mq", "prezzo", "valore"):
                 if k in it:
                     try:
                         nums.append(float(str(it[k]).replace(",", ".")))
                         break
                     except:
                         pass
-    return nums or [140, 150, 160, 155, 165]
+    return nums
+
+
+def _comparabili_block(raw, eur_mq_immobile, st: dict, larghezza: float):
+    """
+    Grafico €/mq (comparabili + questo immobile) e tabella dei comparabili
+    (da comparabili.py). Nessun comparabile → nessuna sezione.
+    """
+    from reportlab.platypus import Spacer
+    from reportlab.graphics.shapes import Drawing
+    from reportlab.graphics.charts.barcharts import VerticalBarChart
+
+    righe = [c for c in (raw or []) if isinstance(c, dict)]
+    valori = _parse_comparabili(raw)
+    if len(valori) < 2:
+        return []
+
+    etichette = [f"#{i + 1}" for i in range(len(valori))]
+    serie = list(valori)
+    if eur_mq_immobile:
+        etichette.append("Questo immobile")
+        serie.append(float(eur_mq_immobile))
+
+    h = 5 * cm
+    disegno = Drawing(larghezza, h)
+    bc = VerticalBarChart()
+    bc.x, bc.y = 1.2 * cm, 0.8 * cm
+    bc.width, bc.height = larghezza - 1.6 * cm, h - 1.2 * cm
+    bc.data = [serie]
+    bc.barWidth = 8
+    bc.valueAxis.valueMin = 0
+    bc.valueAxis.valueMax = max(serie) * 1.15
+    bc.valueAxis.labels.fontSize = 7
+    bc.categoryAxis.categoryNames = etichette
+    bc.categoryAxis.labels.fontSize = 7
+    bc.bars[0].fillColor = colors.HexColor("#93c5fd")
+    if eur_mq_immobile:
+        bc.bars[(0, len(serie) - 1)].fillColor = colors.HexColor("#16a34a")
+    bc.barLabelFormat = "%.0f"
+    bc.barLabels.fontSize = 7
+    bc.barLabels.nudge = 6
+    disegno.add(bc)
+
+    flow = [Paragraph("Immobili simili in zona (€/mq)", st["H2"]), Spacer(1, 4), disegno]
+
+    if righe:
+        tabella = [["#", "Microzona", "Tipologia", "Superficie", "Anno", "€/mq"]]
+        for i, c in enumerate(righe):
+            tabella.append([
+                f"#{i + 1}", c.get("microzona") or "—", c.get("tipologia") or "—",
+                f"{c['mq']} mq" if c.get("mq") else "—", c.get("anno") or "—",
+                f"{float(c['eur_mq']):.0f}" if c.get("eur_mq") else "—",
+            ])
+        t = Table(tabella, colWidths=[1 * cm, None, None, 2.4 * cm, 1.6 * cm, 1.8 * cm])
+        t.setStyle(TableStyle([
+            ("FONTSIZE", (0, 0), (-1, -1), 8),
+            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#f3f4f6")),
+            ("INNERGRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#e5e7eb")),
+            ("ALIGN", (3, 1), (-1, -1), "RIGHT"),
+        ]))
+        flow += [Spacer(1, 4), t]
+
+    return flow + [Spacer(1, 10)]
 
 # ---------------------------------------------------------------------
 # UPLOAD SU GITHUB
@@ -220,16 +371,18 @@ def _parse_comparabili(raw):
 
 def _upload_pdf_to_github(local_path: str, filename: str):
     if not (GITHUB_USER and GITHUB_REPO and GITHUB_TOKEN):
-        print("[GITHUB] Variabili mancanti, salto upload.")
+        logger.warning("github: variabili mancanti, salto upload")
         return None
 
-    api_url = f"https://api.github.com/repos/{GITHUB_USER}/{GITHUB_REPO}/contents/{filename}"
+    api_url = f"{GITHUB_API_URL}/repos/{GITHUB_USER}/{GITHUB_REPO}/contents/{filename}"
+    raw_url = f"{GITHUB_PDF_BASE_URL.rstrip('/')}/{filename}"
 
     try:
         with open(local_path, "rb") as f:
-            content_b64 = base64.b64encode(f.read()).decode("utf-8")
+            content = f.read()
+        content_b64 = base64.b64encode(content).decode("utf-8")
     except Exception as e:
-        print(f"[GITHUB] Errore lettura file {local_path}: {e}")
+        logger.error("github: errore lettura file", extra={"path": local_path, "errore": str(e)})
         return None
 
     headers = {
@@ -246,10 +399,15 @@ def _upload_pdf_to_github(local_path: str, filename: str):
         sha = info.get("sha")
     except urllib.error.HTTPError as e:
         if e.code != 404:
-            print(f"[GITHUB] Errore GET {e}")
+            logger.error("github: errore GET", extra={"file": filename, "errore": str(e)})
             return None
     except Exception as e:
-        print(f"[GITHUB] Errore GET generico: {e}")
+        logger.error("github: errore GET", extra={"file": filename, "errore": str(e)})
+
+    # Stesso contenuto già su GitHub: niente PUT (né nuovo commit)
+    if sha and sha == _git_blob_sha(content):
+        logger.info("github: file invariato, salto PUT", extra={"file": filename})
+        return raw_url
 
     payload = {
         "message": f"Add report {filename}",
@@ -266,25 +424,87 @@ def _upload_pdf_to_github(local_path: str, filename: str):
         resp = urllib.request.urlopen(req_put)
         _ = json.loads(resp.read().decode("utf-8"))
     except Exception as e:
-        print(f"[GITHUB] Errore PUT: {e}")
+        logger.error("github: errore PUT", extra={"file": filename, "errore": str(e)})
         return None
 
-    raw_base = GITHUB_PDF_BASE_URL
-    return f"{raw_base.rstrip('/')}/{filename}"
+    return raw_url
+
+
+def _elimina_pdf_da_github(filename: str) -> bool:
+    """True se il file non è (più) su GitHub."""
+    if not (GITHUB_USER and GITHUB_REPO and GITHUB_TOKEN):
+        logger.warning("github: variabili mancanti, salto delete")
+        return False
+
+    api_url = f"{GITHUB_API_URL}/repos/{GITHUB_USER}/{GITHUB_REPO}/contents/{filename}"
+    headers = {
+        "Authorization": f"Bearer {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github+json",
+        "User-Agent": "stima360-backend"
+    }
+
+    req_get = urllib.request.Request(api_url, headers=headers, method="GET")
+    try:
+        resp = urllib.request.urlopen(req_get)
+        sha = json.loads(resp.read().decode("utf-8")).get("sha")
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return True
+        logger.error("github: errore GET", extra={"file": filename, "errore": str(e)})
+        return False
+    except Exception as e:
+        logger.error("github: errore GET", extra={"file": filename, "errore": str(e)})
+        return False
+
+    payload = {
+        "message": f"Remove report {filename}",
+        "sha": sha,
+        "branch": GITHUB_BRANCH,
+    }
+    data_bytes = json.dumps(payload).encode("utf-8")
+    req_del = urllib.request.Request(api_url, data=data_bytes, headers=headers, method="DELETE")
+    try:
+        urllib.request.urlopen(req_del).read()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return True
+        logger.error("github: errore DELETE", extra={"file": filename, "errore": str(e)})
+        return False
+    except Exception as e:
+        logger.error("github: errore DELETE", extra={"file": filename, "errore": str(e)})
+        return False
+    return True
+
+
+def elimina_pdf_stima(nome_file: str) -> bool:
+    """
+    Rimuove il PDF pubblicato (GitHub), la copia locale e il manifest.
+    Il render in .cache resta: è indicizzato per contenuto e lo pulisce
+    _pulisci_cache. Restituisce False se GitHub non ha confermato.
+    """
+    ok = _elimina_pdf_da_github(nome_file)
+    for path in (os.path.join(REPORTS_DIR, nome_file), _manifest_path(nome_file)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("impossibile rimuovere file", extra={"path": path, "errore": str(e)})
+    return ok
 
 # ---------------------------------------------------------------------
-# FUNZIONE PRINCIPALE
+# STILI, LOGO E WARMUP (caricati una volta per processo)
 # ---------------------------------------------------------------------
 
-def genera_pdf_stima(dati: dict, nome_file: str = "stima360.pdf"):
-    from reportlab.platypus import Spacer
+_STILI = None
+_LOGO = None
 
-    base_dir = BASE_DIR
-    logo_path = _logo_path(base_dir)
 
-    REPORTS_DIR = "/var/tmp/reports"
-    os.makedirs(REPORTS_DIR, exist_ok=True)
-    pdf_fs_path = os.path.join(REPORTS_DIR, nome_file)
+def _stili() -> dict:
+    """Stili del report: costruiti al primo uso e poi riusati."""
+    global _STILI
+    if _STILI is not None:
+        return _STILI
 
     ss = getSampleStyleSheet()
     H2 = ParagraphStyle(
@@ -362,10 +582,156 @@ def genera_pdf_stima(dati: dict, nome_file: str = "stima360.pdf"):
         spaceAfter=6
     )
 
+    _STILI = {
+        "H2": H2, "H2_RIEPILOGO": H2_RIEPILOGO, "P": P,
+        "BIG": BIG, "BIG_SUB": BIG_SUB,
+        "CLIENTE_NAME": CLIENTE_NAME, "CLIENTE_ADDR": CLIENTE_ADDR,
+        "CLIENTE_CONT": CLIENTE_CONT,
+    }
+    return _STILI
+
+
+def _logo() -> str | None:
+    """Percorso del logo, cercato una sola volta."""
+    global _LOGO
+    if _LOGO is None:
+        _LOGO = _logo_path(BASE_DIR) or ""
+    return _LOGO or None
+
+
+def _render_di_prova():
+    """Un PDF completo su file temporaneo (niente upload, niente cache)."""
+    import tempfile
+    from valuation import BASE_MQ
+
+    comune = next(iter(BASE_MQ))
+    payload = {
+        "comune": comune, "microzona": next(iter(BASE_MQ[comune])),
+        "tipologia": "Appartamento", "mq": 90, "piano": "1", "locali": "Trilocale",
+        "bagni": 1, "ascensore": "No", "anno": 2000, "stato": "buono",
+    }
+    dati = {**payload, **compute_from_payload(payload), "id_stima": 0,
+            "nome": "Prova", "cognome": "Warmup", "indirizzo": comune}
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    try:
+        _costruisci_pdf(dati, path)
+    finally:
+        os.remove(path)
+
+
+def warmup():
+    """
+    Precarica stili, metriche dei font e logo (decodifica immagine) e
+    fa un render di prova: chiamata all'avvio dei worker di render (e dal
+    warmup di main.py), così il primo PDF vero non paga.
+    """
+    import reportlab.graphics.barcode.qr  # noqa: F401
+    _stili()
+    for font in ("Helvetica", "Helvetica-Bold"):
+        stringWidth("Stima360", font, 10)
+    logo = _logo()
+    if logo:
+        try:
+            ImageReader(logo).getSize()
+        except Exception as e:
+            logger.warning("logo non leggibile", extra={"path": logo, "errore": str(e)})
+    try:
+        _render_di_prova()
+    except Exception:
+        logger.exception("render di prova fallito")
+
+
+# ---------------------------------------------------------------------
+# FUNZIONE PRINCIPALE
+# ---------------------------------------------------------------------
+
+class UploadFallito(RuntimeError):
+    """Il PDF è stato generato ma GitHub non l'ha accettato."""
+
+
+def genera_pdf_stima(dati: dict, nome_file: str = "stima360.pdf", tempi: dict | None = None):
+    """
+    Genera il PDF e lo pubblica su GitHub, restituendo l'URL raw.
+    Il render è indicizzato dall'hash dei dati (+ versione template):
+    - stesso file già pubblicato con lo stesso hash → URL immediato
+    - render già in cache locale → niente reportlab, solo upload
+    Se passato, `tempi` riceve la durata (s) di "pdf_build" e "github_put".
+    """
+    if tempi is None:
+        tempi = {}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    pdf_fs_path = os.path.join(REPORTS_DIR, nome_file)
+
+    oggi = datetime.date.today()
+    key = _render_key(dati, oggi)
+    pubblicato = _leggi_manifest(nome_file)
+    if pubblicato and pubblicato.get("key") == key and pubblicato.get("url"):
+        tracing.imposta(cache="manifest")
+        logger.info("pdf invariato, riuso url pubblicato",
+                    extra={"file": nome_file, "url": pubblicato["url"]})
+        return pubblicato["url"]
+
+    cache_path = os.path.join(CACHE_DIR, f"{key}.pdf")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            _scrivi_atomico(pdf_fs_path, f.read())
+    else:
+        # render su un file temporaneo: in pdf_fs_path e in cache solo se il
+        # build è riuscito (mai un render parziale o il PDF del lead precedente)
+        tmp_path = f"{pdf_fs_path}.{os.getpid()}.{threading.get_ident()}.build"
+        t0 = time.perf_counter()
+        try:
+            with tracing.span("pdf_build", file=nome_file):
+                _costruisci_pdf(dict(dati), tmp_path, oggi)
+            with open(tmp_path, "rb") as f:
+                _scrivi_atomico(cache_path, f.read())
+            os.replace(tmp_path, pdf_fs_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        tempi["pdf_build"] = time.perf_counter() - t0
+        _pulisci_cache()
+
+    # -------------------------------------------------------------
+    # Upload su GitHub (obbligatorio)
+    # -------------------------------------------------------------
+    t0 = time.perf_counter()
+    with tracing.span("_upload_pdf_to_github", file=nome_file) as sp:
+        github_url = _upload_pdf_to_github(pdf_fs_path, nome_file)
+        if sp is not None and not github_url:
+            sp.errore = "upload fallito"
+    tempi["github_put"] = time.perf_counter() - t0
+
+    if not github_url:
+        # niente PDF su Render, niente fallback
+        raise UploadFallito(
+            f"ERRORE: Upload su GitHub fallito. "
+            f"Il PDF {nome_file} non può essere servito dal backend."
+        )
+
+    _scrivi_manifest(nome_file, {"key": key, "url": github_url})
+    return github_url
+
+
+def _costruisci_pdf(dati: dict, pdf_fs_path: str, giorno: datetime.date | None = None):
+    from reportlab.platypus import Spacer
+
+    logo_path = _logo()
+
+    st = _stili()
+    H2, H2_RIEPILOGO, P = st["H2"], st["H2_RIEPILOGO"], st["P"]
+    BIG, BIG_SUB = st["BIG"], st["BIG_SUB"]
+    CLIENTE_NAME, CLIENTE_ADDR, CLIENTE_CONT = (
+        st["CLIENTE_NAME"], st["CLIENTE_ADDR"], st["CLIENTE_CONT"]
+    )
+
+    # invariant=1: niente timestamp/ID casuali nel file, stessi dati → stessi byte
     doc = SimpleDocTemplate(
         pdf_fs_path, pagesize=A4,
         rightMargin=2*cm, leftMargin=2*cm,
-        topMargin=0.1*cm, bottomMargin=1.8*cm
+        topMargin=0.1*cm, bottomMargin=1.8*cm,
+        invariant=1
     )
     flow = []
     # ------------------------------------------------------------------
@@ -432,10 +798,12 @@ def genera_pdf_stima(dati: dict, nome_file: str = "stima360.pdf"):
             price_exact = calc["price_exact"]
             valore_pertinenze = calc["valore_pertinenze"]
             base_mq = calc["base_mq"]
-        except Exception as e:
-            print(f"[STIMA] Errore compute_from_payload: {e}")
+        except Exception:
+            logger.exception("errore compute_from_payload")
 
-    print(f"[STIMA] base_mq={base_mq} eur_mq_finale={eur_mq_finale} tot={price_exact}")
+    logger.info("valori stima", extra={
+        "base_mq": base_mq, "eur_mq_finale": eur_mq_finale, "price_exact": price_exact,
+    })
 
     # LOGO
     img_big = _logo_flowable(logo_path, target_h_cm=8)
@@ -588,6 +956,9 @@ def genera_pdf_stima(dati: dict, nome_file: str = "stima360.pdf"):
         Spacer(1, 10),
     ]
 
+    # COMPARABILI (comparabili.py, passati da salva_stima)
+    flow += _comparabili_block(dati.get("comparabili"), eur_mq_finale, st, doc.width)
+
     
 
     def _footer(canvas, doc_obj):
@@ -595,26 +966,13 @@ def genera_pdf_stima(dati: dict, nome_file: str = "stima360.pdf"):
         w, h = A4
         canvas.setFont("Helvetica", 8)
         canvas.setFillColor(colors.HexColor("#6b7280"))
-        today = datetime.date.today().strftime("%d/%m/%Y")
+        today = (giorno or datetime.date.today()).strftime("%d/%m/%Y")
         canvas.drawString(2*cm, 1.2*cm, f"Stima360 • Generato il {today}")
         canvas.drawRightString(w-2*cm, 1.2*cm, f"Pagina {doc_obj.page}")
         canvas.restoreState()
 
     try:
         doc.build(flow, onFirstPage=_footer, onLaterPages=_footer)
-    except Exception as e:
-        print({"detail": f"Errore generazione REPORT: {e}"})
-    
-    # -------------------------------------------------------------
-    # Upload su GitHub (obbligatorio)
-    # -------------------------------------------------------------
-    github_url = _upload_pdf_to_github(pdf_fs_path, nome_file)
-    
-    if not github_url:
-        # niente PDF su Render, niente fallback
-        raise RuntimeError(
-            f"ERRORE: Upload su GitHub fallito. "
-            f"Il PDF {nome_file} non può essere servito dal backend."
-        )
-    
-    return github_url
+    except Exception:
+        logger.exception("errore generazione report", extra={"path": pdf_fs_path})
+        raise
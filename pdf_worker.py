@@ -0,0 +1,246 @@
+# backend/pdf_worker.py
+# Pool di processi per il render dei PDF.
+#
+# reportlab è Python puro e CPU-bound: in un thread tiene il GIL e rallenta
+# tutti gli altri endpoint. Qui i render girano in processi separati,
+# già "caldi" (font, stili e logo precaricati), con una coda limitata:
+# quando è piena salva_stima risponde 503 invece di accodare all'infinito.
+
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import log
+import metrics
+import tracing
+import profiler
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_QUEUE_MAX = int(os.getenv("PDF_QUEUE_MAX", "8"))
+# Ogni worker viene riciclato dopo N render (tiene sotto controllo la memoria)
+PDF_RENDERS_PER_WORKER = int(os.getenv("PDF_RENDERS_PER_WORKER", "50"))
+PDF_RETRY_AFTER = int(os.getenv("PDF_RETRY_AFTER", "5"))
+
+
+class CodaPdfPiena(Exception):
+    """Troppi render in corso/in coda: il chiamante deve riprovare più tardi."""
+
+
+# ---------------------------------------------------------
+# LATO WORKER
+# ---------------------------------------------------------
+def _init_worker():
+    log.configura()
+    # i figli escono con os._exit (niente atexit): svuota la coda di log
+    multiprocessing.util.Finalize(None, log.chiudi, exitpriority=10)
+    multiprocessing.util.Finalize(None, tracing.chiudi, exitpriority=10)
+    tracing.instrumenta_http()
+    import pdf_report
+    pdf_report.warmup()
+
+
+def _noop():
+    return os.getpid()
+
+
+def _render(dati: dict, nome_file: str, contesto: dict,
+            traceparent: str | None = None,
+            profilo: float = 0.0) -> tuple[str, dict, dict | None]:
+    # le metriche vivono nel processo dell'app: i tempi tornano col risultato;
+    # il contesto di log (request_id, lead_id) e la trace arrivano col job.
+    # Con un profilo attivo nell'app (profilo = intervallo) si campiona il
+    # render e le pile tornano anche loro col risultato
+    from pdf_report import genera_pdf_stima
+    tempi = {}
+    campionatore = None
+    if profilo:
+        campionatore = profiler.Campionatore(profilo, thread=threading.get_ident())
+        campionatore.avvia()
+    try:
+        with log.contesto(**contesto), \
+                tracing.span_remoto("genera_pdf_stima", traceparent, file=nome_file):
+            url = genera_pdf_stima(dati, nome_file=nome_file, tempi=tempi)
+    finally:
+        pile = dict(campionatore.ferma()) if campionatore is not None else None
+    return url, tempi, pile
+
+
+# ---------------------------------------------------------
+# LATO APP
+# ---------------------------------------------------------
+_executor = None
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(1, PDF_QUEUE_MAX))
+_in_coda = 0
+
+
+def _contesto():
+    # forkserver: i worker nascono da un processo che ha già importato
+    # reportlab, quindi anche il riciclo dopo N render costa poco
+    metodi = multiprocessing.get_all_start_methods()
+    if "forkserver" in metodi:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["pdf_report", "reportlab.graphics.barcode.qr"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=_contesto(),
+                initializer=_init_worker,
+                max_tasks_per_child=PDF_RENDERS_PER_WORKER,
+            )
+        return _executor
+
+
+def avvia():
+    """Crea il pool e fa partire subito i worker (warmup incluso)."""
+    if PDF_WORKERS <= 0:
+        return
+    ex = _get_executor()
+    for f in [ex.submit(_noop) for _ in range(PDF_WORKERS)]:
+        f.result()
+
+
+def chiudi():
+    global _executor
+    with _lock:
+        ex, _executor = _executor, None
+    if ex is not None:
+        ex.shutdown(wait=True, cancel_futures=True)
+
+
+def in_coda() -> int:
+    """Render prenotati e non ancora terminati."""
+    return _in_coda
+
+
+metrics.Gauge(
+    "stima360_pdf_queue_depth",
+    "Render PDF prenotati e non ancora terminati",
+    funzione=in_coda,
+)
+metrics.Gauge(
+    "stima360_pdf_queue_capacity",
+    "Posti nella coda di render PDF",
+    funzione=lambda: PDF_QUEUE_MAX,
+)
+metrics.Gauge(
+    "stima360_pdf_pool_workers",
+    "Processi di render PDF attivi",
+    funzione=lambda: len(getattr(_executor, "_processes", None) or {}),
+)
+
+
+class Prenotazione:
+    """
+    Posto riservato nella coda di render; si rilascia una volta sola.
+    consegnata: passata a genera_pdf, che da lì in poi la rilascia a render
+    finito; chi l'ha presa la rilascia solo se non l'ha consegnata.
+    """
+
+    def __init__(self):
+        self._rilasciata = False
+        self.consegnata = False
+
+    def rilascia(self):
+        global _in_coda
+        with _lock:
+            if self._rilasciata:
+                return
+            self._rilasciata = True
+            _in_coda -= 1
+        _slots.release()
+
+
+def prenota() -> Prenotazione:
+    """
+    Riserva un posto in coda senza bloccare.
+    Va chiamata PRIMA di scrivere sul DB, così un lead rifiutato
+    non lascia righe orfane. Solleva CodaPdfPiena se non c'è posto.
+    """
+    global _in_coda
+    if not _slots.acquire(blocking=False):
+        raise CodaPdfPiena(f"{PDF_QUEUE_MAX} render già in coda")
+    with _lock:
+        _in_coda += 1
+    return Prenotazione()
+
+
+def _registra(risultato: tuple[str, dict, dict | None]) -> str:
+    url, tempi, pile = risultato
+    for stage, durata in tempi.items():
+        metrics.STAGE_DURATA.observe(durata, stage=stage)
+    profiler.unisci(pile, radice="pdf_worker")
+    return url
+
+
+async def genera_pdf(dati: dict, nome_file: str, prenotazione: Prenotazione) -> str:
+    """Esegue il render nel pool (o in un thread se PDF_WORKERS=0)."""
+    t0 = time.perf_counter()
+    try:
+        with tracing.span("pdf", file=nome_file, in_coda=in_coda()):
+            return _registra(await _genera_pdf(dati, nome_file, prenotazione))
+    except Exception as e:
+        from pdf_report import UploadFallito
+        metrics.ERRORI.inc(integrazione="github" if isinstance(e, UploadFallito) else "pdf")
+        raise
+    finally:
+        # attesa in coda + render + upload, visto dalla richiesta
+        metrics.STAGE_DURATA.observe(time.perf_counter() - t0, stage="pdf")
+
+
+def _fine_thread(task: asyncio.Task, prenotazione: Prenotazione):
+    if not task.cancelled():
+        task.exception()   # già vista da chi ha atteso, o persa con la richiesta
+    prenotazione.rilascia()
+
+
+async def _genera_pdf(dati: dict, nome_file: str, prenotazione: Prenotazione):
+    global _executor
+    prenotazione.consegnata = True
+    if PDF_WORKERS <= 0:
+        # render nel processo dell'app: lo vede già il profilo principale.
+        # shield: se la richiesta viene annullata il thread finisce comunque,
+        # e il posto si libera solo allora
+        try:
+            task = asyncio.ensure_future(asyncio.to_thread(
+                _render, dati, nome_file, log.contesto_corrente(), tracing.traceparent()))
+        except Exception:
+            prenotazione.rilascia()
+            raise
+        task.add_done_callback(lambda t: _fine_thread(t, prenotazione))
+        return await asyncio.shield(task)
+
+    try:
+        ex = _get_executor()
+        fut = ex.submit(_render, dati, nome_file,
+                        log.contesto_corrente(), tracing.traceparent(),
+                        profiler.intervallo_attivo())
+    except Exception:
+        prenotazione.rilascia()
+        raise
+    # il posto si libera quando il worker ha finito, anche se la richiesta
+    # HTTP nel frattempo è stata annullata
+    fut.add_done_callback(lambda _f: prenotazione.rilascia())
+
+    try:
+        return await asyncio.wrap_future(fut)
+    except BrokenProcessPool:
+        # un worker è morto (OOM, segfault): il pool va ricreato (se un'altra
+        # richiesta non l'ha già fatto) e quello rotto chiuso, senza attendere
+        with _lock:
+            if _executor is ex:
+                _executor = None
+        ex.shutdown(wait=False)
+        raise
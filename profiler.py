@@ -0,0 +1,275 @@
+# backend/profiler.py
+# Profiler a campionamento, acceso a richiesta da /api/admin/profiler.
+#
+# Un thread legge le pile di tutti i thread (sys._current_frames) ogni
+# pochi millisecondi e conta le pile uguali. Il risultato è in formato
+# "folded" (lo stesso di py-spy --format raw e di flamegraph.pl, si apre
+# anche con speedscope) oppure un flame graph SVG già pronto.
+#
+# Due modalità:
+#   - per N secondi: campiona tutto il processo
+#   - per le prossime N richieste di una route: campiona solo mentre
+#     almeno una di quelle richieste è in corso (gli endpoint async
+#     condividono l'event loop, quindi nelle pile può comparire anche
+#     lavoro di richieste concorrenti)
+# I render PDF girano nei worker (pdf_worker.py): lì campiona il thread
+# del render e le pile tornano col risultato, sotto la radice "pdf_worker".
+#
+# Da spento non c'è nessun thread: il middleware controlla solo `_corrente`.
+# Con più worker uvicorn il profilo riguarda il processo che riceve la chiamata.
+
+import os
+import sys
+import time
+import html
+import zlib
+import threading
+from collections import Counter
+
+# Funzioni "foglia" di thread fermi in attesa: escluse salvo idle=True
+_FOGLIE_IDLE = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+    ("socketserver.py", "serve_forever"),
+    ("connection.py", "_recv"),
+    ("connection.py", "wait"),
+    ("base_events.py", "_run_once"),
+}
+
+INTERVALLO_MIN = 0.001
+
+
+class ProfiloInCorso(Exception):
+    """Un profilo è già attivo in questo processo."""
+
+
+def _etichetta(frame) -> str:
+    codice = frame.f_code
+    return f"{codice.co_name} ({os.path.basename(codice.co_filename)}:{codice.co_firstlineno})"
+
+
+# ---------------------------------------------------------
+# CAMPIONATORE
+# ---------------------------------------------------------
+class Campionatore:
+    """
+    Conta le pile dei thread ogni `intervallo` secondi.
+    thread: ident da campionare (default tutti tranne il campionatore);
+    condizione: se data, campiona solo quando restituisce True.
+    """
+
+    def __init__(self, intervallo: float = 0.005, thread: int | None = None,
+                 idle: bool = False, condizione=None):
+        self.intervallo = max(INTERVALLO_MIN, intervallo)
+        self.thread = thread
+        self.idle = idle
+        self.condizione = condizione
+        self.pile = Counter()
+        self.campioni = 0
+        self._stop = threading.Event()
+        self._t = None
+
+    def _campiona(self):
+        nomi = {t.ident: t.name for t in threading.enumerate()}
+        io = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == io or (self.thread is not None and ident != self.thread):
+                continue
+            codice = frame.f_code
+            if not self.idle and (os.path.basename(codice.co_filename), codice.co_name) in _FOGLIE_IDLE:
+                continue
+            pila = []
+            while frame is not None:
+                pila.append(_etichetta(frame))
+                frame = frame.f_back
+            pila.append(nomi.get(ident, str(ident)))
+            self.pile[";".join(reversed(pila))] += 1
+        self.campioni += 1
+
+    def _ciclo(self):
+        while not self._stop.wait(self.intervallo):
+            if self.condizione is None or self.condizione():
+                self._campiona()
+
+    def avvia(self):
+        self._t = threading.Thread(target=self._ciclo, name="profiler", daemon=True)
+        self._t.start()
+
+    def ferma(self) -> Counter:
+        self._stop.set()
+        if self._t is not None:
+            self._t.join()
+        return self.pile
+
+
+# ---------------------------------------------------------
+# PROFILO ATTIVO
+# ---------------------------------------------------------
+class Profilo:
+    def __init__(self, secondi: float, route=None, richieste: int = 0,
+                 intervallo: float = 0.005, idle: bool = False):
+        self.secondi = secondi
+        self.route = route          # starlette Route, None = tutto il processo
+        self.richieste = richieste
+        self.intervallo = intervallo
+        self.in_volo = 0
+        self.completate = 0
+        self.inizio = time.time()
+        self.durata = 0.0
+        self.fine = threading.Event()
+        self._lock = threading.Lock()
+        self._campionatore = Campionatore(
+            intervallo, idle=idle,
+            condizione=(lambda: self.in_volo > 0) if route is not None else None,
+        )
+
+    @property
+    def pile(self) -> Counter:
+        return self._campionatore.pile
+
+    def unisci(self, pile: dict, radice: str):
+        with self._lock:
+            for pila, n in pile.items():
+                self._campionatore.pile[f"{radice};{pila}"] += n
+
+    def richiesta_finita(self):
+        self.in_volo -= 1
+        self.completate += 1
+        if self.completate >= self.richieste:
+            self.fine.set()
+
+    def attendi(self, timeout: float) -> bool:
+        """Blocca fino a fine profilo; False se scade il timeout (modalità route)."""
+        return self.fine.wait(self.secondi if self.route is None else timeout)
+
+    def stato(self) -> dict:
+        return {
+            "route": getattr(self.route, "path", None),
+            "richieste": self.completate if self.route is not None else None,
+            "campioni": self._campionatore.campioni,
+            "pile": len(self.pile),
+            "durata_s": round(self.durata or time.time() - self.inizio, 3),
+        }
+
+
+_corrente: Profilo | None = None
+_lock = threading.Lock()
+
+
+def avvia(secondi: float = 10, route=None, richieste: int = 20,
+          intervallo: float = 0.005, idle: bool = False) -> Profilo:
+    """Accende il profilo; solleva ProfiloInCorso se ce n'è già uno."""
+    global _corrente
+    with _lock:
+        if _corrente is not None:
+            raise ProfiloInCorso("profilo già in corso")
+        p = Profilo(secondi, route, richieste, intervallo, idle)
+        p._campionatore.avvia()
+        _corrente = p
+    return p
+
+
+def chiudi(p: Profilo):
+    global _corrente
+    with _lock:
+        if _corrente is p:
+            _corrente = None
+    p._campionatore.ferma()
+    p.durata = time.time() - p.inizio
+
+
+def intervallo_attivo() -> float:
+    """Intervallo del profilo in corso (0 = spento): lo usano i worker PDF."""
+    p = _corrente
+    return p.intervallo if p is not None else 0.0
+
+
+def unisci(pile: dict | None, radice: str):
+    """Aggiunge al profilo in corso pile raccolte altrove (worker PDF)."""
+    p = _corrente
+    if p is not None and pile:
+        p.unisci(pile, radice)
+
+
+class MiddlewareASGI:
+    """Conta le richieste della route profilata; da spento è un passaggio diretto."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        p = _corrente
+        if p is None or p.route is None or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        from starlette.routing import Match
+        if p.route.matches(scope)[0] is not Match.FULL:
+            return await self.app(scope, receive, send)
+
+        p.in_volo += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            p.richiesta_finita()
+
+
+# ---------------------------------------------------------
+# FORMATI
+# ---------------------------------------------------------
+def folded(pile: Counter) -> str:
+    """Una riga per pila: "radice;...;foglia N" (py-spy raw / flamegraph.pl)."""
+    return "".join(f"{pila} {n}\n" for pila, n in sorted(pile.items()))
+
+
+def svg(pile: Counter, titolo: str = "stima360", larghezza: int = 1200) -> str:
+    """Flame graph SVG statico (radice in basso, tooltip con campioni e %)."""
+    albero = {"n": 0, "figli": {}}
+    profondita = 0
+    for pila, n in pile.items():
+        nodo = albero
+        nodo["n"] += n
+        parti = pila.split(";")
+        profondita = max(profondita, len(parti))
+        for parte in parti:
+            nodo = nodo["figli"].setdefault(parte, {"n": 0, "figli": {}})
+            nodo["n"] += n
+
+    totale = albero["n"] or 1
+    h_riga, margine = 16, 24
+    altezza = (profondita + 1) * h_riga + margine * 2
+    scala = (larghezza - 20) / totale
+    rettangoli = []
+
+    def disegna(nome, nodo, x, livello):
+        w = nodo["n"] * scala
+        if w < 0.3:
+            return
+        y = altezza - margine - (livello + 1) * h_riga
+        c = zlib.crc32(nome.encode())
+        colore = f"rgb({205 + c % 50},{(c >> 8) % 180 + 40},{(c >> 16) % 55})"
+        testo = html.escape(nome)
+        etichetta = testo if w > 7 * len(nome) else (testo[: int(w / 7) - 2] + "…" if w > 30 else "")
+        rettangoli.append(
+            f'<g><title>{testo} ({nodo["n"]} campioni, {nodo["n"] * 100 / totale:.2f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{h_riga - 1}" fill="{colore}" rx="2"/>'
+            f'<text x="{x + 3:.1f}" y="{y + 11}">{etichetta}</text></g>'
+        )
+        for figlio_nome, figlio in sorted(nodo["figli"].items()):
+            disegna(figlio_nome, figlio, x, livello + 1)
+            x += figlio["n"] * scala
+
+    x = 10.0
+    for nome, nodo in sorted(albero["figli"].items()):
+        disegna(nome, nodo, x, 0)
+        x += nodo["n"] * scala
+
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{larghezza}" height="{altezza}" '
+        f'font-family="monospace" font-size="11">'
+        f'<rect width="100%" height="100%" fill="#fdfdf6"/>'
+        f'<text x="10" y="16" font-size="13">{html.escape(titolo)} — {albero["n"]} campioni</text>'
+        + "".join(rettangoli) + "</svg>"
+    )
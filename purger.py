@@ -0,0 +1,201 @@
+# backend/purger.py
+# Cancellazione definitiva delle stime marcate come eliminate (deleted_at).
+#
+# Gli endpoint admin fanno solo soft delete (UPDATE di poche righe, subito
+# invisibili alle API). Qui le righe vengono cancellate davvero, a blocchi
+# piccoli e in transazioni brevi: i lock su stime durano millisecondi e
+# le scritture pubbliche non restano in coda. FOR UPDATE SKIP LOCKED
+# permette più purger in parallelo (es. più worker uvicorn) senza conflitti.
+#
+# Uso:
+#   python purger.py               # un giro completo
+#   python purger.py --chunk 100
+
+import os
+import logging
+import argparse
+import threading
+
+import log
+from database import get_connection
+
+logger = logging.getLogger("stima360.purger")
+
+PURGE_CHUNK = int(os.getenv("PURGE_CHUNK", "200"))
+# Minuti di attesa prima della cancellazione definitiva
+PURGE_GRACE_MIN = int(os.getenv("PURGE_GRACE_MIN", "60"))
+# Secondi tra un giro e l'altro del thread in background (0 = disattivato)
+PURGE_INTERVALLO = int(os.getenv("PURGE_INTERVALLO", "300"))
+# Giorni di confronti shadow da tenere (0 = per sempre)
+SHADOW_RETENZIONE_GIORNI = int(os.getenv("SHADOW_RETENZIONE_GIORNI", "90"))
+
+# Figli e padri nello stesso statement: il vincolo FK è verificato a fine
+# statement, quando entrambe le DELETE sono già avvenute. I confronti shadow
+# non hanno FK: restano per le statistiche, senza il payload (dati del lead)
+SQL_PURGA_STIME = """
+    WITH vittime AS (
+        SELECT id FROM stime
+        WHERE deleted_at IS NOT NULL
+          AND deleted_at < NOW() - %s * INTERVAL '1 minute'
+        ORDER BY deleted_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ),
+    dettagli AS (
+        DELETE FROM stime_dettagliate d
+        USING vittime v
+        WHERE d.stima_id = v.id
+        RETURNING d.id
+    ),
+    stime_eliminate AS (
+        DELETE FROM stime s
+        USING vittime v
+        WHERE s.id = v.id
+        RETURNING s.id
+    ),
+    shadow AS (
+        UPDATE valutazioni_shadow vs SET payload = NULL
+        FROM vittime v
+        WHERE vs.stima_id = v.id AND vs.payload IS NOT NULL
+        RETURNING vs.id
+    )
+    SELECT
+        ARRAY(SELECT id FROM stime_eliminate),
+        (SELECT COUNT(*) FROM dettagli),
+        (SELECT COUNT(*) FROM shadow)
+"""
+
+SQL_PURGA_DETTAGLIATE = """
+    DELETE FROM stime_dettagliate
+    WHERE id IN (
+        SELECT id FROM stime_dettagliate
+        WHERE deleted_at IS NOT NULL
+          AND deleted_at < NOW() - %s * INTERVAL '1 minute'
+        ORDER BY deleted_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+# idx_valutazioni_shadow_creato_at: legge solo le righe scadute, e nessuna
+# quando non ce ne sono
+SQL_PURGA_SHADOW = """
+    DELETE FROM valutazioni_shadow
+    WHERE id IN (
+        SELECT id FROM valutazioni_shadow
+        WHERE creato_at < NOW() - %s * INTERVAL '1 day'
+        ORDER BY creato_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+"""
+
+
+def _elimina_pdf(stima_ids) -> tuple[int, int]:
+    """(pdf eliminati, errori) per i PDF stima_{id}.pdf."""
+    from pdf_report import elimina_pdf_stima
+
+    ok = errori = 0
+    for sid in stima_ids:
+        if elimina_pdf_stima(f"stima_{sid}.pdf"):
+            ok += 1
+        else:
+            errori += 1
+    return ok, errori
+
+
+def purga(chunk: int = PURGE_CHUNK, grace_min: int = PURGE_GRACE_MIN) -> dict:
+    """
+    Cancella definitivamente le righe soft-deleted più vecchie di grace_min
+    e i confronti shadow oltre SHADOW_RETENZIONE_GIORNI.
+    Ogni blocco è una transazione a sé; i PDF si rimuovono DOPO il commit
+    (se la rimozione fallisce resta un file orfano, mai una riga senza PDF).
+    Restituisce i conteggi reali.
+    """
+    esito = {"stime": 0, "stime_dettagliate": 0, "pdf": 0, "pdf_errori": 0,
+             "shadow_anonimizzati": 0, "shadow": 0}
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        while True:
+            cur.execute(SQL_PURGA_STIME, (grace_min, chunk))
+            ids, n_dettagli, n_shadow = cur.fetchone()
+            conn.commit()
+            if not ids:
+                break
+            esito["stime"] += len(ids)
+            esito["stime_dettagliate"] += n_dettagli
+            esito["shadow_anonimizzati"] += n_shadow
+
+            ok, errori = _elimina_pdf(ids)
+            esito["pdf"] += ok
+            esito["pdf_errori"] += errori
+
+        # dettagliate eliminate da sole (endpoint stime_dettagliate/delete)
+        while True:
+            cur.execute(SQL_PURGA_DETTAGLIATE, (grace_min, chunk))
+            n = cur.rowcount
+            conn.commit()
+            if not n:
+                break
+            esito["stime_dettagliate"] += n
+
+        while SHADOW_RETENZIONE_GIORNI > 0:
+            cur.execute(SQL_PURGA_SHADOW, (SHADOW_RETENZIONE_GIORNI, chunk))
+            n = cur.rowcount
+            conn.commit()
+            if not n:
+                break
+            esito["shadow"] += n
+        cur.close()
+    finally:
+        conn.close()
+
+    if esito["stime"] or esito["stime_dettagliate"] or esito["shadow"]:
+        logger.info("purge completato", extra=esito)
+    return esito
+
+
+# ---------------------------------------------------------
+# THREAD IN BACKGROUND
+# ---------------------------------------------------------
+_stop = threading.Event()
+_thread = None
+
+
+def _ciclo():
+    while not _stop.wait(PURGE_INTERVALLO):
+        try:
+            with log.contesto(job="purge"):
+                purga()
+        except Exception:
+            logger.exception("purge fallito")
+
+
+def avvia():
+    global _thread
+    if PURGE_INTERVALLO <= 0 or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_ciclo, name="purger", daemon=True)
+    _thread.start()
+
+
+def chiudi():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=10)
+        _thread = None
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Cancellazione definitiva stime eliminate")
+    ap.add_argument("--chunk", type=int, default=PURGE_CHUNK)
+    ap.add_argument("--grace", type=int, default=PURGE_GRACE_MIN,
+                    help="minuti di attesa dopo il soft delete")
+    args = ap.parse_args()
+
+    esito = purga(chunk=args.chunk, grace_min=args.grace)
+    print(f"✅ Purge completato: {esito}")
@@ -0,0 +1,511 @@
+# backend/regole.py
+# Coefficienti del motore (valuation.py) come dati, non come codice.
+#
+# Le regole sono un dict di sezioni (tipologia, stato, anno, mare, piano,
+# pertinenze, ...) con i valori che prima erano letterali nelle funzioni.
+# compila() le valida e le trasforma in tabelle di lookup (dict, tuple,
+# anno → coefficiente già risolto) che il motore legge direttamente: nel
+# percorso della stima niente parsing, solo accessi a dizionario.
+#
+# Sorgente (REGOLE_SORGENTE):
+#   file     – REGOLE_FILE (default config/regole.yaml, anche .json); se
+#              manca valgono le predefinite
+#   db       – la riga attiva di regole_motore (migrazione 15), pubblicata
+#              con pubblica() / POST /api/admin/regole / --pubblica
+#   default  – solo REGOLE_PREDEFINITE, nessun I/O
+# Una sezione assente nella sorgente resta quella predefinita.
+#
+# Versione: hash del contenuto (come CATALOG_VERSION). Le predefinite hanno
+# la loro; valuation.versione_motore() la aggiunge a ENGINE_VERSION solo se
+# le regole attive sono diverse, ed è quella che finisce in
+# stime.engine_version.
+#
+# Cambio a caldo: ogni processo controlla la sorgente ogni
+# REGOLE_CONTROLLO_S secondi (mtime del file o versione attiva nel DB) e,
+# se è cambiata, compila le nuove regole e sostituisce il riferimento in
+# un colpo solo. Una stima prende attuali() una volta e usa quelle fino in
+# fondo; regole non valide restano nel log e non sostituiscono niente.
+#
+#   python regole.py --esporta regole.json     # predefinite su file
+#   python regole.py --verifica config/regole.yaml
+#   python regole.py --pubblica config/regole.yaml --nota "garage +10%"
+
+import os
+import json
+import time
+import logging
+import hashlib
+import threading
+from pathlib import Path
+
+logger = logging.getLogger("stima360.regole")
+
+BASE_DIR = Path(__file__).resolve().parent
+REGOLE_SORGENTE = os.getenv("REGOLE_SORGENTE", "file").strip().lower()
+REGOLE_FILE = Path(os.getenv("REGOLE_FILE", BASE_DIR / "config" / "regole.yaml"))
+REGOLE_CONTROLLO_S = float(os.getenv("REGOLE_CONTROLLO_S", "30"))
+
+# ---------------------------------------------------------
+# REGOLE PREDEFINITE (i valori storici di valuation.py)
+# ---------------------------------------------------------
+REGOLE_PREDEFINITE = {
+    "tipologia": {
+        "valori": {"appartamento": 1.00, "villa": 1.20, "rustico": 0.80},
+        "altrimenti": 1.00,
+    },
+    "bagni": {"da": 2, "coeff": 1.10},
+    # numero di locali; sotto il primo vale il primo, sopra l'ultimo l'ultimo
+    "locali": {"valori": {"1": 0.96, "2": 1.00, "3": 1.00, "4": 1.03, "5": 1.05}},
+    # micro bonus ascensore dal piano indicato in su
+    "ascensore": {"da_piano": 2, "coeff": 1.02},
+    # [da, a, coeff], estremi inclusi, null = aperto; vince la prima fascia
+    "anno": {
+        "fasce": [
+            [2025, None, 1.28], [2024, 2024, 1.26], [2023, 2023, 1.24],
+            [2022, 2022, 1.22], [2021, 2021, 1.20], [2010, 2020, 1.15],
+            [2005, 2009, 1.12], [1995, 2004, 1.06], [1980, 1994, 1.00],
+            [1970, 1979, 0.92], [1960, 1969, 0.88], [1950, 1959, 0.82],
+        ],
+        "altrimenti": 1.00,
+    },
+    "stato": {
+        "valori": {"nuovo": 1.05, "ristrutturato": 1.05, "buono": 1.00,
+                   "scarso": 0.85, "grezzo": 0.80},
+        "altrimenti": 1.00,
+    },
+    "posizione_mare": {
+        "valori": {"frontemare": 1.15, "seconda": 1.08},
+        "altrimenti": 1.00,
+    },
+    # metri (costa.py): interpolazione lineare tra i punti; fasce del form
+    # quando i metri non ci sono
+    "distanza_mare": {
+        "curva": [[50, 1.15], [200, 1.03], [400, 1.01], [750, 1.00], [1500, 0.97]],
+        "fasce": {"0-100": 1.15, "100-300": 1.03, "300-500": 1.01, "500-1000": 1.00},
+        "altrimenti": 0.97,
+    },
+    "barriera_mare": {"coeff": 0.90},
+    "vista_mare": {
+        "valori": {"panoramica": 1.10, "parziale": 1.04, "scarsa": 1.02},
+        "altrimenti": 1.00,
+    },
+    "piano": {
+        "terra": 1.03,
+        "neutri_fino_a": 2,                  # 1° e 2° piano: nessun effetto
+        "bonus_ascensore_per_piano": 0.02,   # oltre, con ascensore
+        "ultimo_con_ascensore": 1.06,
+        "senza_ascensore": {"3": 0.75, "4": 0.70},
+        "senza_ascensore_oltre": 0.60,
+    },
+    # parole cercate nella via, nell'ordine: vince la prima
+    "indirizzo": [["lungomare", 1.05], ["sirena", 1.03], ["nazionale", 0.97], ["statale", 0.97]],
+    # gruppi di parole cercati nella descrizione libera, nell'ordine
+    "altro_descrizione": [
+        [["lusso", "signorile", "finemente", "di pregio"], 1.03],
+        [["da ristrutturare", "da completare", "grezzo", "allo stato originale"], 0.95],
+        [["vista mare totale", "vista mare panoramica"], 1.01],
+    ],
+    "extra": {
+        "frontemare_nuovo": 1.10,
+        "rustico": 0.60,                     # sostituisce il coeff di tipologia
+        "terra_giardino": {"da_anno": 2000, "coeff": 1.10},
+        "scarso_vecchio": {"prima_del": 1980, "coeff": 0.80},
+        "limiti": [0.50, 2.20],              # clamp del coefficiente totale
+    },
+    # € per pertinenza: a mq (o a balcone) se indicati, altrimenti forfait
+    "pertinenze": {
+        "garage": {"eur_mq": 500, "minimo": 18000, "forfait": 10000, "frontemare": 1.15},
+        "posto auto": {"eur_mq": 850, "forfait": 10000},
+        "cantina": {"eur_mq": 550, "forfait": 10000},
+        "soffitta": {"eur_mq": 200, "forfait": 20000},
+        "taverna": {"eur_mq": 1150, "forfait": 12000},
+        "balconi": {"eur_cad": 1000, "forfait": 3000},
+        "terrazzo": {"eur_mq": 250, "forfait": 4500},
+        "giardino": {"divisore_base_mq": 5},  # €/mq giardino = base €/mq / divisore
+        # parole nel testo libero delle pertinenze → € fissi
+        "testo": {"piscina": 15000, "posto moto": 3000, "posto bici": 1000},
+    },
+}
+
+PERTINENZE = ("garage", "posto auto", "cantina", "soffitta", "taverna", "balconi", "terrazzo")
+
+
+def _versione(dati: dict) -> str:
+    raw = json.dumps(dati, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+# ---------------------------------------------------------
+# COMPILAZIONE
+# ---------------------------------------------------------
+def _num(v, dove: str, positivo: bool = True) -> float:
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise ValueError(f"{dove}: atteso un numero, trovato {v!r}")
+    if positivo and v <= 0:
+        raise ValueError(f"{dove}: deve essere > 0 ({v})")
+    return float(v)
+
+
+def _intero(v, dove: str) -> int:
+    if isinstance(v, bool) or not isinstance(v, (int, str)):
+        raise ValueError(f"{dove}: atteso un intero, trovato {v!r}")
+    try:
+        return int(v)
+    except ValueError:
+        raise ValueError(f"{dove}: atteso un intero, trovato {v!r}") from None
+
+
+def _tabella(sez: dict, nome: str) -> tuple[dict, float]:
+    valori = {str(k).strip().lower(): _num(c, f"{nome}.{k}") for k, c in (sez.get("valori") or {}).items()}
+    return valori, _num(sez.get("altrimenti", 1.0), f"{nome}.altrimenti")
+
+
+def _anno(sez: dict) -> tuple[dict, int, int, float, float]:
+    """Le fasce diventano anno → coeff; fuori dagli estremi il valore è costante."""
+    altrimenti = _num(sez.get("altrimenti", 1.0), "anno.altrimenti")
+    fasce = []
+    for i, f in enumerate(sez.get("fasce") or []):
+        if not isinstance(f, (list, tuple)) or len(f) != 3:
+            raise ValueError(f"anno.fasce[{i}]: atteso [da, a, coeff]")
+        da = None if f[0] is None else _intero(f[0], f"anno.fasce[{i}].da")
+        a = None if f[1] is None else _intero(f[1], f"anno.fasce[{i}].a")
+        if da is not None and a is not None and da > a:
+            raise ValueError(f"anno.fasce[{i}]: {da} > {a}")
+        fasce.append((da, a, _num(f[2], f"anno.fasce[{i}].coeff")))
+
+    def primo(anno: int) -> float:
+        for da, a, c in fasce:
+            if (da is None or anno >= da) and (a is None or anno <= a):
+                return c
+        return altrimenti
+
+    estremi = [x for da, a, _ in fasce for x in (da, a) if x is not None]
+    if not estremi:
+        return {}, 0, -1, altrimenti, altrimenti
+    lo, hi = min(estremi), max(estremi)
+    return {a: primo(a) for a in range(lo, hi + 1)}, lo, hi, primo(lo - 1), primo(hi + 1)
+
+
+def _parole(voci, nome: str) -> tuple:
+    out = []
+    for i, v in enumerate(voci or []):
+        if not isinstance(v, (list, tuple)) or len(v) != 2:
+            raise ValueError(f"{nome}[{i}]: atteso [parole, coeff]")
+        parole = (v[0],) if isinstance(v[0], str) else tuple(v[0])
+        out.append((tuple(str(p).strip().lower() for p in parole), _num(v[1], f"{nome}[{i}]")))
+    return tuple(out)
+
+
+class Regole:
+    """Regole compilate: tabelle pronte per valuation.py, di sola lettura."""
+
+    def __init__(self, dati: dict, origine: str = "predefinite"):
+        sconosciute = set(dati) - set(REGOLE_PREDEFINITE) - {"nome"}
+        if sconosciute:
+            raise ValueError(f"sezioni sconosciute: {sorted(sconosciute)}")
+        # sezione per sezione: quelle assenti restano le predefinite
+        self.dati = {k: dati.get(k, v) for k, v in REGOLE_PREDEFINITE.items()}
+        self.nome = dati.get("nome")
+        self.versione = _versione(self.dati)
+        self.origine = origine
+        self.caricata_at = time.time()
+        d = self.dati
+
+        self.tipologia, self.tipologia_altrimenti = _tabella(d["tipologia"], "tipologia")
+        self.bagni_da = _intero(d["bagni"]["da"], "bagni.da")
+        self.bagni = _num(d["bagni"]["coeff"], "bagni.coeff")
+
+        locali = {_intero(k, "locali"): _num(c, f"locali.{k}") for k, c in d["locali"]["valori"].items()}
+        if not locali:
+            raise ValueError("locali: nessun valore")
+        self.locali = locali
+        self.locali_min, self.locali_max = min(locali), max(locali)
+
+        self.ascensore_da = _intero(d["ascensore"]["da_piano"], "ascensore.da_piano")
+        self.ascensore = _num(d["ascensore"]["coeff"], "ascensore.coeff")
+
+        self.anno, self.anno_min, self.anno_max, self.anno_sotto, self.anno_sopra = _anno(d["anno"])
+
+        self.stato, self.stato_altrimenti = _tabella(d["stato"], "stato")
+        self.posizione, self.posizione_altrimenti = _tabella(d["posizione_mare"], "posizione_mare")
+        self.vista, self.vista_altrimenti = _tabella(d["vista_mare"], "vista_mare")
+        self.barriera = _num(d["barriera_mare"]["coeff"], "barriera_mare.coeff")
+
+        dm = d["distanza_mare"]
+        curva = tuple((_num(m, "distanza_mare.curva", positivo=False), _num(c, "distanza_mare.curva"))
+                      for m, c in dm["curva"])
+        if not curva or any(m1 <= m0 for (m0, _), (m1, _) in zip(curva, curva[1:])):
+            raise ValueError("distanza_mare.curva: servono metri crescenti")
+        self.distanza_curva = curva
+        self.distanza_fasce = {str(k).replace("–", "-").replace("m", "").replace(" ", ""):
+                               _num(c, f"distanza_mare.fasce.{k}") for k, c in dm["fasce"].items()}
+        self.distanza_altrimenti = _num(dm.get("altrimenti", 1.0), "distanza_mare.altrimenti")
+
+        p = d["piano"]
+        self.piano_terra = _num(p["terra"], "piano.terra")
+        self.piano_neutri = _intero(p["neutri_fino_a"], "piano.neutri_fino_a")
+        self.piano_bonus = _num(p["bonus_ascensore_per_piano"], "piano.bonus_ascensore_per_piano",
+                                positivo=False)
+        self.piano_ultimo = _num(p["ultimo_con_ascensore"], "piano.ultimo_con_ascensore")
+        self.piano_senza = {_intero(k, "piano.senza_ascensore"): _num(c, f"piano.senza_ascensore.{k}")
+                            for k, c in (p.get("senza_ascensore") or {}).items()}
+        self.piano_senza_oltre = _num(p["senza_ascensore_oltre"], "piano.senza_ascensore_oltre")
+
+        self.indirizzo = _parole(d["indirizzo"], "indirizzo")
+        self.altro = _parole(d["altro_descrizione"], "altro_descrizione")
+
+        e = d["extra"]
+        self.frontemare_nuovo = _num(e["frontemare_nuovo"], "extra.frontemare_nuovo")
+        self.rustico = _num(e["rustico"], "extra.rustico")
+        self.terra_giardino_da = _intero(e["terra_giardino"]["da_anno"], "extra.terra_giardino.da_anno")
+        self.terra_giardino = _num(e["terra_giardino"]["coeff"], "extra.terra_giardino.coeff")
+        self.scarso_prima_del = _intero(e["scarso_vecchio"]["prima_del"], "extra.scarso_vecchio.prima_del")
+        self.scarso_vecchio = _num(e["scarso_vecchio"]["coeff"], "extra.scarso_vecchio.coeff")
+        self.limite_min, self.limite_max = (_num(x, "extra.limiti") for x in e["limiti"])
+        if self.limite_min > self.limite_max:
+            raise ValueError("extra.limiti: minimo > massimo")
+
+        pert = d["pertinenze"]
+        self.pertinenze = {}
+        for nome in PERTINENZE:
+            voce = pert.get(nome) or {}
+            self.pertinenze[nome] = {k: _num(v, f"pertinenze.{nome}.{k}", positivo=False)
+                                     for k, v in voce.items()}
+            if "forfait" not in self.pertinenze[nome]:
+                raise ValueError(f"pertinenze.{nome}: manca forfait")
+        self.giardino_divisore = _num(pert["giardino"]["divisore_base_mq"], "pertinenze.giardino.divisore_base_mq")
+        self.pertinenze_testo = tuple((str(k).strip().lower(), _num(v, f"pertinenze.testo.{k}"))
+                                      for k, v in (pert.get("testo") or {}).items())
+
+    def coeff_anno(self, anno: int) -> float:
+        if anno < self.anno_min:
+            return self.anno_sotto
+        if anno > self.anno_max:
+            return self.anno_sopra
+        return self.anno[anno]
+
+    def descrizione(self) -> dict:
+        return {"versione": self.versione, "nome": self.nome, "origine": self.origine,
+                "predefinite": self.versione == PREDEFINITE.versione,
+                "caricata_at": self.caricata_at}
+
+
+def compila(dati: dict, origine: str = "predefinite") -> Regole:
+    """Valida e compila; ValueError con la sezione sbagliata se non vanno."""
+    if not isinstance(dati, dict):
+        raise ValueError("le regole devono essere un oggetto")
+    try:
+        return Regole(dati, origine)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"regole non valide: {e!r}") from None
+
+
+PREDEFINITE = compila(REGOLE_PREDEFINITE)
+
+# versione → Regole: tornare a una versione già vista riusa le stesse tabelle
+_compilate = {PREDEFINITE.versione: PREDEFINITE}
+_attuali = PREDEFINITE
+_lock = threading.Lock()
+_stop = threading.Event()
+_thread = None
+_mtime = None
+
+
+def attuali() -> Regole:
+    """Le regole in vigore: leggere una volta per stima e passarle avanti."""
+    return _attuali
+
+
+def _imposta(dati: dict, origine: str) -> Regole:
+    global _attuali
+    regole = compila(dati, origine)
+    regole = _compilate.setdefault(regole.versione, regole)
+    with _lock:
+        cambiata = regole is not _attuali
+        _attuali = regole          # un solo assegnamento: le stime in corso tengono le loro
+    if cambiata:
+        logger.info("regole del motore attive", extra=regole.descrizione())
+    return regole
+
+
+# ---------------------------------------------------------
+# SORGENTI
+# ---------------------------------------------------------
+def leggi_file(percorso: Path | str) -> dict:
+    percorso = Path(percorso)
+    with open(percorso, encoding="utf-8") as f:
+        if percorso.suffix.lower() == ".json":
+            return json.load(f)
+        import yaml   # solo se le regole stanno in YAML: `import main` resta leggero
+
+        return yaml.safe_load(f) or {}
+
+
+SQL_ATTIVA = "SELECT versione, regole FROM regole_motore WHERE attiva"
+
+
+def _leggi_db(solo_versione: bool = False):
+    from database import get_connection
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT versione FROM regole_motore WHERE attiva" if solo_versione else SQL_ATTIVA)
+        riga = cur.fetchone()
+        cur.close()
+        conn.rollback()
+    finally:
+        conn.close()
+    if riga is None:
+        return None
+    return riga[0] if solo_versione else riga[1]
+
+
+def carica() -> Regole:
+    """Legge la sorgente configurata e, se valida, la mette in vigore."""
+    global _mtime
+    if REGOLE_SORGENTE == "file":
+        if not REGOLE_FILE.exists():
+            _mtime = None
+            return _imposta(REGOLE_PREDEFINITE, "predefinite")
+        # anche se il file non è valido: si riprova solo quando cambia di nuovo
+        _mtime = REGOLE_FILE.stat().st_mtime_ns
+        return _imposta(leggi_file(REGOLE_FILE), str(REGOLE_FILE))
+    if REGOLE_SORGENTE == "db":
+        dati = _leggi_db()
+        if dati is None:
+            return _imposta(REGOLE_PREDEFINITE, "predefinite")
+        return _imposta(dati, "db")
+    return _imposta(REGOLE_PREDEFINITE, "predefinite")
+
+
+def _cambiata() -> bool:
+    if REGOLE_SORGENTE == "file":
+        mtime = REGOLE_FILE.stat().st_mtime_ns if REGOLE_FILE.exists() else None
+        return mtime != _mtime
+    if REGOLE_SORGENTE == "db":
+        return (_leggi_db(solo_versione=True) or PREDEFINITE.versione) != _attuali.versione
+    return False
+
+
+class ConflittoRegole(RuntimeError):
+    """Pubblicazione in conflitto con un'altra in corso (→ 409)."""
+
+
+def pubblica(dati: dict, nota: str | None = None) -> Regole:
+    """Salva le regole in regole_motore come attive (le altre restano nello storico)."""
+    import psycopg2
+    from database import get_connection
+
+    regole = compila(dati, "db")
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        # due pubblicazioni insieme violerebbero idx_regole_motore_attiva
+        # (una sola attiva): il lock le mette in fila, le letture passano
+        cur.execute("LOCK TABLE regole_motore IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute("UPDATE regole_motore SET attiva = FALSE WHERE attiva")
+        cur.execute("""
+            INSERT INTO regole_motore (versione, regole, nota, attiva)
+            VALUES (%s, %s::jsonb, %s, TRUE)
+            ON CONFLICT (versione) DO UPDATE
+              SET attiva = TRUE,
+                  nota = COALESCE(EXCLUDED.nota, regole_motore.nota)
+        """, (regole.versione, json.dumps(regole.dati, ensure_ascii=False), nota))
+        conn.commit()
+        cur.close()
+    except psycopg2.IntegrityError as e:
+        raise ConflittoRegole(f"pubblicazione in conflitto, riprovare: {e.pgerror or e}") from None
+    finally:
+        conn.close()
+    if REGOLE_SORGENTE == "db":
+        _imposta(regole.dati, "db")
+    return regole
+
+
+def storico(limite: int = 20) -> list[dict]:
+    from database import get_connection
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT versione, nota, creato_at, attiva
+            FROM regole_motore
+            ORDER BY creato_at DESC
+            LIMIT %s
+        """, (limite,))
+        righe = [{"versione": v, "nota": n, "creato_at": c.isoformat(), "attiva": a}
+                 for v, n, c, a in cur.fetchall()]
+        cur.close()
+    finally:
+        conn.close()
+    return righe
+
+
+# ---------------------------------------------------------
+# CONTROLLO PERIODICO (thread)
+# ---------------------------------------------------------
+def _ciclo():
+    while not _stop.wait(REGOLE_CONTROLLO_S):
+        try:
+            if _cambiata():
+                carica()
+        except Exception:
+            # regole non valide o sorgente irraggiungibile: restano quelle in vigore
+            logger.exception("aggiornamento regole fallito", extra={"sorgente": REGOLE_SORGENTE})
+
+
+def avvia():
+    """Prima lettura (sincrona) e thread di controllo."""
+    global _thread
+    try:
+        carica()
+    except Exception:
+        logger.exception("regole non caricate: restano le predefinite", extra={"sorgente": REGOLE_SORGENTE})
+    if REGOLE_SORGENTE not in ("file", "db") or REGOLE_CONTROLLO_S <= 0 or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_ciclo, name="regole", daemon=True)
+    _thread.start()
+
+
+def chiudi():
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+        _thread = None
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Regole dei coefficienti del motore")
+    ap.add_argument("--esporta", metavar="FILE", help="scrive le regole predefinite (.json o .yaml)")
+    ap.add_argument("--verifica", metavar="FILE", help="compila un file di regole e ne stampa la versione")
+    ap.add_argument("--pubblica", metavar="FILE", help="salva il file in regole_motore come attivo")
+    ap.add_argument("--nota", help="nota per --pubblica")
+    args = ap.parse_args()
+
+    if args.esporta:
+        with open(args.esporta, "w", encoding="utf-8") as f:
+            if args.esporta.endswith(".json"):
+                json.dump(REGOLE_PREDEFINITE, f, ensure_ascii=False, indent=2)
+            else:
+                import yaml
+
+                yaml.safe_dump(REGOLE_PREDEFINITE, f, allow_unicode=True, sort_keys=False)
+        print(f"📄 {args.esporta} (versione {PREDEFINITE.versione})")
+    elif args.verifica or args.pubblica:
+        try:
+            dati = leggi_file(args.verifica or args.pubblica)
+            r = pubblica(dati, args.nota) if args.pubblica else compila(dati)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        uguali = "(uguali alle predefinite)" if r.versione == PREDEFINITE.versione else ""
+        print(f"✅ versione {r.versione} {uguali}{' pubblicata' if args.pubblica else ''}")
+    else:
+        ap.print_help()
@@ -0,0 +1,265 @@
+# backend/sensibilita.py
+# Forchetta di prezzo e sensibilità: quanto si muove la stima se gli input
+# incerti (stato, vista, distanza dal mare, mq ±5%, anno) sono un po' diversi
+# da quelli dichiarati.
+#
+# Tutte le combinazioni dei livelli (fino a 3^5 = 243) in un solo passaggio
+# numpy, senza chiamare compute_from_payload per ognuna: prezzo_mq_finale
+# è un prodotto di coefficienti e ognuno dipende da un solo input incerto,
+# quindi basta calcolare i coefficienti per livello (una manciata di
+# chiamate scalari) e moltiplicarli in broadcasting. Le regole extra di
+# prezzo_mq_finale sono riportate qui (valori dalle regole, regole.py):
+#   - frontemare + nuovo              → nel vettore di stato
+#   - piano terra + giardino + anno   → nel vettore di anno
+#   - scarso + anno vecchio           → matrice stato × anno
+#   - clamp di coeff_tot nei limiti, dopo il prodotto
+# Se cambia prezzo_mq_finale va aggiornato anche qui:
+#   python sensibilita.py --verifica    (confronto con il motore scalare)
+
+import datetime
+from typing import Any, Dict
+
+from valuation import (
+    compute_from_payload, get_base_mq, normalize_vista_mare, _distanza_payload,
+    coeff_tipologia, coeff_piano, coeff_bagni, coeff_anno, coeff_stato,
+    coeff_locali, coeff_ascensore, coeff_indirizzo, coeff_altro_descrizione,
+    _posizione_coeff, _distanza_coeff, _barriera_coeff, _vista_coeff,
+    _metri, to_int,
+)
+import regole
+
+SCALA_STATO = ("grezzo", "scarso", "buono", "ristrutturato", "nuovo")
+SCALA_VISTA = ("", "scarsa", "parziale", "panoramica")
+# fascia del form → metri (estremi e punto medio)
+FASCE_METRI = {
+    "0-100": (0, 50, 100), "100-300": (100, 200, 300), "300-500": (300, 400, 500),
+    "500-1000": (500, 750, 1000),
+}
+MQ_DELTA = 0.05
+ANNO_DELTA = 5
+DISTANZA_DELTA = 0.25      # sui metri misurati (geocodifica al civico o alla via)
+
+
+def _testo(v) -> str:
+    return str(v or "").strip().lower()
+
+
+def _vicini(scala: tuple, valore: str) -> list:
+    """Il valore e i suoi vicini sulla scala ordinata."""
+    i = scala.index(valore)
+    return list(scala[max(0, i - 1): i + 2])
+
+
+ASSI = ("stato", "vista", "distanza", "anno", "mq")
+
+
+def livelli(payload: Dict[str, Any]) -> tuple[Dict[str, list], Dict[str, int]]:
+    """
+    Valori da provare per ogni input incerto e posizione del valore
+    dichiarato (sempre incluso) in ciascuna lista.
+    """
+    stato = _testo(payload.get("stato"))
+    vista = normalize_vista_mare(payload.get("vistaMareYN", ""),
+                                 payload.get("vistaMareDettaglio", ""),
+                                 payload.get("vistaMare", ""))
+    lv = {
+        "stato": _vicini(SCALA_STATO, stato) if stato in SCALA_STATO else [payload.get("stato", "")],
+        "vista": _vicini(SCALA_VISTA, vista) if vista in SCALA_VISTA else [vista],
+    }
+    centro = {
+        "stato": lv["stato"].index(stato) if stato in SCALA_STATO else 0,
+        "vista": lv["vista"].index(vista),
+    }
+
+    dist = _distanza_payload(payload)
+    metri = _metri(dist)
+    fascia = _testo(dist).replace("–", "-").replace("m", "").replace(" ", "")
+    if metri is not None:
+        lv["distanza"] = sorted({max(0.0, metri * (1 - DISTANZA_DELTA)), metri, metri * (1 + DISTANZA_DELTA)})
+    elif fascia in FASCE_METRI:
+        lv["distanza"] = list(FASCE_METRI[fascia])
+    else:
+        lv["distanza"] = [dist]
+    # metri ±25% o estremi della fascia: il dichiarato è in mezzo
+    centro["distanza"] = len(lv["distanza"]) // 2
+
+    try:
+        mq = float(payload.get("mq") or 0)
+    except (TypeError, ValueError):
+        mq = 0.0
+    lv["mq"] = [mq * (1 - MQ_DELTA), mq, mq * (1 + MQ_DELTA)] if mq > 0 else [mq]
+    centro["mq"] = len(lv["mq"]) // 2
+
+    anno = to_int(payload.get("anno"))
+    if anno:
+        oggi = datetime.date.today().year
+        lv["anno"] = sorted({anno - ANNO_DELTA, anno, min(anno + ANNO_DELTA, oggi)})
+        centro["anno"] = lv["anno"].index(anno)
+    else:
+        lv["anno"] = [payload.get("anno", "")]
+        centro["anno"] = 0
+    return lv, centro
+
+
+def _griglia(payload: Dict[str, Any], lv: Dict[str, list], pertinenze: float,
+             r: regole.Regole | None = None):
+    """Prezzi per tutte le combinazioni: array (stato, vista, distanza, anno, mq)."""
+    import numpy as np   # al primo uso: `import main` resta leggero
+
+    r = r or regole.attuali()
+    base = get_base_mq(payload.get("comune", ""), payload.get("microzona", ""))
+    tipologia = payload.get("tipologia", "")
+    piano = payload.get("piano", "")
+    ascensore = payload.get("ascensore", "")
+    posizione = payload.get("posizioneMare", "")
+    has_giardino = "giardino" in (payload.get("pertinenze", "") or "").lower()
+    c_tip = coeff_tipologia(tipologia, r)
+
+    # coefficienti che non dipendono dagli input incerti
+    fisso = (
+        c_tip * coeff_bagni(to_int(payload.get("bagni", "")), r) *
+        coeff_locali(payload.get("locali", ""), r) * coeff_ascensore(ascensore, piano, r) *
+        coeff_indirizzo(payload.get("via", ""), r) *
+        coeff_altro_descrizione(payload.get("altroDescrizione", ""), r) *
+        _posizione_coeff(posizione, r) * _barriera_coeff(payload.get("barrieraMare", ""), r)
+    )
+    if _testo(tipologia) == "rustico":
+        fisso *= r.rustico / c_tip
+
+    frontemare = _testo(posizione) == "frontemare"
+    terra = _testo(piano) in ("terra", "piano terra")
+    stati = [_testo(s) for s in lv["stato"]]
+    anni = [to_int(a) or 0 for a in lv["anno"]]
+
+    c_stato = np.array([coeff_stato(s, r) * (r.frontemare_nuovo if frontemare and s == "nuovo" else 1.0)
+                        for s in lv["stato"]])
+    c_vista = np.array([coeff_piano(piano, ascensore, posizione, v, r) * _vista_coeff(v, r)
+                        for v in lv["vista"]])
+    c_dist = np.array([_distanza_coeff(d, r) for d in lv["distanza"]])
+    c_anno = np.array([coeff_anno(a, r) * (r.terra_giardino
+                                           if terra and has_giardino and n >= r.terra_giardino_da else 1.0)
+                       for a, n in zip(lv["anno"], anni)])
+    scarso_vecchio = np.array([[r.scarso_vecchio if s == "scarso" and n < r.scarso_prima_del else 1.0
+                                for n in anni] for s in stati])
+    mq = np.array(lv["mq"], dtype=float)
+
+    coeff = (
+        fisso
+        * (c_stato[:, None] * scarso_vecchio)[:, None, None, :]
+        * c_vista[None, :, None, None]
+        * c_dist[None, None, :, None]
+        * c_anno[None, None, None, :]
+    )
+    prezzo_mq = base * np.clip(coeff, r.limite_min, r.limite_max) if base > 0 else np.zeros_like(coeff)
+    return np.round(prezzo_mq[..., None] * mq + pertinenze, 0)
+
+
+def analizza(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Stima puntuale + forchetta (min, p10, mediana, p90, max su tutte le
+    combinazioni, equiprobabili) e impatto di ogni input: escursione del
+    prezzo muovendo solo quello, gli altri fermi al dichiarato.
+    """
+    import numpy as np
+
+    r = regole.attuali()   # stesse regole per la stima puntuale e per la griglia
+    calc = compute_from_payload(payload, r)
+    lv, centro = livelli(payload)
+    prezzi = _griglia(payload, lv, calc["valore_pertinenze"], r)
+
+    fattori = []
+    for asse, nome in enumerate(ASSI):
+        indice = [centro[n] for n in ASSI]
+        indice[asse] = slice(None)
+        lungo = prezzi[tuple(indice)]
+        fattori.append({
+            "fattore": nome,
+            "livelli": [{"valore": v, "price": float(p)} for v, p in zip(lv[nome], lungo)],
+            "impatto": float(lungo.max() - lungo.min()),
+        })
+    fattori.sort(key=lambda f: -f["impatto"])
+
+    tutti = prezzi.ravel()
+    p10, mediana, p90 = np.percentile(tutti, [10, 50, 90])
+    return {
+        "price_exact": calc["price_exact"],
+        "eur_mq_finale": calc["eur_mq_finale"],
+        "min": float(tutti.min()),
+        "p10": float(round(p10)),
+        "mediana": float(round(mediana)),
+        "p90": float(round(p90)),
+        "max": float(tutti.max()),
+        "combinazioni": int(tutti.size),
+        "fattori": fattori,
+    }
+
+
+# ---------------------------------------------------------
+# VERIFICA CONTRO IL MOTORE SCALARE
+# ---------------------------------------------------------
+def verifica(n: int = 300, seme: int = 1) -> int:
+    """Confronta ogni combinazione con compute_from_payload; restituisce le differenze."""
+    import random
+    import itertools
+    from valuation import BASE_MQ
+
+    rnd = random.Random(seme)
+    zone = [(c, z) for c, zz in BASE_MQ.items() for z in zz]
+    differenze = 0
+    for _ in range(n):
+        comune, microzona = rnd.choice(zone)
+        payload = {
+            "comune": comune, "microzona": microzona,
+            "tipologia": rnd.choice(["Appartamento", "Villa", "Rustico", ""]),
+            "mq": rnd.randint(30, 300), "anno": rnd.choice([1960, 1978, 1983, 1998, 2003, 2022, ""]),
+            "stato": rnd.choice(SCALA_STATO + ("",)),
+            "piano": rnd.choice(["terra", "1", "3", "ultimo"]),
+            "ascensore": rnd.choice(["Sì", "No"]), "locali": rnd.choice(["2", "Trilocale", "5"]),
+            "bagni": rnd.choice([1, 2]),
+            "posizioneMare": rnd.choice(["frontemare", "seconda", "oltre", ""]),
+            "distanzaMare": rnd.choice(list(FASCE_METRI) + [">1000", ""]),
+            "distanzaMareM": rnd.choice([None, None, 35.0, 420.0]),
+            "barrieraMare": rnd.choice(["Sì", "No"]),
+            "vistaMare": rnd.choice(SCALA_VISTA),
+            "pertinenze": rnd.choice(["", "giardino", "garage, giardino"]), "mqGarage": 15,
+            "via": rnd.choice(["", "Lungomare Sirena", "Via Nazionale"]),
+        }
+        lv, _ = livelli(payload)
+        prezzi = _griglia(payload, lv, compute_from_payload(payload)["valore_pertinenze"])
+        for idx in itertools.product(*(range(len(lv[k])) for k in ASSI)):
+            s, v, d, a, m = (lv[k][i] for k, i in zip(ASSI, idx))
+            variante = {**payload, "stato": s, "vistaMare": v, "vistaMareYN": "", "vistaMareDettaglio": "",
+                        "anno": a, "mq": m, "distanzaMareM": None, "distanzaMare": d}
+            atteso = compute_from_payload(variante)["price_exact"]
+            if abs(prezzi[idx] - atteso) > 1:
+                differenze += 1
+                if differenze <= 5:
+                    print(f"❌ {variante}: vettoriale {prezzi[idx]}, motore {atteso}")
+    return differenze
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Forchetta di prezzo e sensibilità")
+    ap.add_argument("--verifica", action="store_true", help="confronto con il motore scalare")
+    ap.add_argument("-n", type=int, default=300, help="payload casuali da verificare")
+    args = ap.parse_args()
+
+    if args.verifica:
+        d = verifica(args.n)
+        print("✅ coincide con compute_from_payload" if not d else f"❌ {d} combinazioni diverse")
+        sys.exit(1 if d else 0)
+
+    esempio = {"comune": "Tortoreto", "microzona": "Lido Sud", "mq": 80, "anno": 1990,
+               "stato": "buono", "tipologia": "Appartamento", "piano": "2", "ascensore": "Sì",
+               "posizioneMare": "seconda", "distanzaMare": "100-300", "vistaMare": "parziale"}
+    analizza(esempio)
+    t0 = time.perf_counter()
+    r = analizza(esempio)
+    print(f"{(time.perf_counter() - t0) * 1000:.2f} ms, {r['combinazioni']} combinazioni")
+    print({k: v for k, v in r.items() if k != "fattori"})
+    for f in r["fattori"]:
+        print(f"  {f['fattore']:9} ±{f['impatto'] / 2:,.0f} €")
@@ -0,0 +1,274 @@
+# backend/shadow.py
+# Valutazione "ombra" delle versioni candidate del motore.
+#
+# Un ritocco dei coefficienti in valuation.py va in produzione senza sapere
+# quanto sposta i prezzi. Qui una o più versioni candidate girano su ogni
+# stima reale, FUORI dal percorso della richiesta:
+#   - salva_stima chiama invia(): un put_nowait su una coda limitata, niente
+#     altro (se la coda è piena il confronto si scarta e si conta)
+#   - un thread in background ricalcola il payload con ogni candidata,
+#     confronta con il risultato live e scrive a blocchi in valutazioni_shadow
+# Il riepilogo per comune/tipologia (/api/admin/shadow) dice se promuovere.
+# Il purger cancella i confronti oltre SHADOW_RETENZIONE_GIORNI e toglie il
+# payload a quelli delle stime cancellate.
+#
+# Registro, due tipi di candidate (si caricano nel thread, non all'avvio):
+#   SHADOW_REGOLE="nuove.yaml,altre.json" – coefficienti nuovi: file di
+#     regole (regole.py) compilati e passati al motore live, etichettati
+#     con versione_motore(r). È il caso normale di un ritocco.
+#   SHADOW_MOTORI="modulo1,modulo2" – moduli con ENGINE_VERSION e
+#     compute_from_payload(payload), per cambi al codice del motore (una
+#     copia di valuation.py legge le regole attuali: stessi coefficienti
+#     del live, serve un ENGINE_VERSION diverso).
+# Senza candidate invia() non fa niente.
+
+import os
+import json
+import time
+import queue
+import logging
+import importlib
+import threading
+
+import log
+import metrics
+from database import get_connection
+import regole
+from valuation import ENGINE_VERSION, compute_from_payload, versione_motore
+
+logger = logging.getLogger("stima360.shadow")
+
+SHADOW_MOTORI = [m.strip() for m in os.getenv("SHADOW_MOTORI", "").split(",") if m.strip()]
+SHADOW_REGOLE = [p.strip() for p in os.getenv("SHADOW_REGOLE", "").split(",") if p.strip()]
+SHADOW_CODA = int(os.getenv("SHADOW_CODA", "1000"))
+SHADOW_FLUSH_S = float(os.getenv("SHADOW_FLUSH_S", "5"))
+SHADOW_BLOCCO = 200
+# Scostamento (in %) oltre il quale il confronto è "divergente"
+SHADOW_SOGLIA_PCT = float(os.getenv("SHADOW_SOGLIA_PCT", "0.5"))
+
+CONFRONTI = metrics.Counter(
+    "stima360_shadow_confronti_total",
+    "Confronti motore live / candidato (uguale, divergente, errore, scartato)",
+    ("candidato", "esito"),
+)
+
+# versione → compute_from_payload
+_registro: dict = {}
+_coda: queue.Queue = queue.Queue(maxsize=SHADOW_CODA)
+_stop = threading.Event()
+_thread = None
+
+
+def registra(versione: str, funzione):
+    """Aggiunge una candidata (anche da codice, es. nei check script)."""
+    if versione in (ENGINE_VERSION, versione_motore()):
+        raise ValueError(f"la candidata ha la stessa versione del motore live ({versione})")
+    _registro[versione] = funzione
+
+
+def _carica_moduli():
+    for nome in SHADOW_MOTORI:
+        try:
+            modulo = importlib.import_module(nome)
+            registra(modulo.ENGINE_VERSION, modulo.compute_from_payload)
+            logger.info("motore candidato registrato", extra={
+                "modulo": nome, "versione": modulo.ENGINE_VERSION,
+            })
+        except Exception:
+            logger.exception("motore candidato non caricato", extra={"modulo": nome})
+    for percorso in SHADOW_REGOLE:
+        try:
+            r = regole.compila(regole.leggi_file(percorso), percorso)
+            registra(versione_motore(r), lambda payload, r=r: compute_from_payload(payload, r))
+            logger.info("regole candidate registrate", extra={
+                "file": percorso, "versione": versione_motore(r),
+            })
+        except Exception:
+            logger.exception("regole candidate non caricate", extra={"file": percorso})
+
+
+def candidati() -> list[str]:
+    return sorted(_registro)
+
+
+def attivo() -> bool:
+    return _thread is not None
+
+
+def invia(stima_id: int | None, payload: dict, risultato: dict,
+          versione_live: str | None = None):
+    """Accoda un confronto; non blocca mai la richiesta.
+
+    versione_live: quella delle regole usate per il risultato (le regole
+    possono cambiare prima che il thread arrivi al confronto)."""
+    if not attivo():
+        return
+    try:
+        _coda.put_nowait((stima_id, dict(payload), risultato["price_exact"],
+                          versione_live or versione_motore()))
+    except queue.Full:
+        CONFRONTI.inc(candidato="*", esito="scartato")
+
+
+# ---------------------------------------------------------
+# CONFRONTO E SCRITTURA
+# ---------------------------------------------------------
+def _confronta(stima_id, payload: dict, prezzo_live: float, versione_live: str) -> list[tuple]:
+    righe = []
+    for versione, funzione in list(_registro.items()):
+        try:
+            prezzo = funzione(payload)["price_exact"]
+        except Exception:
+            CONFRONTI.inc(candidato=versione, esito="errore")
+            logger.exception("motore candidato in errore", extra={"candidato": versione})
+            continue
+        delta = (prezzo - prezzo_live) / prezzo_live * 100 if prezzo_live else None
+        divergente = delta is None or abs(delta) > SHADOW_SOGLIA_PCT
+        CONFRONTI.inc(candidato=versione, esito="divergente" if divergente else "uguale")
+        righe.append((
+            stima_id, payload.get("comune"), payload.get("microzona"), payload.get("tipologia"),
+            versione_live, versione, prezzo_live, prezzo, delta,
+            # payload solo per le divergenze: serve a riprodurle
+            json.dumps(payload, default=str) if divergente else None,
+        ))
+    return righe
+
+
+def _scrivi(righe: list[tuple]):
+    from psycopg2.extras import execute_values
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        execute_values(cur, """
+            INSERT INTO valutazioni_shadow
+              (stima_id, comune, microzona, tipologia, engine_live, engine_candidato,
+               price_live, price_candidato, delta_pct, payload)
+            VALUES %s
+        """, righe, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s::jsonb)")
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+
+def _ciclo():
+    _carica_moduli()
+    righe, ultimo_flush = [], time.monotonic()
+    while not (_stop.is_set() and _coda.empty()):
+        try:
+            stima_id, payload, prezzo_live, versione_live = _coda.get(timeout=0.5)
+            righe.extend(_confronta(stima_id, payload, prezzo_live, versione_live))
+        except queue.Empty:
+            pass
+        if righe and (len(righe) >= SHADOW_BLOCCO or _stop.is_set()
+                      or time.monotonic() - ultimo_flush >= SHADOW_FLUSH_S):
+            try:
+                with log.contesto(job="shadow"):
+                    _scrivi(righe)
+            except Exception:
+                metrics.ERRORI.inc(integrazione="db")
+                logger.exception("scrittura confronti shadow fallita", extra={"righe": len(righe)})
+            righe, ultimo_flush = [], time.monotonic()
+
+
+def avvia():
+    global _thread
+    if not (SHADOW_MOTORI or SHADOW_REGOLE or _registro) or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_ciclo, name="shadow", daemon=True)
+    _thread.start()
+
+
+def chiudi():
+    """Svuota la coda (ultimi confronti scritti) e ferma il thread."""
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=10)
+        _thread = None
+
+
+# ---------------------------------------------------------
+# RIEPILOGO (prima della promozione)
+# ---------------------------------------------------------
+SQL_RIEPILOGO = """
+    SELECT engine_candidato, {gruppo},
+           COUNT(*),
+           COUNT(*) FILTER (WHERE delta_pct IS NULL OR ABS(delta_pct) > %(soglia)s),
+           AVG(delta_pct),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY ABS(delta_pct)),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY ABS(delta_pct)),
+           MIN(delta_pct), MAX(delta_pct)
+    FROM valutazioni_shadow
+    WHERE creato_at >= NOW() - %(giorni)s * INTERVAL '1 day'
+      AND (%(candidato)s::text IS NULL OR engine_candidato = %(candidato)s)
+    GROUP BY 1, 2
+    ORDER BY 1, 3 DESC
+"""
+GRUPPI = {"totale": "NULL::text", "comune": "comune", "tipologia": "tipologia",
+          "microzona": "comune || ' / ' || microzona"}
+
+
+def riepilogo(candidato: str | None = None, giorni: int = 7,
+              soglia_pct: float = SHADOW_SOGLIA_PCT) -> dict:
+    """Drift per candidata: totale e per comune, microzona, tipologia."""
+    parametri = {"candidato": candidato, "giorni": giorni, "soglia": soglia_pct}
+    risultato = {}
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        for nome, espressione in GRUPPI.items():
+            cur.execute(SQL_RIEPILOGO.format(gruppo=espressione), parametri)
+            for (cand, chiave, n, divergenti, media, p50, p90, minimo, massimo) in cur.fetchall():
+                voce = {
+                    "n": n, "divergenti": divergenti,
+                    "quota_divergenti": round(divergenti / n, 4) if n else 0.0,
+                    "delta_medio_pct": _r(media), "delta_abs_p50_pct": _r(p50),
+                    "delta_abs_p90_pct": _r(p90), "delta_min_pct": _r(minimo),
+                    "delta_max_pct": _r(massimo),
+                }
+                per_candidato = risultato.setdefault(cand, {})
+                if nome == "totale":
+                    per_candidato["totale"] = voce
+                else:
+                    per_candidato.setdefault(nome, []).append({nome: chiave, **voce})
+        cur.close()
+    finally:
+        conn.close()
+    return risultato
+
+
+def _r(v):
+    return round(float(v), 3) if v is not None else None
+
+
+def divergenze(candidato: str, limite: int = 50) -> list[dict]:
+    """I confronti più lontani dal live, col payload per riprodurli."""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT stima_id, creato_at, comune, microzona, tipologia,
+                   price_live, price_candidato, delta_pct, payload
+            FROM valutazioni_shadow
+            WHERE engine_candidato = %s AND payload IS NOT NULL
+            ORDER BY ABS(delta_pct) DESC NULLS FIRST
+            LIMIT %s
+        """, (candidato, limite))
+        colonne = [d[0] for d in cur.description]
+        righe = [dict(zip(colonne, r)) for r in cur.fetchall()]
+        cur.close()
+    finally:
+        conn.close()
+    for r in righe:
+        r["creato_at"] = r["creato_at"].isoformat()
+        for k in ("price_live", "price_candidato", "delta_pct"):
+            r[k] = float(r[k]) if r[k] is not None else None
+    return righe
+
+
+def stato() -> dict:
+    return {"live": versione_motore(), "candidati": candidati(), "in_coda": _coda.qsize(),
+            "soglia_pct": SHADOW_SOGLIA_PCT}
@@ -0,0 +1,379 @@
+# backend/tracing.py
+# Tracing distribuito compatibile OpenTelemetry (OTLP/HTTP JSON), senza SDK.
+#
+# Come metrics.py, niente dipendenze: gli span sono registrati qui e
+# spediti in formato OTLP JSON a un collector (Jaeger, Tempo, otel-collector
+# su :4318) oppure scritti su file (una riga JSON per blocco di span).
+#
+#   TRACING_EXPORTER=off   (default) nessuno span
+#   TRACING_EXPORTER=otlp  POST su TRACING_ENDPOINT (default http://localhost:4318/v1/traces)
+#   TRACING_EXPORTER=file  append su TRACING_FILE (default /var/tmp/stima360-traces.jsonl)
+#
+# Strumentazione automatica:
+#   - HTTP in ingresso: middleware() in main.py (legge/propaga traceparent W3C)
+#   - HTTP in uscita: requests e urllib.request.urlopen (instrumenta_http)
+#   - DB: CursoreTracciato come cursor_factory di psycopg2 (database.py)
+# Il contesto arriva anche ai worker PDF tramite traceparent().
+#
+# Uso:
+#   with tracing.span("salva_stima.insert", lead_id=42):
+#       ...
+
+import os
+import json
+import time
+import queue
+import atexit
+import secrets
+import threading
+import contextvars
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+import log
+
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "off").lower()
+TRACING_ENDPOINT = os.getenv("TRACING_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_FILE = os.getenv("TRACING_FILE", "/var/tmp/stima360-traces.jsonl")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "stima360-backend")
+
+ATTIVO = TRACING_EXPORTER in ("otlp", "file")
+
+# SpanKind OTLP
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+# Status OTLP
+_OK, _ERRORE = 1, 2
+
+_span_corrente = contextvars.ContextVar("span_corrente", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "nome", "kind",
+                 "inizio", "fine", "attributi", "eventi", "errore")
+
+    def __init__(self, nome, kind=INTERNAL, parent=None, attributi=None):
+        self.trace_id = parent[0] if parent else secrets.token_hex(16)
+        self.parent_id = parent[1] if parent else None
+        self.span_id = secrets.token_hex(8)
+        self.nome = nome
+        self.kind = kind
+        self.inizio = time.time_ns()
+        self.fine = None
+        self.attributi = dict(attributi or {})
+        self.eventi = []
+        self.errore = None
+
+    def imposta(self, **attributi):
+        self.attributi.update(attributi)
+
+    def registra_eccezione(self, e: BaseException):
+        self.errore = f"{type(e).__name__}: {e}"
+        self.eventi.append((time.time_ns(), "exception", {
+            "exception.type": type(e).__name__,
+            "exception.message": str(e),
+        }))
+
+    def otlp(self) -> dict:
+        d = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.nome,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.inizio),
+            "endTimeUnixNano": str(self.fine or time.time_ns()),
+            "attributes": _attributi_otlp(self.attributi),
+            "status": ({"code": _ERRORE, "message": self.errore}
+                       if self.errore else {"code": _OK}),
+        }
+        if self.parent_id:
+            d["parentSpanId"] = self.parent_id
+        if self.eventi:
+            d["events"] = [
+                {"timeUnixNano": str(t), "name": n, "attributes": _attributi_otlp(a)}
+                for t, n, a in self.eventi
+            ]
+        return d
+
+
+def _valore_otlp(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def _attributi_otlp(attributi: dict) -> list:
+    return [{"key": k, "value": _valore_otlp(v)}
+            for k, v in attributi.items() if v is not None]
+
+
+# ---------------------------------------------------------
+# API
+# ---------------------------------------------------------
+@contextmanager
+def span(nome: str, kind: int = INTERNAL, **attributi):
+    """Span figlio di quello corrente (o radice di una nuova trace)."""
+    if not ATTIVO:
+        yield None
+        return
+    padre = _span_corrente.get()
+    s = Span(nome, kind, (padre.trace_id, padre.span_id) if padre else None, attributi)
+    token = _span_corrente.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.registra_eccezione(e)
+        raise
+    finally:
+        _span_corrente.reset(token)
+        s.fine = time.time_ns()
+        _esportatore.aggiungi(s)
+
+
+def imposta(**attributi):
+    """Aggiunge attributi allo span corrente (se c'è)."""
+    s = _span_corrente.get()
+    if s is not None:
+        s.imposta(**attributi)
+
+
+def traceparent() -> str | None:
+    """Header W3C dello span corrente (per HTTP in uscita e job in background)."""
+    s = _span_corrente.get()
+    if s is None:
+        return None
+    return f"00-{s.trace_id}-{s.span_id}-01"
+
+
+def _da_traceparent(valore: str | None):
+    try:
+        versione, trace_id, span_id, _flag = (valore or "").split("-")
+        if len(trace_id) == 32 and len(span_id) == 16 and versione == "00":
+            return trace_id, span_id
+    except ValueError:
+        pass
+    return None
+
+
+@contextmanager
+def span_remoto(nome: str, traceparent_padre: str | None, kind: int = INTERNAL, **attributi):
+    """Span il cui padre arriva da un altro processo (header o job)."""
+    if not ATTIVO:
+        yield None
+        return
+    padre = _da_traceparent(traceparent_padre)
+    s = Span(nome, kind, padre, attributi)
+    token = _span_corrente.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.registra_eccezione(e)
+        raise
+    finally:
+        _span_corrente.reset(token)
+        s.fine = time.time_ns()
+        _esportatore.aggiungi(s)
+
+
+# ---------------------------------------------------------
+# ESPORTAZIONE (thread in background, a blocchi)
+# ---------------------------------------------------------
+class _Esportatore:
+    BLOCCO = 256
+    INTERVALLO = 2.0
+
+    def __init__(self):
+        self._coda = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def aggiungi(self, s: Span):
+        # dopo un fork il thread del padre non esiste: se ne avvia uno nuovo
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(
+                        target=self._ciclo, name="tracing", daemon=True)
+                    self._thread.start()
+        self._coda.put(s)
+
+    def _ciclo(self):
+        while True:
+            blocco = [self._coda.get()]
+            if blocco[0] is None:
+                return
+            scadenza = time.monotonic() + self.INTERVALLO
+            fine = False
+            while len(blocco) < self.BLOCCO:
+                try:
+                    s = self._coda.get(timeout=max(0.0, scadenza - time.monotonic()))
+                except queue.Empty:
+                    break
+                if s is None:
+                    fine = True
+                    break
+                blocco.append(s)
+            self._invia(blocco)
+            if fine:
+                return
+
+    def _invia(self, spans):
+        corpo = {"resourceSpans": [{
+            "resource": {"attributes": _attributi_otlp({
+                "service.name": SERVICE_NAME,
+                "process.pid": os.getpid(),
+            })},
+            "scopeSpans": [{
+                "scope": {"name": "stima360"},
+                "spans": [s.otlp() for s in spans],
+            }],
+        }]}
+        dati = json.dumps(corpo, separators=(",", ":")).encode("utf-8")
+        try:
+            if TRACING_EXPORTER == "file":
+                # una write in append per blocco: righe intere anche con più processi
+                fd = os.open(TRACING_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, dati + b"\n")
+                finally:
+                    os.close(fd)
+            else:
+                req = urllib.request.Request(
+                    TRACING_ENDPOINT, data=dati, method="POST",
+                    headers={"Content-Type": "application/json"})
+                _urlopen_originale(req, timeout=5).read()
+        except Exception:
+            # il tracing non deve mai rompere l'app: gli span persi si perdono
+            pass
+
+    def chiudi(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self._coda.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+            self._pid = None
+
+
+_esportatore = _Esportatore()
+
+
+def chiudi():
+    """Spedisce gli span rimasti in coda (shutdown)."""
+    _esportatore.chiudi()
+
+
+atexit.register(chiudi)
+
+
+# ---------------------------------------------------------
+# STRUMENTAZIONE AUTOMATICA
+# ---------------------------------------------------------
+_urlopen_originale = urllib.request.urlopen
+
+
+def _urlopen_tracciato(url, *args, **kwargs):
+    metodo = url.get_method() if isinstance(url, urllib.request.Request) else "GET"
+    indirizzo = url.full_url if isinstance(url, urllib.request.Request) else str(url)
+    with span(f"HTTP {metodo}", CLIENT, **{
+        "http.request.method": metodo,
+        "url.full": indirizzo.split("?")[0],
+    }) as s:
+        if isinstance(url, urllib.request.Request) and s is not None:
+            url.add_unredirected_header("traceparent", traceparent())
+        try:
+            resp = _urlopen_originale(url, *args, **kwargs)
+        except urllib.error.HTTPError as e:
+            s.imposta(**{"http.response.status_code": e.code})
+            raise
+        s.imposta(**{"http.response.status_code": resp.status})
+        return resp
+
+
+def instrumenta_http():
+    """Span CLIENT per requests e urllib.request.urlopen (idempotente)."""
+    if not ATTIVO or urllib.request.urlopen is _urlopen_tracciato:
+        return
+    urllib.request.urlopen = _urlopen_tracciato
+
+    try:
+        import requests.sessions
+    except ImportError:
+        return
+    originale = requests.sessions.Session.request
+
+    def request_tracciata(self, method, url, *args, **kwargs):
+        with span(f"HTTP {method.upper()}", CLIENT, **{
+            "http.request.method": method.upper(),
+            "url.full": str(url).split("?")[0],
+        }) as s:
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers["traceparent"] = traceparent()
+            resp = originale(self, method, url, *args, headers=headers, **kwargs)
+            s.imposta(**{"http.response.status_code": resp.status_code})
+            if resp.status_code >= 500:
+                s.errore = f"HTTP {resp.status_code}"
+            return resp
+
+    requests.sessions.Session.request = request_tracciata
+
+
+def _cursore_tracciato():
+    import psycopg2.extensions
+
+    class CursoreTracciato(psycopg2.extensions.cursor):
+        """Uno span CLIENT per ogni execute/executemany."""
+
+        def execute(self, query, vars=None):
+            with span("db.query", CLIENT, **{
+                "db.system": "postgresql",
+                "db.statement": _statement(query),
+            }) as s:
+                risultato = super().execute(query, vars)
+                s.imposta(**{"db.rowcount": self.rowcount})
+                return risultato
+
+        def executemany(self, query, vars_list):
+            with span("db.query", CLIENT, **{
+                "db.system": "postgresql",
+                "db.statement": _statement(query),
+            }):
+                return super().executemany(query, vars_list)
+
+    return CursoreTracciato
+
+
+def _statement(query) -> str:
+    testo = query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+    return " ".join(testo.split())[:2000]
+
+
+# cursor_factory da passare a psycopg2.connect (None se il tracing è spento)
+CursoreTracciato = _cursore_tracciato() if ATTIVO else None
+
+
+# ---------------------------------------------------------
+# MIDDLEWARE HTTP (span SERVER per ogni richiesta)
+# ---------------------------------------------------------
+async def middleware(request, call_next):
+    if not ATTIVO:
+        return await call_next(request)
+    with span_remoto(f"HTTP {request.method}", request.headers.get("traceparent"), SERVER, **{
+        "http.request.method": request.method,
+        "url.path": request.url.path,
+        "stima360.request_id": log.request_id.get(),
+    }) as s, log.contesto(trace_id=s.trace_id):
+        response = await call_next(request)
+        route = getattr(request.scope.get("route"), "path", None)
+        if route:
+            s.nome = f"{request.method} {route}"
+            s.imposta(**{"http.route": route})
+        s.imposta(**{"http.response.status_code": response.status_code})
+        if response.status_code >= 500:
+            s.errore = f"HTTP {response.status_code}"
+        return response
@@ -1,8 +1,19 @@
 # /Users/censorsrc/Desktop/Stima360/backend/valuation.py
 from typing import Dict, Any, Optional
 import math
+import json
+import hashlib
 from decimal import Decimal
 
+import regole
+from regole import Regole
+
+# ---------------------------
+# Versione motore (da aggiornare quando cambia la logica; i valori dei
+# coefficienti stanno in regole.py e hanno la loro versione)
+# ---------------------------
+ENGINE_VERSION = "2026.10"
+
 # ---------------------------
 # Base €/mq per comune+microzona
 # ---------------------------
@@ -168,9 +179,23 @@ BASE_MQ = {
     },
 }
 
+def _versione_catalogo(catalogo: Dict[str, Dict[str, float]]) -> str:
+    """Hash corto del listino: cambia solo se cambiano comuni, zone o prezzi."""
+    raw = json.dumps(catalogo, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+CATALOG_VERSION = _versione_catalogo(BASE_MQ)
+
 def normalize_text(s: str) -> str:
     return (s or "").replace("’", "'").strip()
 
+_COMUNI_CANONICI = {normalize_text(c).lower(): c for c in BASE_MQ}
+
+def comune_canonico(nome: str) -> str | None:
+    """Nome del comune come in BASE_MQ (maiuscole, apostrofi, "_" e spazi tollerati)."""
+    chiave = " ".join(normalize_text((nome or "").replace("_", " ")).split()).lower()
+    return _COMUNI_CANONICI.get(chiave)
+
 def get_base_mq(comune: str, microzona: str) -> float:
     comune = normalize_text(comune)
     microzona = normalize_text(microzona)
@@ -183,38 +208,50 @@ def get_base_mq(comune: str, microzona: str) -> float:
 
     return 0.0
 
+# ---------------------------
+# Regole dei coefficienti (regole.py)
+# ---------------------------
+# I valori stanno in regole.py (predefinite, YAML o DB) e arrivano qui già
+# compilati in tabelle. Ogni funzione accetta le regole da usare (`r`):
+# compute_from_payload le prende una volta, così un cambio a caldo non
+# mescola due versioni nella stessa stima. Senza `r` valgono le attuali.
+
+def versione_motore(r: Optional[Regole] = None) -> str:
+    """ENGINE_VERSION, più la versione delle regole se non sono le predefinite."""
+    r = r or regole.attuali()
+    if r.versione == regole.PREDEFINITE.versione:
+        return ENGINE_VERSION
+    return f"{ENGINE_VERSION}+{r.versione}"
+
 # ---------------------------
 # Coefficienti tipologia
 # ---------------------------
-def coeff_tipologia(tipologia: str) -> float:
+def coeff_tipologia(tipologia: str, r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
     t = (tipologia or "").strip().lower()
-    if t == "appartamento":
-        return 1.00
-    if t == "villa":
-        return 1.20
-    if t == "rustico":
-        return 0.80
     # Altro / default
-    return 1.00
+    return r.tipologia.get(t, r.tipologia_altrimenti)
 
 # ---------------------------
 # Bagni
 # ---------------------------
-def coeff_bagni(n_bagni: int) -> float:
+def coeff_bagni(n_bagni: int, r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
     try:
         n = int(n_bagni)
     except Exception:
         n = 0
-    return 1.10 if n >= 2 else 1.00
+    return r.bagni if n >= r.bagni_da else 1.00
 
 # ---------------------------
 # Locali
 # ---------------------------
-def coeff_locali(locali: str) -> float:
+def coeff_locali(locali: str, r: Optional[Regole] = None) -> float:
     """
     Leggero coeff in base al numero di locali.
     Accetta sia "3", sia "Trilocale", ecc.
     """
+    r = r or regole.attuali()
     txt = (locali or "").strip().lower()
     n = 0
 
@@ -233,24 +270,21 @@ def coeff_locali(locali: str) -> float:
         elif "penta" in txt or "5" in txt:
             n = 5
 
-    if n <= 1:
-        return 0.96
-    if n in (2, 3):
-        return 1.00
-    if n == 4:
-        return 1.03
-    if n >= 5:
-        return 1.05
-    return 1.00
+    if n <= r.locali_min:
+        return r.locali[r.locali_min]
+    if n >= r.locali_max:
+        return r.locali[r.locali_max]
+    return r.locali.get(n, 1.00)
 
 # ---------------------------
 # Ascensore (micro bonus separato)
 # ---------------------------
-def coeff_ascensore(ascensore: str, piano: str) -> float:
+def coeff_ascensore(ascensore: str, piano: str, r: Optional[Regole] = None) -> float:
     """
     Micro bonus se c'è ascensore da 2° piano in su.
     Il grosso dell'effetto rimane dentro coeff_piano.
     """
+    r = r or regole.attuali()
     val = (ascensore or "").strip().lower()
     has_lift = val in ("si", "sì", "true", "1", "yes", "y")
 
@@ -258,115 +292,90 @@ def coeff_ascensore(ascensore: str, piano: str) -> float:
     if kind != "numero" or num is None:
         return 1.00
 
-    if num >= 2 and has_lift:
-        return 1.02
+    if num >= r.ascensore_da and has_lift:
+        return r.ascensore
 
     return 1.00
 
 # ---------------------------
 # Anno
 # ---------------------------
-def coeff_anno(anno: int) -> float:
+def coeff_anno(anno: int, r: Optional[Regole] = None) -> float:
     try:
         a = int(anno)
     except Exception:
         return 1.00
 
-    # Nuovi valori più realistici per immobili recenti
-    if a >= 2025:
-        return 1.28
-    if a == 2024:
-        return 1.26
-    if a == 2023:
-        return 1.24
-    if a == 2022:
-        return 1.22
-    if a == 2021:
-        return 1.20
-
-    # Recenti (2010–2020)
-    if 2010 <= a <= 2020:
-        return 1.15
-
-    # Buona modernità (2005–2009)
-    if 2005 <= a <= 2009:
-        return 1.12
-
-    # Ottime condizioni (1995–2004)
-    if 1995 <= a <= 2004:
-        return 1.06
-
-    # Standard
-    if 1980 <= a <= 1994:
-        return 1.00
-    if 1970 <= a <= 1979:
-        return 0.92
-    if 1960 <= a <= 1969:
-        return 0.88
-    if 1950 <= a <= 1959:
-        return 0.82
-
-    # Molto vecchio o sconosciuto
-    return 1.00
-
+    # fasce già risolte anno per anno (regole.py)
+    return (r or regole.attuali()).coeff_anno(a)
 
 
 # ---------------------------
 # Stato
 # ---------------------------
-def coeff_stato(stato: str) -> float:
+def coeff_stato(stato: str, r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
     s = (stato or "").strip().lower()
-    if s == "nuovo":         return 1.05   # prima 1.15
-    if s == "ristrutturato": return 1.05   # prima 1.10
-    if s == "buono":         return 1.00
-    if s == "scarso":        return 0.85   # prima 0.80
-    if s == "grezzo":        return 0.80   # prima 0.70
-    return 1.00
+    return r.stato.get(s, r.stato_altrimenti)
 
 
 # ---------------------------
 # Mare
 # ---------------------------
-def _posizione_coeff(pos: str) -> float:
+def _posizione_coeff(pos: str, r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
     p = (pos or "").strip().lower()
-    if p == "frontemare": return 1.15   # prima 1.30
-    if p == "seconda":    return 1.08   # prima 1.20
-    return 1.00
+    return r.posizione.get(p, r.posizione_altrimenti)
+
+def _metri(dist) -> float | None:
+    if isinstance(dist, (int, float)):
+        return float(dist)
+    try:
+        return float(str(dist).strip())
+    except (TypeError, ValueError):
+        return None
+
+def _distanza_coeff(dist: str, r: Optional[Regole] = None) -> float:
+    # Distanza in metri (costa.py): interpolazione lineare tra i punti della
+    # curva, costante fuori dagli estremi
+    r = r or regole.attuali()
+    metri = _metri(dist)
+    if metri is not None:
+        curva = r.distanza_curva
+        if metri <= curva[0][0]:
+            return curva[0][1]
+        for (m0, c0), (m1, c1) in zip(curva, curva[1:]):
+            if metri <= m1:
+                return round(c0 + (c1 - c0) * (metri - m0) / (m1 - m0), 4)
+        return curva[-1][1]
 
-def _distanza_coeff(dist: str) -> float:
     d = (dist or "").strip().lower()
     d = d.replace("–", "-")
     d = d.replace("m", "").replace(" ", "")  # toglie m e spazi ovunque
+    return r.distanza_fasce.get(d, r.distanza_altrimenti)
 
-    if d == "0-100":     return 1.15
-    if d == "100-300":   return 1.03
-    if d == "300-500":   return 1.01
-    if d == "500-1000":  return 1.00
-    return 0.97
-
-def _barriera_coeff(bar: str) -> float:
+def _barriera_coeff(bar: str, r: Optional[Regole] = None) -> float:
     b = (bar or "").strip().lower()
-    return 0.90 if b == "si" or b == "sì" else 1.00
+    if b == "si" or b == "sì":
+        return (r or regole.attuali()).barriera
+    return 1.00
 
-def _vista_coeff(vista: str) -> float:
+def _vista_coeff(vista: str, r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
     v = (vista or "").strip().lower()
 
     # Normalizza i nomi
     if v == "vista":
         v = "panoramica"
 
-    if v == "panoramica":
-        return 1.10
-    if v == "parziale":
-        return 1.04
-    if v == "scarsa":
-        return 1.02
-
-    return 1.00
+    return r.vista.get(v, r.vista_altrimenti)
 
 
-def coeff_mare(posizione: str, distanza: str, barriera: str, vista: str) -> float:
-    return _posizione_coeff(posizione) * _distanza_coeff(distanza) * _barriera_coeff(barriera) * _vista_coeff(vista)
+def coeff_mare(posizione: str, distanza: str, barriera: str, vista: str,
+               r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
+    return (_posizione_coeff(posizione, r) * _distanza_coeff(distanza, r) *
+            _barriera_coeff(barriera, r) * _vista_coeff(vista, r))
 
 
 def normalize_vista_mare(vista_yn: str, vista_det: str, vista_raw: str = "") -> str:
@@ -419,7 +428,9 @@ def _parse_piano(piano: str):
     except Exception:
         return "numero", None
 
-def coeff_piano(piano: str, ascensore: str, posizioneMare: str, vistaMare: str) -> float:
+def coeff_piano(piano: str, ascensore: str, posizioneMare: str, vistaMare: str,
+                r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
     kind, num = _parse_piano(piano)
     val = str(ascensore).strip().lower() if ascensore is not None else ""
     has_lift = val in ("si", "sì", "true", "1", "yes", "y")
@@ -427,26 +438,18 @@ def coeff_piano(piano: str, ascensore: str, posizioneMare: str, vistaMare: str)
     coeff = 1.00
 
     if kind == "terra":
-        coeff *= 1.03   # prima 1.05
+        coeff *= r.piano_terra
     elif kind == "numero":
-        if num is None:
+        if num is None or num <= r.piano_neutri:
             pass
-        elif num in (1, 2):
-            coeff *= 1.00
-        elif num >= 3:
-            if has_lift:
-                # +2% per piano oltre il 2°
-                coeff *= (1.00 + 0.02 * (num - 2))   # prima 3%
-            else:
-                if num == 3:
-                    coeff *= 0.75   # meno punitivo
-                elif num == 4:
-                    coeff *= 0.70
-                else:
-                    coeff *= 0.60
+        elif has_lift:
+            # bonus per piano oltre i neutri
+            coeff *= (1.00 + r.piano_bonus * (num - r.piano_neutri))
+        else:
+            coeff *= r.piano_senza.get(num, r.piano_senza_oltre)
     elif kind == "ultimo":
         if has_lift:
-            coeff *= 1.06   # prima 1.10
+            coeff *= r.piano_ultimo
 
     # ❌ NIENTE più extra frontemare+ultimo+vista
     return coeff
@@ -454,7 +457,7 @@ def coeff_piano(piano: str, ascensore: str, posizioneMare: str, vistaMare: str)
 # ---------------------------
 # Indirizzo
 # ---------------------------
-def coeff_indirizzo(via: str) -> float:
+def coeff_indirizzo(via: str, r: Optional[Regole] = None) -> float:
     """
     Piccola correzione in base alla via.
     """
@@ -462,19 +465,16 @@ def coeff_indirizzo(via: str) -> float:
     if not v:
         return 1.00
 
-    if "lungomare" in v:
-        return 1.05
-    if "sirena" in v:
-        return 1.03
-    if "nazionale" in v or "statale" in v:
-        return 0.97
+    for parole, coeff in (r or regole.attuali()).indirizzo:
+        if any(k in v for k in parole):
+            return coeff
 
     return 1.00
 
 # ---------------------------
 # Altro descrizione
 # ---------------------------
-def coeff_altro_descrizione(altro: str) -> float:
+def coeff_altro_descrizione(altro: str, r: Optional[Regole] = None) -> float:
     """
     Leggero aggiustamento sulla descrizione libera.
     """
@@ -482,132 +482,84 @@ def coeff_altro_descrizione(altro: str) -> float:
     if not t:
         return 1.00
 
-    if any(k in t for k in ("lusso", "signorile", "finemente", "di pregio")):
-        return 1.03
-
-    if any(k in t for k in ("da ristrutturare", "da completare", "grezzo", "allo stato originale")):
-        return 0.95
-
-    if "vista mare totale" in t or "vista mare panoramica" in t:
-        # vista già entra nei coeff mare, ma diamo un +1% extra
-        return 1.01
+    for parole, coeff in (r or regole.attuali()).altro:
+        if any(k in t for k in parole):
+            return coeff
 
     return 1.00
 
 # ---------------------------
 # Pertinenze (somma in €)
 # ---------------------------
-def valore_pertinenze(flags: Dict[str, Any], base_mq: float, posizioneMare: str) -> float:
+def _mq_flag(flags: Dict[str, Any], chiave: str) -> float:
+    try:
+        return float(flags.get(chiave) or 0)
+    except Exception:
+        return 0.0
+
+def _a_mq(flags: Dict[str, Any], chiave: str, voce: Dict[str, float]) -> float:
+    """€ di una pertinenza a mq: eur_mq × mq se indicati, altrimenti forfait."""
+    mq = _mq_flag(flags, chiave)
+    return mq * voce["eur_mq"] if mq > 0 else voce["forfait"]
+
+def valore_pertinenze(flags: Dict[str, Any], base_mq: float, posizioneMare: str,
+                      r: Optional[Regole] = None) -> float:
+    r = r or regole.attuali()
+    p = r.pertinenze
     fm = (posizioneMare or "").strip().lower() == "frontemare"
     euro = 0.0
 
-    # Garage (già ok)
+    # Garage: minimo garantito, maggiorato se frontemare
     if flags.get("Garage"):
-        try:
-            mq_gar = float(flags.get("mqGarage") or 0)
-        except Exception:
-            mq_gar = 0.0
+        g = p["garage"]
+        mq_gar = _mq_flag(flags, "mqGarage")
 
         if mq_gar > 0:
-            garage_base = max(18000.0, 500.0 * mq_gar)
+            garage_base = max(g.get("minimo", 0.0), g["eur_mq"] * mq_gar)
         else:
-            garage_base = 10000.0
+            garage_base = g["forfait"]
 
         if fm:
-            garage_base *= 1.15
+            garage_base *= g.get("frontemare", 1.0)
 
         euro += garage_base
 
-    # Posto Auto — con mq
+    # Posto auto, cantina, soffitta, taverna — con mq
     if flags.get("Posto Auto"):
-        try:
-            mq_pa = float(flags.get("mqPostoAuto") or 0)
-        except:
-            mq_pa = 0.0
-
-        if mq_pa > 0:
-            euro += mq_pa * 850.0
-        else:
-            euro += 10000.0
-
-    # Cantina — con mq
+        euro += _a_mq(flags, "mqPostoAuto", p["posto auto"])
     if flags.get("Cantina"):
-        try:
-            mq_ca = float(flags.get("mqCantina") or 0)
-        except:
-            mq_ca = 0.0
-
-        if mq_ca > 0:
-            euro += mq_ca * 550.0
-        else:
-            euro += 10000.0
-
-    # Soffitta — con mq
+        euro += _a_mq(flags, "mqCantina", p["cantina"])
     if flags.get("Soffitta"):
-        try:
-            mq_sf = float(flags.get("mqSoffitta") or 0)
-        except:
-            mq_sf = 0.0
-
-        if mq_sf > 0:
-            euro += mq_sf * 200.0
-        else:
-            euro += 20000.0
-
-    # Taverna — con mq
+        euro += _a_mq(flags, "mqSoffitta", p["soffitta"])
     if flags.get("Taverna"):
-        try:
-            mq_tav = float(flags.get("mqTaverna") or 0)
-        except:
-            mq_tav = 0.0
-
-        if mq_tav > 0:
-            euro += mq_tav * 1150.0
-        else:
-            euro += 12000.0
+        euro += _a_mq(flags, "mqTaverna", p["taverna"])
 
     # Balconi — numerati
     if flags.get("Balconi"):
         try:
             n_bal = int(flags.get("numBalconi") or 0)
-        except:
+        except Exception:
             n_bal = 0
 
         if n_bal > 0:
-            euro += n_bal * 1000.0
+            euro += n_bal * p["balconi"]["eur_cad"]
         else:
-            euro += 3000.0
+            euro += p["balconi"]["forfait"]
 
     # Terrazzo — con mq
     if flags.get("Terrazzo"):
-        try:
-            mq_ter = float(flags.get("mqTerrazzo") or 0)
-        except:
-            mq_ter = 0.0
-
-        if mq_ter > 0:
-            euro += mq_ter * 250.0
-        else:
-            euro += 4500.0
+        euro += _a_mq(flags, "mqTerrazzo", p["terrazzo"])
 
-    # Giardino — già ok
+    # Giardino — una frazione del €/mq della zona
     if flags.get("Giardino"):
-        try:
-            mq_g = float(flags.get("mqGiardino") or 0)
-        except:
-            mq_g = 0.0
-
-        euro += mq_g * (base_mq / 5.0)
+        euro += _mq_flag(flags, "mqGiardino") * (base_mq / r.giardino_divisore)
 
     # Extra da testo generico pertinenze (es. Piscina, posto moto, bici)
     text = (flags.get("pertinenze_text") or "").strip().lower()
     if text:
-        if "piscina" in text:
-            euro += 15000.0
-        if "posto moto" in text:
-            euro += 3000.0
-        if "posto bici" in text or "posto bicicle" in text:
-            euro += 1000.0
+        for parola, valore in r.pertinenze_testo:
+            if parola in text:
+                euro += valore
 
     return euro
 
@@ -637,23 +589,25 @@ def prezzo_mq_finale(
     via: str = "",
     altro_descrizione: str = "",
     has_giardino: bool = False,
+    r: Optional[Regole] = None,
 ) -> float:
     if base_mq <= 0:
         return 0.0
 
-    c_tip   = coeff_tipologia(tipologia)
-    c_piano = coeff_piano(piano, ascensore, posizioneMare, vistaMare)
+    r = r or regole.attuali()
+    c_tip   = coeff_tipologia(tipologia, r)
+    c_piano = coeff_piano(piano, ascensore, posizioneMare, vistaMare, r)
 
     # --- FIX 2: cast robusti ---
-    c_bagni = coeff_bagni(to_int(bagni))
-    c_anno  = coeff_anno(to_int(anno))
+    c_bagni = coeff_bagni(to_int(bagni), r)
+    c_anno  = coeff_anno(to_int(anno), r)
 
-    c_stato = coeff_stato(stato)
-    c_mare  = coeff_mare(posizioneMare, distanzaMare, barrieraMare, vistaMare)
-    c_loc   = coeff_locali(locali)
-    c_asc   = coeff_ascensore(ascensore, piano)
-    c_via   = coeff_indirizzo(via)
-    c_altro = coeff_altro_descrizione(altro_descrizione)
+    c_stato = coeff_stato(stato, r)
+    c_mare  = coeff_mare(posizioneMare, distanzaMare, barrieraMare, vistaMare, r)
+    c_loc   = coeff_locali(locali, r)
+    c_asc   = coeff_ascensore(ascensore, piano, r)
+    c_via   = coeff_indirizzo(via, r)
+    c_altro = coeff_altro_descrizione(altro_descrizione, r)
 
     coeff_tot = (
         c_tip *
@@ -671,25 +625,26 @@ def prezzo_mq_finale(
     # --- REGOLE EXTRA ---
     if (str(posizioneMare).strip().lower() == "frontemare" and
         str(stato).strip().lower() == "nuovo"):
-        coeff_tot *= 1.10
+        coeff_tot *= r.frontemare_nuovo
 
     if str(tipologia).strip().lower() == "rustico":
-        coeff_tot *= 0.60 / c_tip
+        coeff_tot *= r.rustico / c_tip
 
     try:
         anno_int = to_int(anno)
     except:
         anno_int = 0
 
-    if str(piano).strip().lower() in ("terra", "piano terra") and has_giardino and anno_int >= 2000:
-        coeff_tot *= 1.10
+    if (str(piano).strip().lower() in ("terra", "piano terra") and has_giardino
+            and anno_int >= r.terra_giardino_da):
+        coeff_tot *= r.terra_giardino
+
+    if anno_int < r.scarso_prima_del and str(stato).strip().lower() == "scarso":
+        coeff_tot *= r.scarso_vecchio
 
-    if anno_int < 1980 and str(stato).strip().lower() == "scarso":
-        coeff_tot *= 0.80
 
-    
     # --- FIX 4: CAP realistico per immobili premium ---
-    coeff_tot = max(0.50, min(coeff_tot, 2.20))
+    coeff_tot = max(r.limite_min, min(coeff_tot, r.limite_max))
 
     return base_mq * coeff_tot
 
@@ -706,7 +661,13 @@ def valore_totale(prezzo_mq_finale_: float, mq: float, pertinenze_euro: float) -
 # ---------------------------
 # Funzione comoda: input dal payload del form
 # ---------------------------
-def compute_from_payload(payload: Dict[str, Any]) -> Dict[str, float]:
+def _distanza_payload(payload: Dict[str, Any]):
+    metri = _metri(payload.get("distanzaMareM"))
+    return metri if metri is not None else payload.get("distanzaMare", "")
+
+def compute_from_payload(payload: Dict[str, Any], r: Optional[Regole] = None) -> Dict[str, float]:
+    # una sola lettura delle regole per tutta la stima (cambio a caldo)
+    r = r or regole.attuali()
     comune = payload.get("comune", "")
     microzona = payload.get("microzona", "")
     base = get_base_mq(comune, microzona)
@@ -757,7 +718,8 @@ def compute_from_payload(payload: Dict[str, Any]) -> Dict[str, float]:
     }
     pert_eur = valore_pertinenze(
         flags, base_mq=base,
-        posizioneMare=payload.get("posizioneMare", "")
+        posizioneMare=payload.get("posizioneMare", ""),
+        r=r,
     )
 
     try:
@@ -775,12 +737,14 @@ def compute_from_payload(payload: Dict[str, Any]) -> Dict[str, float]:
         anno=payload.get("anno", ""),
         stato=payload.get("stato", ""),
         posizioneMare=payload.get("posizioneMare", ""),
-        distanzaMare=payload.get("distanzaMare", ""),
+        # metri dalla costa se noti (costa.py), altrimenti la fascia del form
+        distanzaMare=_distanza_payload(payload),
         barrieraMare=payload.get("barrieraMare", ""),
         vistaMare=vista_norm,
         via=payload.get("via", ""),
         altro_descrizione=payload.get("altroDescrizione", ""),
-        has_giardino=("giardino" in (payload.get("pertinenze","") or "").lower())
+        has_giardino=("giardino" in (payload.get("pertinenze","") or "").lower()),
+        r=r,
     )
 
 
@@ -796,6 +760,51 @@ def compute_from_payload(payload: Dict[str, Any]) -> Dict[str, float]:
     }
 
 
+# ---------------------------
+# Payload dalla riga DB (tabella stime)
+# ---------------------------
+def payload_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Ricostruisce il payload del motore da una riga di `stime`.
+    Postgres restituisce i nomi colonna in minuscolo (posizionemare, ...),
+    il motore invece usa le chiavi camelCase del form.
+    """
+    asc = str(row.get("ascensore") or "").strip().lower()
+    return {
+        "comune":     row.get("comune"),
+        "microzona":  row.get("microzona"),
+        "tipologia":  row.get("tipologia"),
+        "mq":         row.get("mq"),
+        "piano":      row.get("piano"),
+        "locali":     str(row["locali"]) if row.get("locali") is not None else "",
+        "bagni":      row.get("bagni"),
+        "ascensore":  "Sì" if asc in ("true", "t", "1", "si", "sì", "yes") else "No",
+        "anno":       row.get("anno"),
+        "stato":      row.get("stato"),
+
+        "posizioneMare":      row.get("posizionemare"),
+        "distanzaMare":       row.get("distanzamare"),
+        "distanzaMareM":      row.get("distanza_mare_m"),
+        "barrieraMare":       row.get("barrieramare"),
+        "vistaMareYN":        row.get("vistamareyn"),
+        "vistaMareDettaglio": row.get("vistamaredettaglio"),
+        "vistaMare":          row.get("vistamare"),
+
+        "pertinenze":  row.get("pertinenze") or "",
+        "mqGiardino":  row.get("mqgiardino"),
+        "mqGarage":    row.get("mqgarage"),
+        "mqCantina":   row.get("mqcantina"),
+        "mqPostoAuto": row.get("mqpostoauto"),
+        "mqTaverna":   row.get("mqtaverna"),
+        "mqSoffitta":  row.get("mqsoffitta"),
+        "mqTerrazzo":  row.get("mqterrazzo"),
+        "numBalconi":  row.get("numbalconi"),
+
+        "via":              row.get("via"),
+        "altroDescrizione": row.get("altrodescrizione"),
+    }
+
+
 # ---------------------------
 # Utility semplici per la risposta finale
 # ---------------------------
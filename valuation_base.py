@@ -1,4 +1,6 @@
 from typing import Dict, Any
+import json
+import hashlib
 
 # --------------------------------------------------
 # BASE €/mq
@@ -171,6 +173,13 @@ def get_base_mq(comune: str, microzona: str) -> float:
     return float(BASE_MQ.get(comune, {}).get(microzona, 0.0))
 
 
+# Hash corto del listino base (come valuation.CATALOG_VERSION): chiave
+# delle cache e degli ETag delle superfici precalcolate
+CATALOG_VERSION = hashlib.sha1(
+    json.dumps(BASE_MQ, sort_keys=True, ensure_ascii=False).encode("utf-8")
+).hexdigest()[:12]
+
+
 # --------------------------------------------------
 # COEFFICIENTE ANNO (curva continua)
 # --------------------------------------------------
@@ -183,17 +192,7 @@ def coeff_anno(anno: int) -> float:
     if a <= 1950:
         return 0.75
 
-    points = [
-        (1950, 0.75),
-        (1965, 0.85),
-        (1975, 0.92),
-        (1990, 1.00),
-        (2000, 1.05),
-        (2010, 1.08),
-        (2015, 1.10),
-        (2020, 1.12),
-        (2025, 1.15),
-    ]
+    points = _PUNTI_ANNO
 
     if a >= 2025:
         return 1.15
@@ -208,6 +207,12 @@ def coeff_anno(anno: int) -> float:
     return 1.00
 
 
+_PUNTI_ANNO = (
+    (1950, 0.75), (1965, 0.85), (1975, 0.92), (1990, 1.00), (2000, 1.05),
+    (2010, 1.08), (2015, 1.10), (2020, 1.12), (2025, 1.15),
+)
+
+
 # --------------------------------------------------
 # COEFF RUSTICO PROGRESSIVO PER SUPERFICIE
 # --------------------------------------------------
@@ -299,3 +304,56 @@ def compute_base_from_payload(payload: Dict[str, Any]) -> Dict[str, float]:
         "mq": round(mq, 0),
         "price_base": round(valore_finale, 0),
     }
+
+
+# --------------------------------------------------
+# SUPERFICIE PRECALCOLATA (mq × anno, per tipologia)
+# --------------------------------------------------
+# Stessa formula di compute_base_from_payload su tutta la griglia in una
+# volta (numpy), per gli slider del form: il browser interpola tra i
+# nodi senza richiamare /api/stima_base.
+def superficie_base(comune: str, microzona: str, mq, anni, tipologie) -> Dict[str, Any]:
+    """
+    Per ogni tipologia due matrici len(anni) × len(mq):
+    eur_mq_visuale e price_base, arrotondate come compute_base_from_payload.
+    """
+    import numpy as np   # al primo uso: `import main` resta leggero
+
+    mq = np.asarray(mq, dtype=float)
+    anni = np.asarray(anni, dtype=int)
+    base = get_base_mq(comune, microzona)
+
+    # coeff_anno vettoriale: interpolazione tra i punti, arrotondata a 4 decimali
+    x0 = np.array([p[0] for p in _PUNTI_ANNO[:-1]], dtype=float)
+    x1 = np.array([p[0] for p in _PUNTI_ANNO[1:]], dtype=float)
+    c0 = np.array([p[1] for p in _PUNTI_ANNO[:-1]])
+    c1 = np.array([p[1] for p in _PUNTI_ANNO[1:]])
+    a = anni.astype(float)
+    i = np.clip(np.searchsorted(x1, a), 0, len(x1) - 1)
+    t = (a - x0[i]) / (x1[i] - x0[i])
+    c_anno = np.round(c0[i] + t * (c1[i] - c0[i]), 4)
+    c_anno = np.where(a <= 1950, 0.75, np.where(a >= 2025, 1.15, c_anno))
+    eur_mq = (base * c_anno)[:, None] * np.ones_like(mq)[None, :]
+
+    rustico = np.select([mq <= 100, mq <= 200, mq <= 400, mq <= 600],
+                        [0.60, 0.55, 0.45, 0.40], 0.35)
+    cap_mq = np.select([mq >= 800, mq >= 400, mq >= 200], [300, 450, 600], 0)
+    cap_anno = np.select([anni >= 2020, anni >= 2010], [900, 750], 600)
+    cap = np.where(cap_mq[None, :] > 0, cap_mq[None, :], cap_anno[:, None])
+
+    risultato = {}
+    for tipologia in tipologie:
+        tip = (tipologia or "").lower().strip()
+        if base <= 0:
+            finale = np.zeros_like(eur_mq)
+        elif "villa" in tip:
+            finale = eur_mq * 1.20
+        elif "rustico" in tip:
+            finale = np.minimum(eur_mq * rustico[None, :], cap)
+        else:
+            finale = eur_mq
+        risultato[tipologia] = {
+            "eur_mq_visuale": np.round(finale, 0),
+            "price_base": np.round(finale * mq[None, :], 0),
+        }
+    return risultato
@@ -0,0 +1,109 @@
+# verifica_avvio.py – budget sul tempo di import di main.py (cold start)
+#
+# Importa main in processi Python nuovi (-X importtime) e controlla che:
+#   - il costo di import dei NOSTRI moduli (main meno fastapi/pydantic/
+#     starlette, che servono comunque) resti sotto il budget, in mediana
+#   - i moduli pesanti NON siano caricati dall'import: arrivano al primo
+#     uso o nel warmup dopo il bind (vedi warmup() in main.py)
+# Esce con codice 1 se il budget è superato o un modulo vietato è caricato.
+#
+# Uso:
+#   python verifica_avvio.py
+#   python verifica_avvio.py --budget-ms 80 --giri 7
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Caricati solo al primo uso / nel warmup
+MODULI_VIETATI = (
+    "requests", "psycopg2", "reportlab", "pdf_report", "uvicorn",
+    "smtplib", "email.mime", "numpy", "yaml",
+)
+# Dipendenze del framework: il loro costo non rientra nel budget
+FRAMEWORK = ("fastapi", "pydantic", "starlette")
+
+BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "120"))
+
+_SONDA = (
+    "import sys, main\n"
+    "print('MODULI', ' '.join(sorted(sys.modules)))\n"
+)
+
+
+def _giro() -> tuple[dict, set]:
+    """Un import a freddo: ({modulo di primo livello: µs cumulativi}, moduli caricati)."""
+    env = {**os.environ, "SCHEMA_CHECK": "off", "PURGE_INTERVALLO": "0",
+           "LOG_LEVEL": "WARNING"}
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SONDA],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True, check=True,
+    )
+    tempi = {}
+    for riga in r.stderr.splitlines():
+        if not riga.startswith("import time:") or "|" not in riga:
+            continue
+        _, cumulativo, nome = riga.split("|")
+        if not cumulativo.strip().isdigit():
+            continue
+        # solo il primo livello sotto main (indentazione di due spazi) e main stesso
+        indent = len(nome) - len(nome.lstrip(" "))
+        if indent <= 3:
+            nome = nome.strip()
+            tempi[nome] = tempi.get(nome, 0) + int(cumulativo)
+    moduli = set()
+    for riga in r.stdout.splitlines():
+        if riga.startswith("MODULI "):
+            moduli = set(riga.split()[1:])
+    return tempi, moduli
+
+
+def verifica(giri: int, budget_ms: float) -> int:
+    propri, totali, dettagli = [], [], {}
+    moduli = set()
+    for _ in range(giri):
+        tempi, moduli = _giro()
+        totale = tempi.get("main", 0) / 1000
+        framework = sum(v for k, v in tempi.items()
+                        if k.split(".")[0] in FRAMEWORK) / 1000
+        totali.append(totale)
+        propri.append(totale - framework)
+        for k, v in tempi.items():
+            dettagli.setdefault(k, []).append(v / 1000)
+
+    proprio = statistics.median(propri)
+    print(f"import main: {statistics.median(totali):.0f} ms totali, "
+          f"{proprio:.0f} ms esclusi {'/'.join(FRAMEWORK)} (mediana di {giri})")
+    print("moduli di primo livello più lenti:")
+    for nome, valori in sorted(dettagli.items(), key=lambda kv: -statistics.median(kv[1]))[:8]:
+        if nome != "main":
+            print(f"  {statistics.median(valori):8.1f} ms  {nome}")
+
+    errori = 0
+    if proprio > budget_ms:
+        errori += 1
+        print(f"❌ budget superato: {proprio:.0f} ms > {budget_ms:.0f} ms")
+    else:
+        print(f"✅ budget rispettato: {proprio:.0f} ms ≤ {budget_ms:.0f} ms")
+
+    for vietato in MODULI_VIETATI:
+        caricati = sorted(m for m in moduli if m == vietato or m.startswith(vietato + "."))
+        if caricati:
+            errori += 1
+            print(f"❌ {vietato} caricato all'import di main ({', '.join(caricati[:3])})")
+    if not errori:
+        print("✅ nessun modulo pesante caricato all'import")
+    return errori
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Budget sul tempo di import di main.py")
+    ap.add_argument("--budget-ms", type=float, default=BUDGET_MS,
+                    help=f"ms ammessi per i moduli propri (default {BUDGET_MS:.0f}, env IMPORT_BUDGET_MS)")
+    ap.add_argument("--giri", type=int, default=5, help="import a freddo da misurare (mediana)")
+    args = ap.parse_args()
+
+    sys.exit(1 if verifica(args.giri, args.budget_ms) else 0)
@@ -0,0 +1,155 @@
+# verifica_indici.py – controlla che le query calde usino gli indici
+#
+# Crea uno schema temporaneo, applica le migrazioni, lo riempie con dati
+# finti (abbastanza righe perché il planner preferisca gli indici), poi
+# lancia EXPLAIN su ogni query SQL_* di main.py e su quelle per id.
+# Esce con codice 1 se trova un Seq Scan su una tabella grande.
+#
+# Uso:
+#   python verifica_indici.py
+#   python verifica_indici.py --righe 50000
+
+import os
+import sys
+import json
+import uuid
+import argparse
+from datetime import datetime, timedelta
+
+SCHEMA = f"verifica_indici_{uuid.uuid4().hex[:8]}"
+
+# Le connessioni (anche quelle di migrations/main) usano lo schema temporaneo
+os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+
+from database import get_connection  # noqa: E402
+from migrations import applica_migrazioni  # noqa: E402
+import main  # noqa: E402
+import purger  # noqa: E402
+
+TABELLE_GRANDI = {"stime", "stime_dettagliate", "whatsapp_incoming"}
+
+# Seq Scan attesi: la inbox admin senza "dal" legge per intero
+# whatsapp_incoming, ma il LATERAL su stime deve restare sull'indice
+SEQ_AMMESSI = {"SQL_WHATSAPP_MESSAGES (tutti)": {"whatsapp_incoming"}}
+
+
+def crea_schema():
+    conn = get_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.close(); conn.close()
+
+
+def elimina_schema():
+    conn = get_connection()
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.close(); conn.close()
+
+
+def popola(righe: int):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO stime (comune, microzona, via, mq, nome, cognome,
+                           telefono, token, token_expires, data)
+        SELECT 'Tortoreto', 'Lido Centro', 'Via ' || g, 80,
+               'Nome' || g, 'Cognome' || g,
+               '+39 333 ' || lpad(g::text, 7, '0'),
+               CASE WHEN g % 3 = 0 THEN md5(g::text)::uuid END,
+               NOW() + INTERVAL '7 days',
+               NOW() - (g || ' minutes')::interval
+        FROM generate_series(1, %s) g
+    """, (righe,))
+    cur.execute("""
+        INSERT INTO stime_dettagliate (stima_id, nome, data)
+        SELECT id, nome, data FROM stime WHERE id % 2 = 0
+    """)
+    cur.execute("""
+        INSERT INTO whatsapp_incoming (from_number, message_type, text,
+                                       received_at, direction)
+        SELECT '39333' || lpad(g::text, 7, '0'), 'text', 'ciao',
+               NOW() - (g || ' minutes')::interval, 'in'
+        FROM generate_series(1, %s) g
+    """, (righe,))
+    conn.commit()
+    conn.autocommit = True
+    cur.execute("ANALYZE")
+    cur.close(); conn.close()
+
+
+def _query_da_verificare():
+    """(nome, sql, parametri) per ogni query calda."""
+    oggi = datetime.combine(datetime.now().date(), datetime.min.time())
+    domani = oggi + timedelta(days=1)
+    return [
+        ("SQL_ADMIN_STIME", main.SQL_ADMIN_STIME, (oggi, domani)),
+        ("SQL_ADMIN_STIME_PRO", main.SQL_ADMIN_STIME_PRO, (oggi, domani)),
+        ("SQL_PREFILL", main.SQL_PREFILL, (str(uuid.uuid4()),)),
+        ("SQL_PREZZO_ZONA", main.SQL_PREZZO_ZONA, ("Tortoreto", "Lido Centro")),
+        ("SQL_WHATSAPP_MESSAGES (dal)",
+         main.SQL_WHATSAPP_MESSAGES.format(where="WHERE wi.received_at >= %s"),
+         (oggi,)),
+        ("SQL_WHATSAPP_MESSAGES (tutti)", main.SQL_WHATSAPP_MESSAGES.format(where=""), ()),
+        ("SQL_SOFT_DELETE_STIME", main.SQL_SOFT_DELETE_STIME, ([1, 2, 3],)),
+        ("SQL_SOFT_DELETE_DETTAGLIATE_DI_STIME",
+         main.SQL_SOFT_DELETE_DETTAGLIATE_DI_STIME, ([1, 2, 3],)),
+        ("SQL_PURGA_STIME", purger.SQL_PURGA_STIME, (60, 200)),
+        ("SQL_PURGA_DETTAGLIATE", purger.SQL_PURGA_DETTAGLIATE, (60, 200)),
+        ("UPDATE stime per id",
+         "UPDATE stime SET lead_status=%s WHERE id=%s AND deleted_at IS NULL",
+         ("contattato", 1)),
+        ("ottieni_stima_completa",
+         "SELECT * FROM stime s LEFT JOIN stime_dettagliate d ON d.stima_id = s.id "
+         "WHERE s.id = %s AND s.deleted_at IS NULL", (1,)),
+    ]
+
+
+def _seq_scan(piano: dict) -> list[str]:
+    """Tabelle grandi lette con Seq Scan nel piano (ricorsivo)."""
+    trovati = []
+    if piano.get("Node Type") == "Seq Scan" and piano.get("Relation Name") in TABELLE_GRANDI:
+        trovati.append(piano["Relation Name"])
+    for figlio in piano.get("Plans", []):
+        trovati.extend(_seq_scan(figlio))
+    return trovati
+
+
+def verifica(righe: int) -> int:
+    crea_schema()
+    try:
+        applica_migrazioni()
+        popola(righe)
+
+        errori = 0
+        conn = get_connection()
+        cur = conn.cursor()
+        for nome, sql, params in _query_da_verificare():
+            # i DELETE/UPDATE non vengono eseguiti: solo EXPLAIN (senza ANALYZE)
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            piano = cur.fetchone()[0]
+            if isinstance(piano, str):
+                piano = json.loads(piano)
+            seq = set(_seq_scan(piano[0]["Plan"])) - SEQ_AMMESSI.get(nome, set())
+            if seq:
+                errori += 1
+                print(f"❌ {nome}: Seq Scan su {', '.join(sorted(seq))}")
+            else:
+                print(f"✅ {nome}")
+        conn.rollback()
+        cur.close(); conn.close()
+        return errori
+    finally:
+        elimina_schema()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Verifica uso indici sulle query calde")
+    ap.add_argument("--righe", type=int, default=20000,
+                    help="righe finte per tabella (default 20000)")
+    args = ap.parse_args()
+
+    errori = verifica(args.righe)
+    sys.exit(1 if errori else 0)
@@ -24,7 +24,7 @@ from cover_pdf import genera_cover_pdf
 # --- regole di stima esatte ---
 import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from valuation import compute_from_payload
+from valuation import compute_from_payload, comune_canonico
 from pydantic import BaseModel
 from whatsapp import send_template_stima
 
@@ -238,17 +238,8 @@ class StimaIn(BaseModel):
 def normalizza_comune(val: Optional[str]) -> Optional[str]:
     if not val:
         return None
-    v = val.strip().replace("_", " ").lower()
-    # prima lettera maiuscola di ogni parola
-    v = " ".join(w.capitalize() for w in v.split())
-    # mappa sinonimi/comandi scritti male
-    M = {
-        "Alba Adriatica": "Alba Adriatica",
-        "Martinsicuro": "Martinsicuro",
-        "Tortoreto": "Tortoreto",
-    }
-    # se coincide con uno valido, ok; altrimenti None (così il DB non esplode)
-    return M.get(v, None)
+    # solo i comuni del listino; altrimenti None (così il DB non esplode)
+    return comune_canonico(val)
 
 # ---------------- SALVA STIMA (accetta FORM o JSON) ----------------
 def to_int(val):